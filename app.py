@@ -1,282 +1,100 @@
 import streamlit as st
 import pandas as pd
 import sqlite3
+import queue
+import multiprocessing
+import tempfile
+import zipfile
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 import hashlib
-import plotly.express as px
-import plotly.graph_objects as go
+import itertools
 from datetime import datetime, timedelta
-import base64
 from io import BytesIO
-import qrcode
-from PIL import Image, ImageDraw, ImageFont
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import re
+import sys
+import threading
+import time
 import json
-import uuid
+import secrets
+import export_worker
+from order_pdf import get_order_pdf
 
-# Configuración de la página
-st.set_page_config(
-    page_title="G-LAB - Mónica Riano Laboratorio Dental",
-    page_icon="🦷",
-    layout="wide",
-    initial_sidebar_state="collapsed"
-)
+# CSS personalizado con fondo azul claro y líneas: hoja de estilos estática (static/glab.css): Streamlit la sirve en app/static y el navegador
+# la descarga una sola vez; en cada rerun solo viaja la etiqueta <link>
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 
-# CSS personalizado con fondo azul claro y líneas
-def load_css():
-    st.markdown("""
-    <style>
-    @import url('https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;500;600;700&display=swap');
-    
-    .main {
-        background: linear-gradient(135deg, 
-            rgba(224, 247, 250, 0.9) 0%, 
-            rgba(178, 235, 242, 0.8) 25%,
-            rgba(129, 212, 250, 0.7) 50%,
-            rgba(100, 181, 246, 0.8) 75%,
-            rgba(144, 202, 249, 0.9) 100%);
-        background-attachment: fixed;
-        font-family: 'Poppins', sans-serif;
-        padding: 20px;
-    }
-    
-    /* Patrón de fondo elegante */
-    .main::before {
-        content: '';
-        position: fixed;
-        top: 0;
-        left: 0;
-        width: 100%;
-        height: 100%;
-        background-image: 
-            radial-gradient(circle at 25% 25%, rgba(255, 255, 255, 0.2) 2px, transparent 2px),
-            radial-gradient(circle at 75% 75%, rgba(255, 255, 255, 0.1) 1px, transparent 1px);
-        background-size: 50px 50px;
-        pointer-events: none;
-        z-index: -1;
-    }
-    
-    .logo-header {
-        text-align: center;
-        padding: 30px;
-        background: rgba(255, 255, 255, 0.95);
-        backdrop-filter: blur(15px);
-        border-radius: 20px;
-        margin: 20px 0;
-        border: 1px solid rgba(255, 255, 255, 0.3);
-        box-shadow: 0 8px 32px rgba(0, 0, 0, 0.1);
-    }
-    
-    .logo-header h1 {
-        background: linear-gradient(45deg, #1976d2, #42a5f5);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-        font-size: 2.5rem;
-        font-weight: 700;
-        margin-bottom: 10px;
-        text-shadow: 2px 2px 4px rgba(0,0,0,0.1);
-    }
-    
-    .logo-header h3 {
-        color: #1565c0;
-        font-weight: 600;
-        margin-bottom: 15px;
-        font-size: 1.3rem;
-    }
-    
-    .logo-header p {
-        color: #1976d2;
-        font-weight: 500;
-        font-size: 1.1rem;
-    }
-    
-    /* Botones de navegación mejorados */
-    .nav-button {
-        background: rgba(255, 255, 255, 0.9) !important;
-        backdrop-filter: blur(10px) !important;
-        border: 1px solid rgba(25, 118, 210, 0.3) !important;
-        border-radius: 15px !important;
-        padding: 15px 20px !important;
-        margin: 5px !important;
-        color: #1565c0 !important;
-        font-weight: 600 !important;
-        transition: all 0.3s ease !important;
-        box-shadow: 0 4px 15px rgba(0, 0, 0, 0.1) !important;
-    }
-    
-    .nav-button:hover {
-        background: linear-gradient(45deg, #1976d2, #42a5f5) !important;
-        color: white !important;
-        transform: translateY(-2px) !important;
-        box-shadow: 0 8px 25px rgba(25, 118, 210, 0.3) !important;
-    }
-    
-    /* Tarjetas de contenido elegantes */
-    .content-card {
-        background: rgba(255, 255, 255, 0.95);
-        backdrop-filter: blur(15px);
-        border-radius: 20px;
-        padding: 25px;
-        margin: 15px 0;
-        border: 1px solid rgba(255, 255, 255, 0.3);
-        box-shadow: 0 8px 32px rgba(0, 0, 0, 0.1);
-        transition: all 0.3s ease;
-    }
-    
-    .content-card:hover {
-        transform: translateY(-5px);
-        box-shadow: 0 15px 40px rgba(0, 0, 0, 0.15);
-    }
-    
-    /* Texto mejorado con mejor contraste */
-    .stMarkdown, .stText, p, span, div {
-        color: #0d47a1 !important;
-        font-weight: 500;
-    }
-    
-    h1, h2, h3, h4, h5, h6 {
-        color: #1565c0 !important;
-        font-weight: 700;
-        text-shadow: 1px 1px 2px rgba(0,0,0,0.1);
-    }
-    
-    /* Formularios elegantes */
-    .stTextInput > div > div > input,
-    .stSelectbox > div > div > select,
-    .stTextArea > div > div > textarea {
-        background: rgba(255, 255, 255, 0.9) !important;
-        backdrop-filter: blur(10px) !important;
-        border: 2px solid rgba(25, 118, 210, 0.3) !important;
-        border-radius: 12px !important;
-        color: #0d47a1 !important;
-        font-weight: 500 !important;
-    }
-    
-    .stTextInput > div > div > input:focus,
-    .stSelectbox > div > div > select:focus,
-    .stTextArea > div > div > textarea:focus {
-        border-color: #1976d2 !important;
-        box-shadow: 0 0 0 3px rgba(25, 118, 210, 0.1) !important;
-    }
-    
-    /* Métricas y estadísticas */
-    .metric-card {
-        background: linear-gradient(135deg, rgba(255, 255, 255, 0.95), rgba(240, 248, 255, 0.9));
-        backdrop-filter: blur(15px);
-        border-radius: 15px;
-        padding: 20px;
-        border: 1px solid rgba(25, 118, 210, 0.2);
-        box-shadow: 0 6px 20px rgba(0, 0, 0, 0.08);
-        text-align: center;
-        transition: all 0.3s ease;
-    }
-    
-    .metric-card:hover {
-        transform: scale(1.05);
-        box-shadow: 0 10px 30px rgba(25, 118, 210, 0.2);
-    }
-    
-    /* Sidebar mejorado */
-    .css-1d391kg {
-        background: rgba(255, 255, 255, 0.95);
-        backdrop-filter: blur(15px);
-    }
-    
-    /* Botones de acción */
-    .stButton > button {
-        background: linear-gradient(45deg, #1976d2, #42a5f5) !important;
-        color: white !important;
-        border: none !important;
-        border-radius: 12px !important;
-        padding: 12px 24px !important;
-        font-weight: 600 !important;
-        transition: all 0.3s ease !important;
-        box-shadow: 0 4px 15px rgba(25, 118, 210, 0.3) !important;
-    }
-    
-    .stButton > button:hover {
-        transform: translateY(-2px) !important;
-        box-shadow: 0 8px 25px rgba(25, 118, 210, 0.4) !important;
-    }
-    
-    /* Alertas y notificaciones */
-    .stAlert {
-        background: rgba(255, 255, 255, 0.95) !important;
-        backdrop-filter: blur(10px) !important;
-        border-radius: 12px !important;
-        border-left: 4px solid #1976d2 !important;
-    }
-    
-    /* Tablas elegantes */
-    .stDataFrame {
-        background: rgba(255, 255, 255, 0.95);
-        backdrop-filter: blur(10px);
-        border-radius: 12px;
-        overflow: hidden;
-        box-shadow: 0 4px 15px rgba(0, 0, 0, 0.1);
-    }
-    
-    /* Chat mejorado */
-    .stChatMessage {
-        background: rgba(255, 255, 255, 0.9) !important;
-        backdrop-filter: blur(10px) !important;
-        border-radius: 15px !important;
-        border: 1px solid rgba(25, 118, 210, 0.2) !important;
-        margin: 10px 0 !important;
-    }
-    
-    /* Expansores elegantes */
-    .streamlit-expanderHeader {
-        background: rgba(255, 255, 255, 0.9) !important;
-        backdrop-filter: blur(10px) !important;
-        border-radius: 12px !important;
-        border: 1px solid rgba(25, 118, 210, 0.2) !important;
-    }
-    
-    /* Efectos de hover para elementos interactivos */
-    .element-container:hover {
-        transition: all 0.3s ease;
-    }
-    
-    /* Animaciones suaves */
-    * {
-        transition: all 0.3s ease;
-    }
-    
-    /* Scrollbar personalizado */
-    ::-webkit-scrollbar {
-        width: 8px;
-    }
-    
-    ::-webkit-scrollbar-track {
-        background: rgba(255, 255, 255, 0.1);
-        border-radius: 10px;
-    }
-    
-    ::-webkit-scrollbar-thumb {
-        background: linear-gradient(45deg, #1976d2, #42a5f5);
-        border-radius: 10px;
-    }
-    
-    ::-webkit-scrollbar-thumb:hover {
-        background: linear-gradient(45deg, #1565c0, #1976d2);
-    }
-    </style>
-    """, unsafe_allow_html=True)
+@st.cache_resource
+def stylesheet_url():
+    # La versión depende del contenido: un cambio en el CSS invalida la copia del navegador
+    with open(os.path.join(STATIC_DIR, 'glab.css'), 'rb') as archivo:
+        version = hashlib.sha256(archivo.read()).hexdigest()[:12]
+    return f"app/static/glab.css?v={version}"
 
-load_css()
+def load_css():
+    st.markdown(f'<link rel="stylesheet" href="{stylesheet_url()}">', unsafe_allow_html=True)
 
 # El resto del código de la aplicación va aquí...
 
 
 
-# Función para inicializar la base de datos
-def init_database():
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
+# Configuración de la base de datos (se puede cambiar con variables de entorno)
+DB_PATH = os.environ.get('GLAB_DB_PATH', 'glab.db')
+DB_POOL_SIZE = int(os.environ.get('GLAB_DB_POOL_SIZE', '8'))
+
+def open_connection(path):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-32000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+# Pool de conexiones SQLite compartido por todas las sesiones del proceso
+class ConnectionPool:
+    def __init__(self, path, size):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+    
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return open_connection(self.path)
     
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+@st.cache_resource
+def get_connection_pool(path, size):
+    return ConnectionPool(path, size)
+
+@contextmanager
+def get_connection():
+    """Conexión del pool: confirma al salir, revierte si hay error"""
+    pool = get_connection_pool(DB_PATH, DB_POOL_SIZE)
+    conn = pool.acquire()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+# Esquema versionado de la base de datos
+# Cada migración se aplica una sola vez y queda registrada en schema_version.
+def _migration_001_esquema_inicial(cursor):
     # Tabla de usuarios
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS usuarios (
@@ -353,7 +171,669 @@ def init_database():
             activo INTEGER DEFAULT 1
         )
     ''')
+
+def _migration_002_cantidad_ordenes(cursor):
+    # create_new_order guarda la cantidad, pero el esquema original no tenía la columna
+    columnas = [row[1] for row in cursor.execute('PRAGMA table_info(ordenes)')]
+    if 'cantidad' not in columnas:
+        cursor.execute('ALTER TABLE ordenes ADD COLUMN cantidad INTEGER DEFAULT 1')
+
+def _migration_003_indices(cursor):
+    # Índices para los filtros, joins y ordenamientos más frecuentes
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_fecha_ingreso ON ordenes (fecha_ingreso)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_estado ON ordenes (estado, fecha_ingreso)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_tecnico ON ordenes (tecnico_asignado, fecha_ingreso)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_mensajero ON ordenes (mensajero, fecha_ingreso)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_doctor ON ordenes (doctor_id, fecha_ingreso)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_doctores_nombre ON doctores (nombre)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_login ON usuarios (username, activo)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventario_nombre ON inventario (nombre)')
+    # Índice de expresión: las consultas de stock crítico usan "cantidad - stock_minimo <= 0"
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventario_critico ON inventario (cantidad - stock_minimo)')
+    cursor.execute('ANALYZE')
+
+def _migration_004_resumen_diario(cursor):
+    # fecha_ingreso se guarda como texto ISO 'YYYY-MM-DD HH:MM:SS' para poder filtrar por rangos
+    cursor.execute("""
+        UPDATE ordenes SET fecha_ingreso = datetime(fecha_ingreso)
+        WHERE datetime(fecha_ingreso) IS NOT NULL AND fecha_ingreso != datetime(fecha_ingreso)
+    """)
+    
+    # Conteo e ingresos por día × estado × técnico × doctor ('' / 0 cuando no hay valor)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ordenes_daily_rollup (
+            dia TEXT NOT NULL,
+            estado TEXT NOT NULL,
+            tecnico TEXT NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            ordenes INTEGER NOT NULL DEFAULT 0,
+            ingresos REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, estado, tecnico, doctor_id)
+        ) WITHOUT ROWID
+    """)
+    
+    cursor.execute("DELETE FROM ordenes_daily_rollup")
+    cursor.execute("""
+        INSERT INTO ordenes_daily_rollup (dia, estado, tecnico, doctor_id, ordenes, ingresos)
+        SELECT COALESCE(substr(fecha_ingreso, 1, 10), ''), COALESCE(estado, ''),
+               COALESCE(tecnico_asignado, ''), COALESCE(doctor_id, 0), COUNT(*), SUM(precio)
+        FROM ordenes
+        GROUP BY 1, 2, 3, 4
+    """)
+    
+    # Los triggers mantienen el resumen en la misma transacción que cada escritura
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_rollup_insert AFTER INSERT ON ordenes
+        BEGIN
+            INSERT INTO ordenes_daily_rollup (dia, estado, tecnico, doctor_id, ordenes, ingresos)
+            VALUES (COALESCE(substr(NEW.fecha_ingreso, 1, 10), ''), COALESCE(NEW.estado, ''),
+                    COALESCE(NEW.tecnico_asignado, ''), COALESCE(NEW.doctor_id, 0), 1, NEW.precio)
+            ON CONFLICT (dia, estado, tecnico, doctor_id)
+            DO UPDATE SET ordenes = ordenes + 1, ingresos = ingresos + excluded.ingresos;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_rollup_delete AFTER DELETE ON ordenes
+        BEGIN
+            UPDATE ordenes_daily_rollup SET ordenes = ordenes - 1, ingresos = ingresos - OLD.precio
+            WHERE dia = COALESCE(substr(OLD.fecha_ingreso, 1, 10), '') AND estado = COALESCE(OLD.estado, '')
+              AND tecnico = COALESCE(OLD.tecnico_asignado, '') AND doctor_id = COALESCE(OLD.doctor_id, 0);
+            DELETE FROM ordenes_daily_rollup WHERE ordenes <= 0;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_rollup_update
+        AFTER UPDATE OF fecha_ingreso, estado, tecnico_asignado, doctor_id, precio ON ordenes
+        BEGIN
+            UPDATE ordenes_daily_rollup SET ordenes = ordenes - 1, ingresos = ingresos - OLD.precio
+            WHERE dia = COALESCE(substr(OLD.fecha_ingreso, 1, 10), '') AND estado = COALESCE(OLD.estado, '')
+              AND tecnico = COALESCE(OLD.tecnico_asignado, '') AND doctor_id = COALESCE(OLD.doctor_id, 0);
+            INSERT INTO ordenes_daily_rollup (dia, estado, tecnico, doctor_id, ordenes, ingresos)
+            VALUES (COALESCE(substr(NEW.fecha_ingreso, 1, 10), ''), COALESCE(NEW.estado, ''),
+                    COALESCE(NEW.tecnico_asignado, ''), COALESCE(NEW.doctor_id, 0), 1, NEW.precio)
+            ON CONFLICT (dia, estado, tecnico, doctor_id)
+            DO UPDATE SET ordenes = ordenes + 1, ingresos = ingresos + excluded.ingresos;
+            DELETE FROM ordenes_daily_rollup WHERE ordenes <= 0;
+        END
+    """)
+
+def _migration_005_busqueda(cursor):
+    # Índice de texto completo; rowid = ordenes.id
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS ordenes_fts USING fts5(
+            numero_orden, paciente, trabajo, observaciones, doctor,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    """)
     
+    cursor.execute("DELETE FROM ordenes_fts")
+    cursor.execute("""
+        INSERT INTO ordenes_fts (rowid, numero_orden, paciente, trabajo, observaciones, doctor)
+        SELECT o.id, o.numero_orden, o.paciente, o.trabajo, o.observaciones, d.nombre
+        FROM ordenes o
+        LEFT JOIN doctores d ON o.doctor_id = d.id
+    """)
+    
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_insert AFTER INSERT ON ordenes
+        BEGIN
+            INSERT INTO ordenes_fts (rowid, numero_orden, paciente, trabajo, observaciones, doctor)
+            VALUES (NEW.id, NEW.numero_orden, NEW.paciente, NEW.trabajo, NEW.observaciones,
+                    (SELECT nombre FROM doctores WHERE id = NEW.doctor_id));
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_update
+        AFTER UPDATE OF numero_orden, paciente, trabajo, observaciones, doctor_id ON ordenes
+        BEGIN
+            UPDATE ordenes_fts
+            SET numero_orden = NEW.numero_orden, paciente = NEW.paciente, trabajo = NEW.trabajo,
+                observaciones = NEW.observaciones,
+                doctor = (SELECT nombre FROM doctores WHERE id = NEW.doctor_id)
+            WHERE rowid = NEW.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_delete AFTER DELETE ON ordenes
+        BEGIN
+            DELETE FROM ordenes_fts WHERE rowid = OLD.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_doctor AFTER UPDATE OF nombre ON doctores
+        BEGIN
+            UPDATE ordenes_fts SET doctor = NEW.nombre
+            WHERE rowid IN (SELECT id FROM ordenes WHERE doctor_id = NEW.id);
+        END
+    """)
+
+def _migration_006_tracking_unico(cursor):
+    # Antes de exigir unicidad: vacíos a NULL y duplicados con sufijo del id
+    cursor.execute("UPDATE ordenes SET tracking_id = NULL WHERE trim(tracking_id) = ''")
+    cursor.execute("""
+        UPDATE ordenes SET tracking_id = tracking_id || '-' || id
+        WHERE tracking_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM ordenes WHERE tracking_id IS NOT NULL GROUP BY tracking_id COLLATE NOCASE
+        )
+    """)
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_ordenes_tracking ON ordenes (tracking_id COLLATE NOCASE)')
+
+def _migration_007_secuencias(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS secuencias (
+            nombre TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO secuencias (nombre, valor) VALUES ('orden', 0)")
+    sync_order_sequence(cursor)
+
+def _migration_008_indice_reporte_tecnicos(cursor):
+    # Índice que cubre la consulta agregada del reporte de técnicos (no lee la tabla)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ordenes_reporte_tecnicos
+        ON ordenes (tecnico_asignado, estado, fecha_ingreso, fecha_entrega, precio)
+    ''')
+
+def _migration_009_asignaciones_por_id(cursor):
+    # Técnico, mensajero y doctor del usuario pasan a ser llaves enteras; los nombres en
+    # ordenes quedan solo para mostrar y los mantiene al día un trigger
+    cursor.execute('ALTER TABLE ordenes ADD COLUMN tecnico_id INTEGER REFERENCES usuarios (id)')
+    cursor.execute('ALTER TABLE ordenes ADD COLUMN mensajero_id INTEGER REFERENCES usuarios (id)')
+    cursor.execute('ALTER TABLE usuarios ADD COLUMN doctor_id INTEGER REFERENCES doctores (id)')
+    backfill_assignment_ids(cursor)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_tecnico_id ON ordenes (tecnico_id, fecha_ingreso)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_mensajero_id ON ordenes (mensajero_id, fecha_ingreso)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_doctor ON usuarios (doctor_id)')
+    # Las búsquedas por nombre de técnico usan el prefijo de idx_ordenes_reporte_tecnicos
+    cursor.execute('DROP INDEX IF EXISTS idx_ordenes_tecnico')
+    cursor.execute('DROP INDEX IF EXISTS idx_ordenes_mensajero')
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_usuarios_nombre AFTER UPDATE OF nombre ON usuarios
+        BEGIN
+            UPDATE ordenes SET tecnico_asignado = NEW.nombre WHERE tecnico_id = NEW.id;
+            UPDATE ordenes SET mensajero = NEW.nombre WHERE mensajero_id = NEW.id;
+        END
+    """)
+    cursor.execute('ANALYZE')
+
+def backfill_assignment_ids(cursor):
+    """Completar tecnico_id, mensajero_id y usuarios.doctor_id a partir de los nombres"""
+    usuarios = cursor.execute(
+        "SELECT id, nombre, rol FROM usuarios WHERE rol IN ('Técnico', 'Mensajero') ORDER BY id"
+    ).fetchall()
+    # Con nombres repetidos gana el usuario más antiguo
+    for user_id, nombre, rol in usuarios:
+        if rol == 'Técnico':
+            cursor.execute('UPDATE ordenes SET tecnico_id = ? WHERE tecnico_asignado = ? AND tecnico_id IS NULL',
+                           (user_id, nombre))
+        else:
+            cursor.execute('UPDATE ordenes SET mensajero_id = ? WHERE mensajero = ? AND mensajero_id IS NULL',
+                           (user_id, nombre))
+    link_doctor_users(cursor)
+
+def link_doctor_users(cursor):
+    """Vincular por nombre los usuarios con rol Doctor que aún no tienen doctor_id"""
+    cursor.execute("""
+        UPDATE usuarios SET doctor_id = (SELECT MIN(d.id) FROM doctores d WHERE d.nombre = usuarios.nombre)
+        WHERE rol = 'Doctor' AND doctor_id IS NULL
+    """)
+
+def _migration_010_eventos(cursor):
+    # Bitácora de eventos de órdenes (solo se agregan filas) escrita por triggers en la misma
+    # transacción que el cambio, y etapas con su duración cerradas al llegar el siguiente estado
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ordenes_eventos (
+            id INTEGER PRIMARY KEY,
+            orden_id INTEGER NOT NULL REFERENCES ordenes (id),
+            tipo TEXT NOT NULL,
+            valor TEXT,
+            tecnico_id INTEGER,
+            fecha TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_eventos_orden ON ordenes_eventos (orden_id, id)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ordenes_etapas (
+            id INTEGER PRIMARY KEY,
+            orden_id INTEGER NOT NULL REFERENCES ordenes (id),
+            etapa TEXT NOT NULL,
+            inicio TEXT NOT NULL,
+            fin TEXT,
+            horas REAL,
+            tecnico_id INTEGER,
+            trabajo TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_etapas_abiertas ON ordenes_etapas (orden_id) WHERE fin IS NULL')
+    # Índices que cubren los percentiles: cada partición ya viene ordenada por horas
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_etapas_duracion ON ordenes_etapas (etapa, horas) WHERE horas IS NOT NULL')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_etapas_tecnico ON ordenes_etapas (etapa, tecnico_id, horas)
+        WHERE horas IS NOT NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_etapas_trabajo ON ordenes_etapas (etapa, trabajo, horas)
+        WHERE horas IS NOT NULL
+    ''')
+    
+    ahora = "strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')"
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_eventos_insert AFTER INSERT ON ordenes
+        BEGIN
+            INSERT INTO ordenes_eventos (orden_id, tipo, valor, tecnico_id, fecha)
+            VALUES (NEW.id, 'estado', NEW.estado, NEW.tecnico_id, COALESCE(NEW.fecha_ingreso, %s));
+        END
+    ''' % ahora)
+    for tipo, columna, valor in [('estado', 'estado', 'NEW.estado'),
+                                 ('tecnico', 'tecnico_id', 'NEW.tecnico_asignado'),
+                                 ('mensajero', 'mensajero_id', 'NEW.mensajero'),
+                                 ('ubicacion', 'ubicacion_actual', 'NEW.ubicacion_actual')]:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_eventos_{tipo} AFTER UPDATE OF {columna} ON ordenes
+            WHEN NEW.{columna} IS NOT OLD.{columna}
+            BEGIN
+                INSERT INTO ordenes_eventos (orden_id, tipo, valor, tecnico_id, fecha)
+                VALUES (NEW.id, '{tipo}', {valor}, NEW.tecnico_id, {ahora});
+            END
+        ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_etapas AFTER INSERT ON ordenes_eventos WHEN NEW.tipo = 'estado'
+        BEGIN
+            UPDATE ordenes_etapas
+            SET fin = NEW.fecha, horas = (julianday(NEW.fecha) - julianday(inicio)) * 24, tecnico_id = NEW.tecnico_id
+            WHERE orden_id = NEW.orden_id AND fin IS NULL;
+            INSERT INTO ordenes_etapas (orden_id, etapa, inicio, tecnico_id, trabajo)
+            SELECT NEW.orden_id, NEW.valor, NEW.fecha, NEW.tecnico_id, trabajo
+            FROM ordenes WHERE id = NEW.orden_id AND NEW.valor <> 'Entregada';
+        END
+    ''')
+    # Solo se conoce con certeza el inicio de las órdenes que siguen en 'Creada'
+    cursor.execute('''
+        INSERT INTO ordenes_eventos (orden_id, tipo, valor, tecnico_id, fecha)
+        SELECT id, 'estado', estado, tecnico_id, fecha_ingreso FROM ordenes
+        WHERE estado = 'Creada' AND fecha_ingreso IS NOT NULL
+    ''')
+
+def _migration_011_version_ordenes(cursor):
+    # Versión para control de concurrencia optimista: cada actualización la incrementa
+    cursor.execute('ALTER TABLE ordenes ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+def _migration_012_movimientos_inventario(cursor):
+    # Libro de movimientos de inventario (solo se agregan filas); inventario.cantidad pasa a ser
+    # el saldo materializado que el trigger actualiza con cada movimiento
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inventario_movimientos (
+            id INTEGER PRIMARY KEY,
+            item_id INTEGER NOT NULL REFERENCES inventario (id),
+            tipo TEXT NOT NULL,
+            cantidad INTEGER NOT NULL,
+            referencia TEXT,
+            usuario_id INTEGER REFERENCES usuarios (id),
+            fecha TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_movimientos_item ON inventario_movimientos (item_id, fecha)')
+    # El saldo actual abre el libro antes de crear el trigger, para no sumarlo dos veces
+    cursor.execute('''
+        INSERT INTO inventario_movimientos (item_id, tipo, cantidad, referencia, fecha)
+        SELECT id, 'ajuste', cantidad, 'Saldo inicial', strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')
+        FROM inventario WHERE cantidad <> 0
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_movimientos_saldo AFTER INSERT ON inventario_movimientos
+        BEGIN
+            UPDATE inventario SET cantidad = cantidad + NEW.cantidad WHERE id = NEW.item_id;
+        END
+    ''')
+
+def _migration_013_materiales(cursor):
+    # Lista de materiales por servicio (por unidad) y materiales de cada orden: 'reservado' al
+    # pasar a En Proceso, 'consumido' al pasar a Empacada
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS servicios_materiales (
+            servicio_id INTEGER NOT NULL REFERENCES servicios (id),
+            item_id INTEGER NOT NULL REFERENCES inventario (id),
+            cantidad INTEGER NOT NULL,
+            PRIMARY KEY (servicio_id, item_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ordenes_materiales (
+            orden_id INTEGER NOT NULL REFERENCES ordenes (id),
+            item_id INTEGER NOT NULL REFERENCES inventario (id),
+            cantidad INTEGER NOT NULL,
+            estado TEXT NOT NULL,
+            PRIMARY KEY (orden_id, item_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_servicios_nombre ON servicios (nombre)')
+    # Reservado materializado por item, mantenido por triggers como el saldo
+    cursor.execute('ALTER TABLE inventario ADD COLUMN reservado INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_materiales_reserva AFTER INSERT ON ordenes_materiales
+        WHEN NEW.estado = 'reservado'
+        BEGIN
+            UPDATE inventario SET reservado = reservado + NEW.cantidad WHERE id = NEW.item_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_materiales_consumo AFTER UPDATE OF estado ON ordenes_materiales
+        WHEN OLD.estado = 'reservado' AND NEW.estado <> 'reservado'
+        BEGIN
+            UPDATE inventario SET reservado = reservado - OLD.cantidad WHERE id = OLD.item_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_materiales_liberacion AFTER DELETE ON ordenes_materiales
+        WHEN OLD.estado = 'reservado'
+        BEGIN
+            UPDATE inventario SET reservado = reservado - OLD.cantidad WHERE id = OLD.item_id;
+        END
+    ''')
+
+def _migration_014_consumo_diario(cursor):
+    # Consumo diario por material para el pronóstico, mantenido por trigger como el resumen de
+    # órdenes: el libro es solo de inserciones, así que basta con sumar cada consumo nuevo
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inventario_consumo_diario (
+            dia TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            cantidad INTEGER NOT NULL,
+            PRIMARY KEY (dia, item_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT INTO inventario_consumo_diario (dia, item_id, cantidad)
+        SELECT substr(fecha, 1, 10), item_id, -SUM(cantidad) FROM inventario_movimientos
+        WHERE tipo = 'consumo'
+        GROUP BY substr(fecha, 1, 10), item_id
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_consumo_diario AFTER INSERT ON inventario_movimientos
+        WHEN NEW.tipo = 'consumo'
+        BEGIN
+            INSERT INTO inventario_consumo_diario (dia, item_id, cantidad)
+            VALUES (substr(NEW.fecha, 1, 10), NEW.item_id, -NEW.cantidad)
+            ON CONFLICT (dia, item_id) DO UPDATE SET cantidad = cantidad + excluded.cantidad;
+        END
+    ''')
+
+def _migration_015_lotes(cursor):
+    # Lotes con su propio vencimiento; las entradas del libro crean lotes y las salidas los
+    # consumen en orden FEFO (primero el que vence antes, los que no vencen al final)
+    cursor.execute('ALTER TABLE inventario_movimientos ADD COLUMN lote TEXT')
+    cursor.execute('ALTER TABLE inventario_movimientos ADD COLUMN vencimiento TEXT')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inventario_lotes (
+            id INTEGER PRIMARY KEY,
+            item_id INTEGER NOT NULL REFERENCES inventario (id),
+            movimiento_id INTEGER REFERENCES inventario_movimientos (id),
+            lote TEXT,
+            fecha_vencimiento TEXT,
+            inicial INTEGER NOT NULL,
+            cantidad INTEGER NOT NULL,
+            fecha_ingreso TEXT NOT NULL
+        )
+    ''')
+    # Índices parciales: solo los lotes con saldo, así no crecen con los años de lotes agotados
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_lotes_fefo
+        ON inventario_lotes (item_id, fecha_vencimiento IS NULL, fecha_vencimiento, id, cantidad) WHERE cantidad > 0
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_lotes_vencimiento
+        ON inventario_lotes (fecha_vencimiento, item_id, cantidad, lote) WHERE cantidad > 0
+    ''')
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS lotes_por_vencer AS
+        SELECT l.fecha_vencimiento, l.item_id, i.nombre, l.lote, l.cantidad
+        FROM inventario_lotes l JOIN inventario i ON i.id = l.item_id
+        WHERE l.cantidad > 0 AND l.fecha_vencimiento IS NOT NULL
+    ''')
+    cursor.execute('''
+        INSERT INTO inventario_lotes (item_id, lote, fecha_vencimiento, inicial, cantidad, fecha_ingreso)
+        SELECT id, 'Saldo inicial', NULLIF(fecha_vencimiento, ''), cantidad, cantidad,
+               strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')
+        FROM inventario WHERE cantidad > 0
+    ''')
+    # Un solo trigger para fijar el orden: los lotes se calculan con el saldo anterior al movimiento.
+    # Una entrada primero cubre el saldo negativo (consumos sin lote) y solo el resto forma lote.
+    cursor.execute('DROP TRIGGER IF EXISTS trg_movimientos_saldo')
+    cursor.execute('''
+        CREATE TRIGGER trg_movimientos_saldo AFTER INSERT ON inventario_movimientos
+        BEGIN
+            UPDATE inventario_lotes SET cantidad = cantidad - fefo.tomar
+            FROM (
+                SELECT id, MIN(cantidad, MAX(0, -NEW.cantidad - (SUM(cantidad) OVER (
+                           ORDER BY fecha_vencimiento IS NULL, fecha_vencimiento, id ROWS UNBOUNDED PRECEDING
+                       ) - cantidad))) AS tomar
+                FROM inventario_lotes
+                WHERE item_id = NEW.item_id AND cantidad > 0 AND NEW.cantidad < 0
+            ) fefo
+            WHERE inventario_lotes.id = fefo.id AND fefo.tomar > 0;
+            INSERT INTO inventario_lotes (item_id, movimiento_id, lote, fecha_vencimiento, inicial, cantidad, fecha_ingreso)
+            SELECT NEW.item_id, NEW.id, NEW.lote, NEW.vencimiento,
+                   NEW.cantidad - MAX(0, -i.cantidad), NEW.cantidad - MAX(0, -i.cantidad), NEW.fecha
+            FROM inventario i WHERE i.id = NEW.item_id AND NEW.cantidad > MAX(0, -i.cantidad);
+            UPDATE inventario
+            SET cantidad = cantidad + NEW.cantidad,
+                fecha_vencimiento = (SELECT MIN(fecha_vencimiento) FROM inventario_lotes
+                                     WHERE item_id = NEW.item_id AND cantidad > 0)
+            WHERE id = NEW.item_id;
+        END
+    ''')
+
+def _migration_016_indice_usuarios(cursor):
+    # Lista paginada de usuarios por llave (rol, nombre, id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_rol_nombre ON usuarios (rol, nombre)')
+
+def _migration_017_indice_inventario_stock(cursor):
+    # El inventario completo (pronóstico y alertas) se lee solo desde el índice, en orden por nombre
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventario_stock
+        ON inventario (nombre, cantidad, reservado, stock_minimo)
+    ''')
+
+def _migration_018_resumen_por_llave(cursor):
+    # Al restar una orden solo puede quedar en cero la fila de su llave anterior: se borra esa fila
+    # en lugar de buscar filas vacías en todo el resumen
+    llave_anterior = """
+        dia = COALESCE(substr(OLD.fecha_ingreso, 1, 10), '') AND estado = COALESCE(OLD.estado, '')
+        AND tecnico = COALESCE(OLD.tecnico_asignado, '') AND doctor_id = COALESCE(OLD.doctor_id, 0)
+    """
+    cursor.execute("DROP TRIGGER IF EXISTS trg_rollup_delete")
+    cursor.execute(f"""
+        CREATE TRIGGER trg_rollup_delete AFTER DELETE ON ordenes
+        BEGIN
+            UPDATE ordenes_daily_rollup SET ordenes = ordenes - 1, ingresos = ingresos - OLD.precio
+            WHERE {llave_anterior};
+            DELETE FROM ordenes_daily_rollup WHERE {llave_anterior} AND ordenes <= 0;
+        END
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS trg_rollup_update")
+    cursor.execute(f"""
+        CREATE TRIGGER trg_rollup_update
+        AFTER UPDATE OF fecha_ingreso, estado, tecnico_asignado, doctor_id, precio ON ordenes
+        BEGIN
+            UPDATE ordenes_daily_rollup SET ordenes = ordenes - 1, ingresos = ingresos - OLD.precio
+            WHERE {llave_anterior};
+            INSERT INTO ordenes_daily_rollup (dia, estado, tecnico, doctor_id, ordenes, ingresos)
+            VALUES (COALESCE(substr(NEW.fecha_ingreso, 1, 10), ''), COALESCE(NEW.estado, ''),
+                    COALESCE(NEW.tecnico_asignado, ''), COALESCE(NEW.doctor_id, 0), 1, NEW.precio)
+            ON CONFLICT (dia, estado, tecnico, doctor_id)
+            DO UPDATE SET ordenes = ordenes + 1, ingresos = ingresos + excluded.ingresos;
+            DELETE FROM ordenes_daily_rollup WHERE {llave_anterior} AND ordenes <= 0;
+        END
+    """)
+
+def _migration_019_orden_fefo(cursor):
+    # Orden FEFO como columna simple, fijada al crear el lote (los lotes sin vencimiento van al
+    # final): el índice tiene exactamente las columnas del ORDER BY y lo cubre, así que ninguna
+    # consulta de lotes necesita ordenar ni leer la tabla
+    cursor.execute("ALTER TABLE inventario_lotes ADD COLUMN vence_orden TEXT NOT NULL DEFAULT '9999-12-31'")
+    cursor.execute("UPDATE inventario_lotes SET vence_orden = fecha_vencimiento WHERE fecha_vencimiento IS NOT NULL")
+    cursor.execute('DROP INDEX IF EXISTS idx_lotes_fefo')
+    cursor.execute('''
+        CREATE INDEX idx_lotes_fefo
+        ON inventario_lotes (item_id, vence_orden, id, cantidad) WHERE cantidad > 0
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS trg_movimientos_saldo')
+    cursor.execute('''
+        CREATE TRIGGER trg_movimientos_saldo AFTER INSERT ON inventario_movimientos
+        BEGIN
+            UPDATE inventario_lotes SET cantidad = cantidad - fefo.tomar
+            FROM (
+                SELECT id, MIN(cantidad, MAX(0, -NEW.cantidad - (SUM(cantidad) OVER (
+                           ORDER BY vence_orden, id ROWS UNBOUNDED PRECEDING
+                       ) - cantidad))) AS tomar
+                FROM inventario_lotes
+                WHERE item_id = NEW.item_id AND cantidad > 0 AND NEW.cantidad < 0
+            ) fefo
+            WHERE inventario_lotes.id = fefo.id AND fefo.tomar > 0;
+            INSERT INTO inventario_lotes (item_id, movimiento_id, lote, fecha_vencimiento, vence_orden,
+                                          inicial, cantidad, fecha_ingreso)
+            SELECT NEW.item_id, NEW.id, NEW.lote, NEW.vencimiento, COALESCE(NEW.vencimiento, '9999-12-31'),
+                   NEW.cantidad - MAX(0, -i.cantidad), NEW.cantidad - MAX(0, -i.cantidad), NEW.fecha
+            FROM inventario i WHERE i.id = NEW.item_id AND NEW.cantidad > MAX(0, -i.cantidad);
+            UPDATE inventario
+            SET cantidad = cantidad + NEW.cantidad,
+                fecha_vencimiento = (SELECT MIN(fecha_vencimiento) FROM inventario_lotes
+                                     WHERE item_id = NEW.item_id AND cantidad > 0)
+            WHERE id = NEW.item_id;
+        END
+    ''')
+
+# Migraciones en orden: (versión, descripción, función)
+SCHEMA_MIGRATIONS = [
+    (1, 'Esquema inicial', _migration_001_esquema_inicial),
+    (2, 'Columna cantidad en ordenes', _migration_002_cantidad_ordenes),
+    (3, 'Índices para consultas frecuentes', _migration_003_indices),
+    (4, 'Fechas ISO y resumen diario de órdenes', _migration_004_resumen_diario),
+    (5, 'Búsqueda de texto completo en órdenes', _migration_005_busqueda),
+    (6, 'Tracking ID único', _migration_006_tracking_unico),
+    (7, 'Secuencia de números de orden', _migration_007_secuencias),
+    (8, 'Índice del reporte de técnicos', _migration_008_indice_reporte_tecnicos),
+    (9, 'Técnico, mensajero y doctor por id', _migration_009_asignaciones_por_id),
+    (10, 'Bitácora de eventos y etapas de órdenes', _migration_010_eventos),
+    (11, 'Versión de órdenes para concurrencia optimista', _migration_011_version_ordenes),
+    (12, 'Libro de movimientos de inventario', _migration_012_movimientos_inventario),
+    (13, 'Materiales por servicio y por orden', _migration_013_materiales),
+    (14, 'Consumo diario por material', _migration_014_consumo_diario),
+    (15, 'Lotes de inventario con vencimiento', _migration_015_lotes),
+    (16, 'Índice de la lista de usuarios', _migration_016_indice_usuarios),
+    (17, 'Índice cubriente del stock de inventario', _migration_017_indice_inventario_stock),
+    (18, 'Limpieza del resumen diario por llave', _migration_018_resumen_por_llave),
+    (19, 'Orden FEFO de lotes sin ordenar en memoria', _migration_019_orden_fefo),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT NOT NULL,
+            aplicada_en TEXT NOT NULL
+        )
+    ''')
+    return conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+
+def apply_migrations(conn):
+    """Aplicar las migraciones pendientes y devolver la versión resultante"""
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return SCHEMA_VERSION
+    
+    # BEGIN IMMEDIATE serializa a otros procesos que migren al mismo tiempo
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current_version = get_schema_version(conn)
+        cursor = conn.cursor()
+        for version, descripcion, migration in SCHEMA_MIGRATIONS:
+            if version > current_version:
+                migration(cursor)
+                cursor.execute('INSERT INTO schema_version (version, descripcion, aplicada_en) VALUES (?, ?, ?)',
+                               (version, descripcion, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    return SCHEMA_VERSION
+
+# Consultas frecuentes que deben resolverse con índices, nunca recorriendo la tabla completa.
+# benchmark.py plans revisa su EXPLAIN QUERY PLAN sobre un millón de órdenes.
+HOT_QUERIES = {
+    'login': (
+        "SELECT * FROM usuarios WHERE username = ? AND password = ? AND activo = 1",
+        ('admin', '')),
+    'ordenes_tecnico': (
+        "SELECT o.*, d.nombre as doctor_nombre FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id "
+        "WHERE o.tecnico_id = ? ORDER BY o.fecha_ingreso DESC",
+        (3,)),
+    'ordenes_doctor': (
+        "SELECT * FROM ordenes WHERE doctor_id = ? ORDER BY fecha_ingreso DESC",
+        (1,)),
+    'ordenes_en_transporte': (
+        "SELECT o.*, d.nombre as doctor_nombre FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id "
+        "WHERE o.estado = 'En Transporte' ORDER BY o.fecha_ingreso DESC",
+        ()),
+    'total_por_estado': (
+        "SELECT COUNT(*) as total FROM ordenes WHERE estado = ?",
+        ('Entregada',)),
+    'orden_por_numero': (
+        "SELECT o.*, d.nombre as doctor_nombre FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id "
+        "WHERE o.numero_orden = ?",
+        ('ORD-001',)),
+    'inventario': (
+        "SELECT id, nombre, cantidad, reservado, stock_minimo FROM inventario ORDER BY nombre",
+        ()),
+    'stock_critico': (
+        "SELECT nombre, cantidad, stock_minimo FROM inventario WHERE cantidad - stock_minimo <= 0",
+        ()),
+    'ordenes_por_fecha': (
+        "SELECT * FROM ordenes WHERE fecha_ingreso >= ? AND fecha_ingreso < ? ORDER BY fecha_ingreso DESC",
+        ('2025-07-01', '2025-08-01')),
+    'tracking_exacto': (
+        "SELECT o.*, d.nombre as doctor_nombre FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id "
+        "WHERE o.tracking_id = ? COLLATE NOCASE",
+        ('012b7a15',)),
+    'tracking_prefijo': (
+        "SELECT o.*, d.nombre as doctor_nombre FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id "
+        "WHERE o.tracking_id >= ? COLLATE NOCASE AND o.tracking_id < ? COLLATE NOCASE "
+        "ORDER BY o.tracking_id COLLATE NOCASE LIMIT ?",
+        ('012b', '012b\uffff', 11)),
+    'resumen_periodo': (
+        "SELECT SUM(ordenes), SUM(ingresos) FROM ordenes_daily_rollup WHERE dia >= ? AND dia < ?",
+        ('2025-07-01', '2025-08-01')),
+}
+
+# Estado del esquema compartido por todas las sesiones del proceso
+@st.cache_resource
+def _schema_state():
+    return {'version': 0, 'lock': threading.Lock()}
+
+# Función para inicializar la base de datos
+def init_database():
+    state = _schema_state()
+    if state['version'] >= SCHEMA_VERSION:
+        return
+    
+    with state['lock']:
+        if state['version'] < SCHEMA_VERSION:
+            with get_connection() as conn:
+                state['version'] = apply_migrations(conn)
+
+# Datos de ejemplo (se cargan con: python app.py --bootstrap)
+def bootstrap_database():
+    with get_connection() as conn:
+        apply_migrations(conn)
+        _insert_seed_data(conn.cursor())
+        backfill_assignment_ids(conn.cursor())
+        sync_order_sequence(conn.cursor())
+
+def _insert_seed_data(cursor):
     # Insertar usuarios por defecto
     usuarios_default = [
         ('admin', hashlib.md5('admin123'.encode()).hexdigest(), 'Administrador G-LAB', 'admin@glab.com', '313-222-1878', 'Administrador'),
@@ -382,8 +862,9 @@ def init_database():
         ('Dra. Luz Mary', 'Centro Odontológico Luz Mary', 'Prótesis Dental', '313-456-7894', 'dra.luzmary@email.com', 'VIP', 15.0)
     ]
     
+    # doctores, servicios e inventario no tienen clave única: se evita duplicar por nombre
     for doctor in doctores_default:
-        cursor.execute('INSERT OR IGNORE INTO doctores (nombre, clinica, especialidad, telefono, email, categoria, descuento) VALUES (?, ?, ?, ?, ?, ?, ?)', doctor)
+        cursor.execute('INSERT INTO doctores (nombre, clinica, especialidad, telefono, email, categoria, descuento) SELECT ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM doctores WHERE nombre = ?)', doctor + (doctor[0],))
     
     # Insertar servicios únicos (sin duplicados)
     servicios_default = [
@@ -399,7 +880,7 @@ def init_database():
     ]
     
     for servicio in servicios_default:
-        cursor.execute('INSERT OR IGNORE INTO servicios (nombre, categoria, precio, tiempo_estimado, descripcion) VALUES (?, ?, ?, ?, ?)', servicio)
+        cursor.execute('INSERT INTO servicios (nombre, categoria, precio, tiempo_estimado, descripcion) SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM servicios WHERE nombre = ?)', servicio + (servicio[0],))
     
     # Insertar órdenes de ejemplo
     ordenes_ejemplo = [
@@ -422,276 +903,153 @@ def init_database():
         ('Cera para Modelado', 'Materiales', 40, 12000, 'Wax Dental Pro', '2026-10-20', 8)
     ]
     
-    for item in inventario_ejemplo:
-        cursor.execute('INSERT OR IGNORE INTO inventario (nombre, categoria, cantidad, precio_unitario, proveedor, fecha_vencimiento, stock_minimo) VALUES (?, ?, ?, ?, ?, ?, ?)', item)
+    # El saldo inicial entra como movimiento para que el libro cuadre con inventario.cantidad
+    for nombre, categoria, cantidad, precio_unitario, proveedor, fecha_vencimiento, stock_minimo in inventario_ejemplo:
+        cursor.execute('INSERT INTO inventario (nombre, categoria, cantidad, precio_unitario, proveedor, fecha_vencimiento, stock_minimo) SELECT ?, ?, 0, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM inventario WHERE nombre = ?)',
+                       (nombre, categoria, precio_unitario, proveedor, fecha_vencimiento, stock_minimo, nombre))
+        if cursor.rowcount:
+            record_inventory_movements(cursor, [(cursor.lastrowid, 'entrada', cantidad, 'Inventario inicial',
+                                                 None, fecha_vencimiento)])
+    
+    # Materiales por unidad de cada servicio
+    materiales_ejemplo = [
+        ('Corona Metal-Cerámica', 'Aleación Metálica', 1), ('Corona Metal-Cerámica', 'Porcelana Feldespática', 1),
+        ('Corona Metal-Cerámica', 'Yeso Dental', 1), ('Corona Metal-Cerámica', 'Cera para Modelado', 1),
+        ('Puente 3 Unidades', 'Aleación Metálica', 3), ('Puente 3 Unidades', 'Porcelana Feldespática', 3),
+        ('Puente 3 Unidades', 'Yeso Dental', 2), ('Puente 3 Unidades', 'Cera para Modelado', 2),
+        ('Prótesis Total', 'Resina Acrílica', 3), ('Prótesis Total', 'Yeso Dental', 2),
+        ('Prótesis Total', 'Cera para Modelado', 2),
+        ('Carillas de Porcelana', 'Porcelana Feldespática', 1), ('Carillas de Porcelana', 'Yeso Dental', 1),
+        ('Implante Dental', 'Porcelana Feldespática', 1), ('Implante Dental', 'Yeso Dental', 1),
+        ('Incrustación', 'Porcelana Feldespática', 1), ('Incrustación', 'Yeso Dental', 1),
+        ('Blanqueamiento', 'Resina Acrílica', 1), ('Blanqueamiento', 'Yeso Dental', 1),
+        ('Férula de Descarga', 'Resina Acrílica', 1), ('Férula de Descarga', 'Yeso Dental', 1),
+        ('Retenedor Ortodóntico', 'Resina Acrílica', 1), ('Retenedor Ortodóntico', 'Yeso Dental', 1)
+    ]
     
-    conn.commit()
-    conn.close()
+    for servicio, material, cantidad in materiales_ejemplo:
+        cursor.execute('INSERT OR IGNORE INTO servicios_materiales (servicio_id, item_id, cantidad) SELECT s.id, i.id, ? FROM servicios s, inventario i WHERE s.nombre = ? AND i.nombre = ? LIMIT 1', (cantidad, servicio, material))
 
-# Función para generar QR
-def generate_qr_code(data):
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(data)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    return img
+# Módulo de exportación masiva de PDFs
+# Un solo proceso por defecto: cada proceso del pool carga su propio reportlab y su caché de QR,
+# y con pocos núcleos o PDFs ya en caché el pool resulta más lento que renderizar en el servidor
+EXPORT_WORKERS = int(os.environ.get('GLAB_EXPORT_WORKERS', '1'))
+EXPORT_MAX_MB = int(os.environ.get('GLAB_EXPORT_MAX_MB', '200'))
+EXPORT_MAX_ORDERS = int(os.environ.get('GLAB_EXPORT_MAX_ORDERS', '10000'))
 
-# Función para generar PDF con formato exacto
-def generate_order_pdf(order_data):
-    try:
-        from reportlab.lib.pagesizes import letter
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.units import inch
-        from reportlab.lib.colors import red, black, blue
-        
-        buffer = BytesIO()
-        c = canvas.Canvas(buffer, pagesize=letter)
-        width, height = letter
-        
-        # Header con logo estilizado
-        c.setFont("Helvetica-Bold", 20)
-        c.setFillColor(black)
-        c.drawString(100, height - 60, "🦷 Mónica Riano")
-        
-        c.setFont("Helvetica", 12)
-        c.drawString(100, height - 80, "LABORATORIO DENTAL S.A.S")
-        
-        # Número de orden en recuadro rojo (esquina superior derecha)
-        c.setFillColor(red)
-        c.rect(450, height - 100, 120, 60, fill=1)
-        c.setFillColor(black)
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(460, height - 55, "ORDEN No.")
-        c.setFont("Helvetica-Bold", 18)
-        c.drawString(470, height - 75, order_data.get('numero_orden', 'N/A'))
-        
-        # Campos principales del formulario
-        y_pos = height - 140
-        
-        # NOMBRE DE LA CLÍNICA
-        c.setFont("Helvetica", 10)
-        c.drawString(50, y_pos, "NOMBRE DE LA CLÍNICA")
-        c.rect(50, y_pos - 25, 300, 20)
-        c.drawString(55, y_pos - 20, order_data.get('clinica', ''))
-        
-        # FECHA DE ENTREGA AL LABORATORIO (derecha)
-        c.drawString(400, y_pos, "FECHA DE ENTREGA AL LABORATORIO")
-        c.rect(400, y_pos - 25, 80, 20)
-        c.rect(480, y_pos - 25, 80, 20)
-        
-        # NOMBRE DEL DOCTOR(A)
-        y_pos -= 50
-        c.drawString(50, y_pos, "NOMBRE DEL DOCTOR(A)")
-        c.rect(50, y_pos - 25, 300, 20)
-        c.drawString(55, y_pos - 20, order_data.get('doctor', ''))
-        
-        # FECHA DE ENTREGA A LA CLÍNICA (derecha)
-        c.drawString(400, y_pos, "FECHA DE ENTREGA A LA CLÍNICA")
-        c.rect(400, y_pos - 25, 80, 20)
-        c.rect(480, y_pos - 25, 80, 20)
-        
-        # PACIENTE
-        y_pos -= 50
-        c.drawString(50, y_pos, "PACIENTE")
-        c.rect(50, y_pos - 25, 300, 20)
-        c.drawString(55, y_pos - 20, order_data.get('paciente', ''))
-        
-        # Secciones de checkboxes
-        y_pos -= 80
-        
-        # METAL CERÁMICA
-        c.drawString(50, y_pos, "METAL CERÁMICA")
-        c.rect(50, y_pos - 20, 150, 80)
-        
-        # Checkboxes dentro de Metal Cerámica
-        checkbox_y = y_pos - 35
-        c.rect(60, checkbox_y, 10, 10)
-        c.drawString(75, checkbox_y + 2, "SOBREDENTADURA")
-        
-        checkbox_y -= 15
-        c.rect(60, checkbox_y, 10, 10)
-        c.drawString(75, checkbox_y + 2, "CORONA")
-        
-        checkbox_y -= 15
-        c.rect(60, checkbox_y, 10, 10)
-        c.drawString(75, checkbox_y + 2, "BARRA HÍBRIDA")
-        
-        # DISILICATO DE LITIO (centro)
-        c.drawString(220, y_pos, "DISILICATO DE LITIO")
-        c.rect(220, y_pos - 20, 150, 80)
-        
-        # Checkboxes dentro de Disilicato de Litio
-        checkbox_y = y_pos - 35
-        c.rect(230, checkbox_y, 10, 10)
-        c.drawString(245, checkbox_y + 2, "CARILLAS")
-        
-        checkbox_y -= 15
-        c.rect(230, checkbox_y, 10, 10)
-        c.drawString(245, checkbox_y + 2, "CORONAS")
-        
-        checkbox_y -= 15
-        c.rect(230, checkbox_y, 10, 10)
-        c.drawString(245, checkbox_y + 2, "INCRUSTACIÓN")
-        
-        # DISILICATO DE LITIO (derecha)
-        c.drawString(390, y_pos, "DISILICATO DE LITIO")
-        c.rect(390, y_pos - 20, 150, 80)
-        
-        # Checkboxes dentro de Disilicato de Litio (derecha)
-        checkbox_y = y_pos - 35
-        c.rect(400, checkbox_y, 10, 10)
-        c.drawString(415, checkbox_y + 2, "COLOR SUSTRATO")
-        
-        checkbox_y -= 15
-        c.rect(400, checkbox_y, 10, 10)
-        c.drawString(415, checkbox_y + 2, "COLOR FINAL")
-        
-        checkbox_y -= 15
-        c.rect(400, checkbox_y, 10, 10)
-        c.drawString(415, checkbox_y + 2, "ZIRCONIO")
-        
-        # Segunda fila de secciones
-        y_pos -= 120
-        
-        # TITANIO
-        c.drawString(50, y_pos, "TITANIO")
-        c.rect(50, y_pos - 20, 150, 60)
-        
-        checkbox_y = y_pos - 35
-        c.rect(60, checkbox_y, 10, 10)
-        c.drawString(75, checkbox_y + 2, "BARRA")
-        
-        checkbox_y -= 15
-        c.rect(60, checkbox_y, 10, 10)
-        c.drawString(75, checkbox_y + 2, "PILAR PERSONALIZADA")
-        
-        # Continuación de Disilicato (centro)
-        c.drawString(220, y_pos, "")
-        c.rect(220, y_pos - 20, 150, 60)
-        
-        checkbox_y = y_pos - 35
-        c.rect(230, checkbox_y, 10, 10)
-        c.drawString(245, checkbox_y + 2, "MONOLÍTICO")
-        
-        checkbox_y -= 15
-        c.rect(230, checkbox_y, 10, 10)
-        c.drawString(245, checkbox_y + 2, "ESTRATIFICADA")
-        
-        # Continuación de Disilicato (derecha)
-        c.drawString(390, y_pos, "")
-        c.rect(390, y_pos - 20, 150, 60)
-        
-        checkbox_y = y_pos - 35
-        c.rect(400, checkbox_y, 10, 10)
-        c.drawString(415, checkbox_y + 2, "MONOLÍTICO")
-        
-        checkbox_y -= 15
-        c.rect(400, checkbox_y, 10, 10)
-        c.drawString(415, checkbox_y + 2, "ESTRATIFICADA")
-        
-        # UNIDADES DE IMPLANTES y TIPO DE IMPRESIÓN
-        y_pos -= 80
-        
-        c.drawString(50, y_pos, "UNIDADES DE IMPLANTES")
-        c.rect(50, y_pos - 25, 100, 20)
-        
-        c.drawString(200, y_pos, "TIPO DE IMPRESIÓN")
-        c.rect(200, y_pos - 20, 150, 40)
-        
-        checkbox_y = y_pos - 35
-        c.rect(210, checkbox_y, 10, 10)
-        c.drawString(225, checkbox_y + 2, "ANALÓGICA")
-        
-        checkbox_y -= 15
-        c.rect(210, checkbox_y, 10, 10)
-        c.drawString(225, checkbox_y + 2, "DIGITAL")
-        
-        c.drawString(400, y_pos, "UNIDADES DE PREPARACIÓN")
-        c.rect(400, y_pos - 25, 100, 20)
-        
-        # OBSERVACIONES
-        y_pos -= 80
-        c.drawString(50, y_pos, "OBSERVACIONES")
-        c.rect(50, y_pos - 80, 490, 75)
-        if order_data.get('observaciones'):
-            # Dividir texto en líneas para que quepa en el recuadro
-            obs_text = order_data['observaciones']
-            lines = []
-            words = obs_text.split()
-            current_line = ""
-            for word in words:
-                if len(current_line + " " + word) < 70:
-                    current_line += " " + word if current_line else word
-                else:
-                    lines.append(current_line)
-                    current_line = word
-            if current_line:
-                lines.append(current_line)
+def order_pdf_data(orden):
+    """Campos que usa generate_order_pdf, a partir de una fila de órdenes con doctor_nombre y clinica"""
+    return {
+        'numero_orden': orden['numero_orden'],
+        'doctor': orden['doctor_nombre'] or 'No asignado',
+        'clinica': orden['clinica'] or 'No especificada',
+        'paciente': orden['paciente'],
+        'trabajo': orden['trabajo'],
+        'precio': orden['precio'],
+        'observaciones': orden['observaciones'],
+        'tracking_id': orden['tracking_id']
+    }
+
+def _export_executor(workers):
+    # spawn y no fork: el servidor de Streamlit tiene muchos hilos y un proceso creado con fork
+    # puede heredar tomado un lock de st.cache_* o del pool de conexiones y quedarse bloqueado.
+    # Los procesos ejecutan export_worker, que solo importa order_pdf (sin Streamlit); la caché
+    # en disco es compartida entre ellos
+    if workers > 1:
+        return (ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')),
+                export_worker.render_order_pdf)
+    return ThreadPoolExecutor(max_workers=1), get_order_pdf
+
+def render_order_pdfs(orders, workers=EXPORT_WORKERS):
+    """Renderizar PDFs en paralelo y entregarlos en orden, con pocos trabajos en curso a la vez"""
+    pendientes = deque()
+    executor, render = _export_executor(workers)
+    with executor:
+        for order_data in orders:
+            pendientes.append((order_data, executor.submit(render, order_data)))
+            if len(pendientes) >= workers * 4:
+                order_data, future = pendientes.popleft()
+                yield order_data, future.result()
+        while pendientes:
+            order_data, future = pendientes.popleft()
+            yield order_data, future.result()
+
+def iter_orders_for_export(conn, filtros, batch=500):
+    sql, params = build_orders_page_query(filtros, limit=None)
+    cursor = conn.execute(sql, params)
+    columnas = [col[0] for col in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            break
+        for row in rows:
+            yield order_pdf_data(dict(zip(columnas, row)))
+
+def count_orders(conn, filtros):
+    sql, params = build_orders_page_query(filtros, limit=None)
+    return conn.execute(f"SELECT COUNT(*) FROM ({sql})", params).fetchone()[0]
+
+def export_orders_zip(orders, destino, workers=EXPORT_WORKERS, progreso=None, max_bytes=None):
+    """Escribir cada PDF en el ZIP apenas se genera; devuelve cuántas órdenes se procesaron.
+
+    Si el ZIP pasa de max_bytes se deja de generar PDFs y se devuelven las procesadas hasta ahí.
+    """
+    procesadas = 0
+    # Los PDF ya vienen comprimidos: se guardan sin volver a comprimir
+    with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_STORED) as archivo:
+        for order_data, pdf in render_order_pdfs(orders, workers):
+            if pdf is not None:
+                archivo.writestr(f"orden_{order_data['numero_orden']}.pdf", pdf)
+            procesadas += 1
+            if progreso:
+                progreso(procesadas)
+            if max_bytes and destino.tell() > max_bytes:
+                break
+    return procesadas
+
+def show_orders_export(filtros):
+    with st.expander("📦 Exportar PDFs de las órdenes filtradas"):
+        st.caption("Genera un ZIP con un PDF por cada orden que coincide con los filtros actuales")
+        if st.button("📦 Generar ZIP", key="exportar_pdfs"):
+            with get_connection() as conn:
+                total = count_orders(conn, filtros)
+            if not total:
+                st.info("📭 No hay órdenes con estos filtros")
+                return
+            if total > EXPORT_MAX_ORDERS:
+                st.error(f"❌ Los filtros incluyen {total:,} órdenes (máximo {EXPORT_MAX_ORDERS:,}); "
+                         "acótalos para exportar menos")
+                return
             
-            text_y = y_pos - 20
-            for line in lines[:3]:  # Máximo 3 líneas
-                c.drawString(55, text_y, line)
-                text_y -= 15
-        
-        # Sección inferior con más checkboxes
-        y_pos -= 120
-        
-        # FOTOGRAFÍAS
-        c.drawString(50, y_pos, "FOTOGRAFÍAS")
-        c.rect(50, y_pos - 20, 120, 100)
-        
-        checkbox_items = ["ANTAGONISTA", "REGISTRO OCLUSAL", "MODELO DE ESTUDIO", "ENFILADO"]
-        checkbox_y = y_pos - 35
-        for item in checkbox_items:
-            c.rect(60, checkbox_y, 10, 10)
-            c.drawString(75, checkbox_y + 2, item)
-            checkbox_y -= 20
-        
-        # JIG DE VERIFICACIÓN (centro)
-        c.drawString(200, y_pos, "")
-        c.rect(200, y_pos - 20, 150, 100)
-        
-        checkbox_items = ["JIG DE VERIFICACIÓN", "ANÁLOGO", "TRANSFER DE IMPRESIÓN", "ADITAMIENTO", "TORNILLO LABORATORIO", "ENCERADO"]
-        checkbox_y = y_pos - 35
-        for item in checkbox_items:
-            c.rect(210, checkbox_y, 10, 10)
-            c.drawString(225, checkbox_y + 2, item)
-            checkbox_y -= 15
-        
-        # CARACTERÍSTICAS DEL PILAR (derecha)
-        c.drawString(380, y_pos, "CARACTERÍSTICAS DEL PILAR")
-        c.rect(380, y_pos - 20, 160, 100)
-        
-        checkbox_items = ["DIENTE NATURAL", "DIENTE PIGMENTADO", "NÚCLEO PLATEADO", "NÚCLEO DORADO"]
-        checkbox_y = y_pos - 35
-        for item in checkbox_items:
-            c.rect(390, checkbox_y, 10, 10)
-            c.drawString(405, checkbox_y + 2, item)
-            checkbox_y -= 20
-        
-        # Footer con contacto
-        c.setFont("Helvetica", 10)
-        c.drawString(50, 50, "cel.: 313-222-1878 • e-mail: mrlaboratoriodental@gmail.com")
-        
-        # QR Code en esquina inferior derecha
-        try:
-            qr_img = generate_qr_code(f"Orden: {order_data.get('numero_orden', 'N/A')} - Tracking: {order_data.get('tracking_id', 'N/A')}")
-            qr_path = f"/tmp/qr_{order_data.get('numero_orden', 'temp')}.png"
-            qr_img.save(qr_path)
-            c.drawImage(qr_path, 480, 30, 60, 60)
-        except Exception as qr_error:
-            # Si falla el QR, continuar sin él
-            c.setFont("Helvetica", 8)
-            c.drawString(480, 50, f"Tracking: {order_data.get('tracking_id', 'N/A')}")
-        
-        c.save()
-        buffer.seek(0)
-        return buffer
-        
-    except Exception as e:
-        print(f"Error generando PDF: {str(e)}")  # Para debug
-        return None
+            barra = st.progress(0.0, text=f"0/{total} PDFs")
+            paso = max(1, total // 100)
+            
+            def progreso(n):
+                if n % paso == 0 or n == total:
+                    barra.progress(min(n / total, 1.0), text=f"{n}/{total} PDFs")
+            
+            # El ZIP se arma en disco y los PDF no se acumulan en memoria mientras se generan; el
+            # ZIP terminado sí pasa completo a la memoria del servidor, porque st.download_button
+            # lo guarda entero para servir la descarga (GLAB_EXPORT_MAX_MB limita su tamaño)
+            with tempfile.NamedTemporaryFile(suffix='.zip') as destino:
+                with get_connection() as conn:
+                    procesadas = export_orders_zip(iter_orders_for_export(conn, filtros), destino, progreso=progreso,
+                                                   max_bytes=EXPORT_MAX_MB * 1024 * 1024)
+                destino.flush()
+                
+                if procesadas < total:
+                    st.error(f"❌ El ZIP pasó de {EXPORT_MAX_MB} MB tras {procesadas:,} de {total:,} órdenes; "
+                             "acota los filtros para exportar menos")
+                    return
+                
+                with open(destino.name, 'rb') as archivo:
+                    st.download_button(
+                        label="⬇️ Descargar ZIP",
+                        data=archivo,
+                        file_name=f"ordenes_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+                        mime="application/zip",
+                        key="descargar_zip_ordenes"
+                    )
 
 # Función principal de login
 def login_page():
@@ -720,35 +1078,37 @@ def login_page():
                 st.error("❌ Usuario o contraseña incorrectos")
 
 def authenticate_user(username, password):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    
     hashed_password = hashlib.md5(password.encode()).hexdigest()
-    cursor.execute('SELECT * FROM usuarios WHERE username = ? AND password = ? AND activo = 1', (username, hashed_password))
-    user = cursor.fetchone()
+    with get_connection() as conn:
+        user = conn.execute('SELECT * FROM usuarios WHERE username = ? AND password = ? AND activo = 1',
+                            (username, hashed_password)).fetchone()
     
-    conn.close()
     return user is not None
 
 def get_user_data(username):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM usuarios WHERE username = ?', (username,))
-    user = cursor.fetchone()
+    with get_connection() as conn:
+        user = conn.execute(
+            'SELECT id, username, nombre, email, telefono, rol, doctor_id FROM usuarios WHERE username = ?',
+            (username,)).fetchone()
     
-    conn.close()
     if user:
         return {
             'id': user[0],
             'username': user[1],
-            'nombre': user[3],
-            'email': user[4],
-            'telefono': user[5],
-            'rol': user[6]
+            'nombre': user[2],
+            'email': user[3],
+            'telefono': user[4],
+            'rol': user[5],
+            'doctor_id': user[6]
         }
     return None
 
+def get_linked_doctor_id(user_id):
+    """doctor_id actual del usuario: el de la sesión se leyó al iniciar sesión y el vínculo puede cambiar después"""
+    with get_connection() as conn:
+        row = conn.execute('SELECT doctor_id FROM usuarios WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
 
 # Función principal de la aplicación
 def main_app():
@@ -943,33 +1303,186 @@ def logout():
         del st.session_state[key]
     st.rerun()
 
+# Rangos de fechas [inicio, fin) como texto ISO, comparables con fecha_ingreso y con el resumen diario
+def period_bounds(periodo='Mes', fecha=None):
+    fecha = fecha or datetime.now().date()
+    if periodo == 'Año':
+        inicio = fecha.replace(month=1, day=1)
+        fin = inicio.replace(year=inicio.year + 1)
+    else:
+        meses = 3 if periodo == 'Trimestre' else 1
+        mes_inicio = fecha.month if meses == 1 else 3 * ((fecha.month - 1) // 3) + 1
+        inicio = fecha.replace(month=mes_inicio, day=1)
+        mes_fin = mes_inicio + meses
+        fin = inicio.replace(year=inicio.year + (mes_fin - 1) // 12, month=(mes_fin - 1) % 12 + 1)
+    return inicio.isoformat(), fin.isoformat()
+
+def get_period_summary(conn, inicio, fin):
+    """Órdenes e ingresos entre dos fechas, leídos del resumen diario"""
+    ordenes, ingresos = conn.execute(
+        "SELECT SUM(ordenes), SUM(ingresos) FROM ordenes_daily_rollup WHERE dia >= ? AND dia < ?",
+        (inicio, fin)).fetchone()
+    return ordenes or 0, ingresos or 0
+
+# Métricas del dashboard: una sola consulta sobre el resumen diario con agregación condicional
+DASHBOARD_METRICS_SQL = """
+    WITH grupos AS (
+        SELECT estado, tecnico,
+               SUM(ordenes) AS total,
+               SUM(CASE WHEN dia >= :inicio AND dia < :fin THEN ordenes ELSE 0 END) AS total_mes,
+               SUM(CASE WHEN dia >= :inicio AND dia < :fin THEN ingresos ELSE 0 END) AS ingresos_mes
+        FROM ordenes_daily_rollup
+        GROUP BY estado, tecnico
+    )
+    SELECT g.estado, g.tecnico, g.total, g.total_mes, g.ingresos_mes,
+           (SELECT COUNT(*) FROM inventario WHERE cantidad - stock_minimo <= 0) AS stock_critico
+    FROM (SELECT 1) LEFT JOIN grupos g
+"""
+
+# Lotes con saldo que vencen hasta :hasta (y cuántos ya vencieron), solo desde idx_lotes_vencimiento
+EXPIRY_SUMMARY_SQL = """
+    SELECT COUNT(*), COUNT(DISTINCT CASE WHEN fecha_vencimiento >= :hoy THEN item_id END),
+           COALESCE(SUM(fecha_vencimiento < :hoy), 0)
+    FROM inventario_lotes
+    WHERE cantidad > 0 AND fecha_vencimiento <= :hasta
+"""
+HOT_QUERIES['resumen_vencimientos'] = (EXPIRY_SUMMARY_SQL, {'hoy': '2025-01-01', 'hasta': '2025-01-31'})
+EXPIRY_ALERT_DAYS = int(os.environ.get('GLAB_EXPIRY_ALERT_DAYS', '30'))
+
+def compute_dashboard_metrics(conn, inicio, fin, hoy=None):
+    hoy = hoy or datetime.now().date()
+    rows = conn.execute(DASHBOARD_METRICS_SQL, {'inicio': inicio, 'fin': fin}).fetchall()
+    lotes, items, vencidos = conn.execute(EXPIRY_SUMMARY_SQL, {
+        'hoy': hoy.isoformat(), 'hasta': (hoy + timedelta(days=EXPIRY_ALERT_DAYS)).isoformat()
+    }).fetchone()
+    metrics = {
+        'total_ordenes': 0,
+        'ordenes_mes': 0,
+        'ingresos_mes': 0,
+        'stock_critico': rows[0][5],
+        'lotes_por_vencer': lotes,
+        'items_por_vencer': items,
+        'lotes_vencidos': vencidos,
+        'por_estado': {},
+        'por_tecnico': {}
+    }
+    
+    for estado, tecnico, total, total_mes, ingresos_mes, _ in rows:
+        if total is None:
+            continue
+        metrics['total_ordenes'] += total
+        metrics['ordenes_mes'] += total_mes
+        metrics['ingresos_mes'] += ingresos_mes
+        metrics['por_estado'][estado] = metrics['por_estado'].get(estado, 0) + total
+        if tecnico:
+            metrics['por_tecnico'][tecnico] = metrics['por_tecnico'].get(tecnico, 0) + total
+    
+    return metrics
+
+class DashboardMetrics:
+    """Métricas en caché; se recalculan solo cuando cambia PRAGMA data_version o el día"""
+    
+    def __init__(self, path):
+        # Conexión propia de solo lectura: data_version solo cambia con commits de otras conexiones
+        self._conn = open_connection(path)
+        self._lock = threading.Lock()
+        self._key = None
+        self._metrics = None
+    
+    def get(self):
+        hoy = datetime.now().date()
+        inicio, fin = period_bounds('Mes', hoy)
+        with self._lock:
+            data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            # El día es parte de la llave: la ventana de vencimientos avanza aunque nada cambie
+            key = (data_version, hoy)
+            if self._metrics is None or key != self._key:
+                self._metrics = compute_dashboard_metrics(self._conn, inicio, fin, hoy)
+                self._key = key
+            return self._metrics
+
+@st.cache_resource
+def get_dashboard_metrics_service(path):
+    return DashboardMetrics(path)
+
+def get_dashboard_metrics():
+    return get_dashboard_metrics_service(DB_PATH).get()
+
+# Módulo de datos de referencia: técnicos, mensajeros, doctores y servicios se cargan una
+# vez y se invalidan desde las funciones create_*/update_* que escriben esas tablas. Esa
+# invalidación solo alcanza a este proceso: el TTL acota cuánto tardan en verse los cambios
+# hechos desde otro proceso (otra instancia de la app o --bootstrap)
+USER_ROLES = ['Administrador', 'Secretaria', 'Técnico', 'Doctor', 'Mensajero']
+REFERENCE_DATA_TTL = 60  # segundos
+
+@st.cache_data(show_spinner=False, ttl=REFERENCE_DATA_TTL)
+def get_reference_data():
+    with get_connection() as conn:
+        usuarios = conn.execute(
+            "SELECT id, rol, nombre FROM usuarios WHERE rol IN ('Técnico', 'Mensajero') AND activo = 1 ORDER BY nombre"
+        ).fetchall()
+        doctores = conn.execute("SELECT id, nombre FROM doctores WHERE activo = 1 ORDER BY nombre").fetchall()
+        servicios = conn.execute(
+            "SELECT nombre, precio FROM servicios WHERE activo = 1 ORDER BY categoria, nombre"
+        ).fetchall()
+    # Por id y no por nombre: dos técnicos o doctores pueden llamarse igual
+    return {
+        'tecnicos': reference_labels((user_id, nombre) for user_id, rol, nombre in usuarios if rol == 'Técnico'),
+        'mensajeros': reference_labels((user_id, nombre) for user_id, rol, nombre in usuarios if rol == 'Mensajero'),
+        'doctores': reference_labels(doctores),
+        'servicios': {nombre: precio for nombre, precio in servicios},
+        'roles': USER_ROLES
+    }
+
+def reference_labels(filas):
+    """{id: etiqueta} en el orden recibido; los nombres repetidos llevan el id para distinguirlos"""
+    filas = list(filas)
+    repetidos = {nombre for nombre, n in Counter(nombre for _, nombre in filas).items() if n > 1}
+    return {fila_id: f"{nombre} (#{fila_id})" if nombre in repetidos else nombre for fila_id, nombre in filas}
+
+def get_technicians():
+    return get_reference_data()['tecnicos']
+
+def get_messengers():
+    return get_reference_data()['mensajeros']
+
+def get_doctor_options():
+    return get_reference_data()['doctores']
+
+def get_service_prices():
+    return get_reference_data()['servicios']
+
+def invalidate_reference_data():
+    get_reference_data.clear()
+
 # Módulo Dashboard
 def show_dashboard():
+    import plotly.express as px
+    
     st.markdown("## 📊 Dashboard Ejecutivo")
     
+    metrics = get_dashboard_metrics()
+    
+    if metrics['lotes_vencidos']:
+        st.error(f"⏰ {metrics['lotes_vencidos']} lotes de inventario ya vencieron")
+    if metrics['lotes_por_vencer'] > metrics['lotes_vencidos']:
+        st.warning(f"⏰ {metrics['lotes_por_vencer'] - metrics['lotes_vencidos']} lotes de "
+                   f"{metrics['items_por_vencer']} items vencen en los próximos {EXPIRY_ALERT_DAYS} días")
+    
     # Métricas principales
     col1, col2, col3, col4 = st.columns(4)
     
-    conn = sqlite3.connect('glab.db')
-    
-    # Total órdenes
-    total_ordenes = pd.read_sql_query("SELECT COUNT(*) as total FROM ordenes", conn).iloc[0]['total']
     with col1:
-        st.metric("📋 Órdenes Activas", total_ordenes)
+        st.metric("📋 Órdenes Activas", metrics['total_ordenes'])
     
-    # Órdenes del mes
-    ordenes_mes = pd.read_sql_query("SELECT COUNT(*) as total FROM ordenes WHERE fecha_ingreso LIKE '2025-07%'", conn).iloc[0]['total']
     with col2:
-        st.metric("📅 Órdenes del Mes", ordenes_mes)
+        st.metric("📅 Órdenes del Mes", metrics['ordenes_mes'])
     
-    # Stock crítico
-    stock_critico = pd.read_sql_query("SELECT COUNT(*) as total FROM inventario WHERE cantidad <= stock_minimo", conn).iloc[0]['total']
     with col3:
-        st.metric("⚠️ Stock Crítico", stock_critico)
+        st.metric("⚠️ Stock Crítico", metrics['stock_critico'])
     
-    # Ingresos del mes
-    ingresos = pd.read_sql_query("SELECT SUM(precio) as total FROM ordenes WHERE fecha_ingreso LIKE '2025-07%'", conn).iloc[0]['total']
     with col4:
+        ingresos = metrics['ingresos_mes']
         st.metric("💰 Ingresos del Mes", f"${ingresos:,.0f}" if ingresos else "$0")
     
     # Gráficos
@@ -977,7 +1490,7 @@ def show_dashboard():
     
     with col1:
         st.markdown("### 📊 Órdenes por Estado")
-        df_estados = pd.read_sql_query("SELECT estado, COUNT(*) as cantidad FROM ordenes GROUP BY estado", conn)
+        df_estados = pd.DataFrame(list(metrics['por_estado'].items()), columns=['estado', 'cantidad'])
         if not df_estados.empty:
             fig = px.pie(df_estados, values='cantidad', names='estado', 
                         color_discrete_sequence=['#4CAF50', '#FF9800', '#2196F3', '#F44336', '#9C27B0'])
@@ -985,13 +1498,11 @@ def show_dashboard():
     
     with col2:
         st.markdown("### 👨‍⚕️ Órdenes por Técnico")
-        df_tecnicos = pd.read_sql_query("SELECT tecnico_asignado, COUNT(*) as cantidad FROM ordenes WHERE tecnico_asignado IS NOT NULL GROUP BY tecnico_asignado", conn)
+        df_tecnicos = pd.DataFrame(list(metrics['por_tecnico'].items()), columns=['tecnico_asignado', 'cantidad'])
         if not df_tecnicos.empty:
             fig = px.bar(df_tecnicos, x='tecnico_asignado', y='cantidad',
                         color='cantidad', color_continuous_scale='Blues')
             st.plotly_chart(fig, use_container_width=True)
-    
-    conn.close()
 
 # Módulo de Órdenes
 def show_orders_module():
@@ -1007,18 +1518,32 @@ def show_orders_module():
             st.session_state.show_new_order = False
             st.rerun()
     else:
-        # Lista de órdenes existentes
-        conn = sqlite3.connect('glab.db')
-        df_ordenes = pd.read_sql_query("""
-            SELECT o.*, d.nombre as doctor_nombre 
-            FROM ordenes o 
-            LEFT JOIN doctores d ON o.doctor_id = d.id 
-            ORDER BY o.fecha_ingreso DESC
-        """, conn)
-        conn.close()
+        # Búsqueda de texto completo
+        busqueda = st.text_input("🔎 Buscar por paciente, trabajo, observaciones, orden o doctor",
+                                 key="busqueda_ordenes")
+        if busqueda.strip():
+            show_order_search_results(busqueda)
+            return
+        
+        # Lista de órdenes paginada: solo se consulta y dibuja la página visible
+        filtros, page_size = show_orders_filters()
+        cursores = get_orders_page_cursors(filtros, page_size)
+        show_orders_export(filtros)
+        
+        with get_connection() as conn:
+            df_ordenes = fetch_orders_page(conn, filtros, cursores[-1], page_size + 1)
+        
+        hay_siguiente = len(df_ordenes) > page_size
+        df_ordenes = df_ordenes.head(page_size)
         
+        if df_ordenes.empty:
+            st.info("📭 No hay órdenes con estos filtros")
+        
+        versiones = {}
         if not df_ordenes.empty:
             for _, orden in df_ordenes.iterrows():
+                version = seen_order_version(orden)
+                versiones[orden['id']] = version
                 with st.expander(f"📋 {orden['numero_orden']} - {orden['paciente']} ({orden['estado']})"):
                     col1, col2, col3 = st.columns(3)
                     
@@ -1045,38 +1570,32 @@ def show_orders_module():
                     
                     with col1:
                         # Cambiar estado
+                        # Sin mensajero asignado la orden no puede salir a transporte
+                        destinos = [destino for destino in ORDER_TRANSITIONS[orden['estado']]
+                                    if destino != 'En Transporte' or not pd.isna(orden['mensajero_id'])]
                         nuevo_estado = st.selectbox(
                             f"Estado {orden['numero_orden']}", 
-                            ['Creada', 'En Proceso', 'Empacada', 'En Transporte', 'Entregada'],
-                            index=['Creada', 'En Proceso', 'Empacada', 'En Transporte', 'Entregada'].index(orden['estado']),
+                            [orden['estado']] + destinos,
                             key=f"estado_{orden['id']}"
                         )
                         
                         if nuevo_estado != orden['estado']:
                             if st.button(f"💾 Actualizar Estado", key=f"update_{orden['id']}"):
-                                update_order_status(orden['id'], nuevo_estado)
-                                st.success("Estado actualizado")
-                                st.rerun()
+                                if update_order_status(orden['id'], nuevo_estado, version,
+                                                       st.session_state.user_data['id']):
+                                    st.success("Estado actualizado")
+                                    st.rerun()
+                                else:
+                                    show_order_conflict(orden['id'], version)
                     
                     with col2:
                         # Generar PDF
                         if st.button(f"📄 PDF", key=f"pdf_{orden['id']}"):
-                            order_data = {
-                                'numero_orden': orden['numero_orden'],
-                                'doctor': orden['doctor_nombre'] or 'No asignado',
-                                'clinica': orden.get('clinica', 'No especificada'),
-                                'paciente': orden['paciente'],
-                                'trabajo': orden['trabajo'],
-                                'precio': orden['precio'],
-                                'observaciones': orden['observaciones'],
-                                'tracking_id': orden['tracking_id']
-                            }
-                            
-                            pdf_buffer = generate_order_pdf(order_data)
-                            if pdf_buffer:
+                            pdf_bytes = get_order_pdf(order_pdf_data(orden))
+                            if pdf_bytes:
                                 st.download_button(
                                     label="⬇️ Descargar PDF",
-                                    data=pdf_buffer,
+                                    data=pdf_bytes,
                                     file_name=f"orden_{orden['numero_orden']}.pdf",
                                     mime="application/pdf",
                                     key=f"download_{orden['id']}"
@@ -1084,20 +1603,188 @@ def show_orders_module():
                     
                     with col3:
                         # Asignar técnico
-                        tecnicos = ['Carlos López', 'María García', 'Pedro Martínez']
-                        tecnico_actual = orden['tecnico_asignado'] or tecnicos[0]
+                        tecnicos = get_technicians()
+                        ids_tecnicos = list(tecnicos.keys())
+                        tecnico_actual = None if pd.isna(orden['tecnico_id']) else int(orden['tecnico_id'])
                         nuevo_tecnico = st.selectbox(
                             f"Técnico {orden['numero_orden']}", 
-                            tecnicos,
-                            index=tecnicos.index(tecnico_actual) if tecnico_actual in tecnicos else 0,
+                            ids_tecnicos,
+                            index=ids_tecnicos.index(tecnico_actual) if tecnico_actual in tecnicos else 0,
+                            format_func=tecnicos.get,
                             key=f"tecnico_{orden['id']}"
                         )
                         
-                        if nuevo_tecnico != orden['tecnico_asignado']:
+                        if nuevo_tecnico and nuevo_tecnico != tecnico_actual:
                             if st.button(f"👨‍🔧 Asignar", key=f"assign_{orden['id']}"):
-                                assign_technician(orden['id'], nuevo_tecnico)
-                                st.success("Técnico asignado")
-                                st.rerun()
+                                if assign_technician(orden['id'], nuevo_tecnico, version):
+                                    st.success("Técnico asignado")
+                                    st.rerun()
+                                else:
+                                    show_order_conflict(orden['id'], version)
+            
+            show_bulk_status_change(df_ordenes, versiones)
+        
+        # Navegación entre páginas
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            if len(cursores) > 1 and st.button("⬅️ Anterior"):
+                cursores.pop()
+                st.rerun()
+        with col2:
+            st.write(f"📄 Página {len(cursores)}")
+        with col3:
+            if hay_siguiente and st.button("Siguiente ➡️"):
+                ultima = df_ordenes.iloc[-1]
+                cursores.append((ultima['fecha_ingreso'], int(ultima['id'])))
+                st.rerun()
+
+def show_bulk_status_change(df_ordenes, versiones):
+    with st.expander("🔁 Cambio de estado en lote"):
+        opciones = dict(zip(df_ordenes['numero_orden'], df_ordenes['id']))
+        seleccion = st.multiselect("Órdenes de esta página", list(opciones), key="lote_ordenes")
+        # En Transporte no: la orden pasa a ese estado cuando un mensajero la toma
+        nuevo_estado = st.selectbox("Nuevo estado", [estado for estado in ORDER_STATES if estado != 'En Transporte'],
+                                    key="lote_estado")
+        
+        if seleccion and st.button("💾 Aplicar a las seleccionadas", key="lote_aplicar"):
+            cambios = [(opciones[numero], versiones[opciones[numero]]) for numero in seleccion]
+            cambiadas = update_orders_status(cambios, nuevo_estado, st.session_state.user_data['id'])
+            if len(cambiadas) == len(cambios):
+                st.success(f"✅ {len(cambiadas)} órdenes pasaron a {nuevo_estado}")
+                st.rerun()
+            st.warning(f"⚠️ {len(cambiadas)} de {len(cambios)} órdenes pasaron a {nuevo_estado}; las demás "
+                       "cambiaron mientras las veías o no pueden pasar a ese estado.")
+
+ORDER_STATES = ['Creada', 'En Proceso', 'Empacada', 'En Transporte', 'Entregada']
+ORDERS_PAGE_SIZES = [10, 20, 50, 100]
+ORDERS_PAGE_SIZE = int(os.environ.get('GLAB_ORDERS_PAGE_SIZE', '20'))
+
+def build_orders_page_query(filtros, cursor=None, limit=ORDERS_PAGE_SIZE):
+    """Consulta paginada por llave (fecha_ingreso, id) descendente.
+    
+    cursor es el (fecha_ingreso, id) de la última orden de la página anterior.
+    """
+    condiciones = []
+    params = []
+    
+    if filtros.get('estado'):
+        condiciones.append("o.estado = ?")
+        params.append(filtros['estado'])
+    if filtros.get('tecnico_id'):
+        condiciones.append("o.tecnico_id = ?")
+        params.append(filtros['tecnico_id'])
+    if filtros.get('doctor_id'):
+        condiciones.append("o.doctor_id = ?")
+        params.append(filtros['doctor_id'])
+    if filtros.get('desde'):
+        condiciones.append("o.fecha_ingreso >= ?")
+        params.append(str(filtros['desde']))
+    if filtros.get('hasta'):
+        condiciones.append("o.fecha_ingreso < ?")
+        params.append(str(filtros['hasta'] + timedelta(days=1)))
+    if cursor:
+        condiciones.append("(o.fecha_ingreso, o.id) < (?, ?)")
+        params.extend(cursor)
+    
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    sql = f"""
+        SELECT o.*, d.nombre as doctor_nombre, d.clinica
+        FROM ordenes o
+        LEFT JOIN doctores d ON o.doctor_id = d.id
+        {where}
+        ORDER BY o.fecha_ingreso DESC, o.id DESC
+    """
+    # limit=None: todas las órdenes que cumplen los filtros (exportación)
+    if limit is not None:
+        sql += "LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+HOT_QUERIES['pagina_ordenes'] = build_orders_page_query(
+    {'estado': 'En Proceso', 'tecnico_id': 3}, ('2025-07-20 20:37:58', 100))
+
+def fetch_orders_page(conn, filtros, cursor=None, limit=ORDERS_PAGE_SIZE):
+    sql, params = build_orders_page_query(filtros, cursor, limit)
+    return pd.read_sql_query(sql, conn, params=params)
+
+def show_orders_filters():
+    doctor_options = get_doctor_options()
+    tecnicos = get_technicians()
+    
+    col1, col2, col3, col4, col5, col6 = st.columns(6)
+    with col1:
+        estado = st.selectbox("📊 Estado", ['Todos'] + ORDER_STATES, key="filtro_estado")
+    with col2:
+        tecnico = st.selectbox("🔧 Técnico", [None] + list(tecnicos.keys()),
+                               format_func=lambda i: 'Todos' if i is None else tecnicos[i], key="filtro_tecnico")
+    with col3:
+        doctor = st.selectbox("👨‍⚕️ Doctor", [None] + list(doctor_options.keys()),
+                              format_func=lambda i: 'Todos' if i is None else doctor_options[i], key="filtro_doctor")
+    with col4:
+        desde = st.date_input("📅 Desde", value=None, key="filtro_desde")
+    with col5:
+        hasta = st.date_input("📅 Hasta", value=None, key="filtro_hasta")
+    with col6:
+        page_size = st.selectbox("📄 Por página", ORDERS_PAGE_SIZES,
+                                 index=ORDERS_PAGE_SIZES.index(ORDERS_PAGE_SIZE) if ORDERS_PAGE_SIZE in ORDERS_PAGE_SIZES else 1,
+                                 key="filtro_page_size")
+    
+    filtros = {
+        'estado': estado if estado != 'Todos' else None,
+        'tecnico_id': tecnico,
+        'doctor_id': doctor,
+        'desde': desde,
+        'hasta': hasta
+    }
+    return filtros, page_size
+
+def get_orders_page_cursors(filtros, page_size):
+    """Pila de cursores de página en la sesión; se reinicia cuando cambian los filtros"""
+    firma = (tuple(sorted(filtros.items())), page_size)
+    if st.session_state.get('ordenes_filtros') != firma:
+        st.session_state.ordenes_filtros = firma
+        st.session_state.ordenes_cursores = [None]
+    return st.session_state.ordenes_cursores
+
+# Pesos bm25 por columna: numero_orden, paciente, trabajo, observaciones, doctor
+SEARCH_WEIGHTS = (10.0, 5.0, 2.0, 1.0, 3.0)
+
+def build_search_query(texto):
+    """Convertir el texto del usuario en una consulta FTS5 con prefijos: 'mar gon' -> "mar"* "gon"*"""
+    palabras = re.findall(r'\w+', texto)
+    return ' '.join(f'"{palabra}"*' for palabra in palabras)
+
+def search_orders(conn, texto, limit=50):
+    consulta = build_search_query(texto)
+    if not consulta:
+        return pd.DataFrame()
+    
+    # Se ordena y limita dentro del índice antes de unir con ordenes
+    return pd.read_sql_query(f"""
+        WITH coincidencias AS (
+            SELECT rowid, bm25(ordenes_fts, {', '.join(str(w) for w in SEARCH_WEIGHTS)}) as puntaje
+            FROM ordenes_fts
+            WHERE ordenes_fts MATCH ?
+            ORDER BY puntaje
+            LIMIT ?
+        )
+        SELECT o.id, o.numero_orden, o.paciente, o.trabajo, d.nombre as doctor_nombre, o.estado, o.fecha_ingreso,
+               o.observaciones
+        FROM coincidencias c
+        JOIN ordenes o ON o.id = c.rowid
+        LEFT JOIN doctores d ON o.doctor_id = d.id
+        ORDER BY c.puntaje
+    """, conn, params=(consulta, limit))
+
+def show_order_search_results(texto):
+    with get_connection() as conn:
+        df_resultados = search_orders(conn, texto)
+    
+    if df_resultados.empty:
+        st.info("🔎 Sin resultados")
+    else:
+        st.write(f"🔎 {len(df_resultados)} resultados")
+        st.dataframe(df_resultados.drop(columns=['id']), use_container_width=True, hide_index=True)
 
 def show_new_order_form():
     st.markdown("### ➕ Nueva Orden")
@@ -1111,38 +1798,22 @@ def show_new_order_form():
         
         with col1:
             if is_doctor:
-                # Si es doctor, usar su ID automáticamente
-                doctor_id = user_data.get('id')
+                # Si es doctor, usar el doctor vinculado a su usuario
+                doctor_id = get_linked_doctor_id(user_data['id'])
                 st.info(f"👨‍⚕️ Doctor: {user_data.get('nombre')}")
             else:
                 # Si no es doctor, permitir seleccionar
-                conn = sqlite3.connect('glab.db')
-                df_doctores = pd.read_sql_query("SELECT id, nombre FROM doctores WHERE activo = 1", conn)
-                conn.close()
-                
-                doctor_options = {f"{row['nombre']}": row['id'] for _, row in df_doctores.iterrows()}
-                doctor_selected = st.selectbox("👨‍⚕️ Doctor", list(doctor_options.keys()))
-                doctor_id = doctor_options[doctor_selected]
+                doctor_options = get_doctor_options()
+                doctor_id = st.selectbox("👨‍⚕️ Doctor", list(doctor_options.keys()), format_func=doctor_options.get)
             
             paciente = st.text_input("👤 Paciente")
             
-            # Lista de servicios para autocompletado
-            servicios_disponibles = [
-                {"nombre": "Corona Metal-Cerámica", "precio": 180000},
-                {"nombre": "Corona Disilicato de Litio", "precio": 220000},
-                {"nombre": "Puente 3 Unidades", "precio": 480000},
-                {"nombre": "Prótesis Parcial Removible", "precio": 350000},
-                {"nombre": "Prótesis Total", "precio": 450000},
-                {"nombre": "Carillas de Porcelana", "precio": 280000},
-                {"nombre": "Blanqueamiento", "precio": 120000},
-                {"nombre": "Implante Dental", "precio": 800000},
-                {"nombre": "Sobredentadura", "precio": 650000},
-                {"nombre": "Barra Híbrida", "precio": 1200000}
-            ]
+            # Servicios y precios del catálogo
+            servicios_disponibles = get_service_prices()
             
             trabajo_selected = st.selectbox(
                 "🦷 Tipo de Trabajo", 
-                [servicio["nombre"] for servicio in servicios_disponibles],
+                list(servicios_disponibles.keys()),
                 help="Seleccione el tipo de trabajo dental"
             )
             
@@ -1150,8 +1821,8 @@ def show_new_order_form():
             cantidad = st.number_input("🔢 Cantidad", min_value=1, value=1, help="Número de unidades a realizar")
             
             # Precio automático basado en la selección y cantidad
-            precio_unitario = next(s["precio"] for s in servicios_disponibles if s["nombre"] == trabajo_selected)
-            precio_total = precio_unitario * cantidad
+            precio_unitario = servicios_disponibles.get(trabajo_selected, 0)
+            precio_total = int(precio_unitario * cantidad)
             
             col_precio1, col_precio2 = st.columns(2)
             with col_precio1:
@@ -1167,14 +1838,17 @@ def show_new_order_form():
             
             if not is_doctor:
                 # Solo admin/secretaria pueden asignar técnico
-                tecnico = st.selectbox("👨‍🔧 Técnico Asignado", ['Carlos López', 'María García', 'Pedro Martínez'])
+                tecnicos = get_technicians()
+                tecnico = st.selectbox("👨‍🔧 Técnico Asignado", list(tecnicos.keys()), format_func=tecnicos.get)
             else:
                 # Los doctores no pueden elegir técnico
                 st.info("👨‍🔧 Técnico: Se asignará automáticamente cuando la orden esté en proceso")
                 tecnico = None
         
         if st.form_submit_button("💾 Crear Orden"):
-            if paciente and trabajo_selected and cantidad > 0:
+            if not doctor_id:
+                st.error("❌ Tu usuario no está vinculado a ningún doctor; pide al administrador que lo revise")
+            elif paciente and trabajo_selected and cantidad > 0:
                 order_id = create_new_order(
                     doctor_id,
                     paciente,
@@ -1196,29 +1870,66 @@ def show_new_order_form():
             else:
                 st.error("❌ Por favor complete todos los campos obligatorios y asegúrese de que la cantidad sea mayor a 0")
 
-def create_new_order(doctor_id, paciente, trabajo, cantidad, precio, fecha_entrega, observaciones, tecnico):
+# Módulo de numeración de órdenes y tracking IDs
+# Crockford Base32: sin I, L, O ni U para que no se confundan al dictarlos; en mayúsculas
+# cabe en el modo alfanumérico del QR y no necesita escaparse en una URL
+TRACKING_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+TRACKING_LENGTH = 10
+ORDER_INSERT_ATTEMPTS = 5
+
+def generate_tracking_id(length=None):
+    return ''.join(secrets.choice(TRACKING_ALPHABET) for _ in range(length or TRACKING_LENGTH))
+
+def sync_order_sequence(cursor):
+    # Adelantar la secuencia si hay números ORD-n mayores (datos de ejemplo o importados)
+    cursor.execute("""
+        UPDATE secuencias SET valor = MAX(valor, COALESCE((
+            SELECT MAX(CAST(substr(numero_orden, 5) AS INTEGER)) FROM ordenes
+            WHERE numero_orden GLOB 'ORD-[0-9]*'
+        ), 0))
+        WHERE nombre = 'orden'
+    """)
+
+def next_sequence_value(cursor, nombre):
+    # Debe llamarse dentro de una transacción de escritura: el UPDATE toma el bloqueo
+    cursor.execute('UPDATE secuencias SET valor = valor + 1 WHERE nombre = ?', (nombre,))
+    cursor.execute('SELECT valor FROM secuencias WHERE nombre = ?', (nombre,))
+    return cursor.fetchone()[0]
+
+def insert_order(conn, doctor_id, paciente, trabajo, cantidad, precio, fecha_entrega, observaciones, tecnico_id):
+    """Insertar una orden asignando número y tracking ID en la misma transacción"""
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    numero_orden = f"ORD-{next_sequence_value(cursor, 'orden'):03d}"
+    tracking_id = generate_tracking_id()
+    fecha_ingreso = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    for intento in range(ORDER_INSERT_ATTEMPTS):
+        try:
+            cursor.execute('''
+                INSERT INTO ordenes (numero_orden, doctor_id, paciente, trabajo, cantidad, precio, fecha_ingreso,
+                                   fecha_entrega, observaciones, tecnico_id, tecnico_asignado, tracking_id, estado)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT nombre FROM usuarios WHERE id = ?), ?, 'Creada')
+            ''', (numero_orden, doctor_id, paciente, trabajo, cantidad, precio, fecha_ingreso,
+                  fecha_entrega, observaciones, tecnico_id, tecnico_id, tracking_id))
+            return cursor.lastrowid
+        except sqlite3.IntegrityError as e:
+            # Solo se deshace la sentencia; la transacción y el bloqueo siguen activos
+            if intento == ORDER_INSERT_ATTEMPTS - 1:
+                raise
+            if 'numero_orden' in str(e):
+                sync_order_sequence(cursor)
+                numero_orden = f"ORD-{next_sequence_value(cursor, 'orden'):03d}"
+            elif 'tracking_id' in str(e):
+                tracking_id = generate_tracking_id()
+            else:
+                raise
+
+def create_new_order(doctor_id, paciente, trabajo, cantidad, precio, fecha_entrega, observaciones, tecnico_id):
     try:
-        conn = sqlite3.connect('glab.db')
-        cursor = conn.cursor()
-        
-        # Generar número de orden único
-        cursor.execute("SELECT COUNT(*) FROM ordenes")
-        count = cursor.fetchone()[0]
-        numero_orden = f"ORD-{count + 1:03d}"
-        
-        # Generar tracking ID
-        tracking_id = str(uuid.uuid4())[:8]
-        
-        cursor.execute('''
-            INSERT INTO ordenes (numero_orden, doctor_id, paciente, trabajo, cantidad, precio, 
-                               fecha_entrega, observaciones, tecnico_asignado, tracking_id, estado)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'Creada')
-        ''', (numero_orden, doctor_id, paciente, trabajo, cantidad, precio, 
-              fecha_entrega, observaciones, tecnico, tracking_id))
-        
-        order_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            order_id = insert_order(conn, doctor_id, paciente, trabajo, cantidad, precio,
+                                    fecha_entrega, observaciones, tecnico_id)
         
         return order_id
     except Exception as e:
@@ -1229,19 +1940,18 @@ def show_order_details(order_id):
     """Mostrar detalles completos de una orden con opción de descarga PDF"""
     st.markdown("## 📋 Detalles de la Orden")
     
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    
-    # Obtener datos de la orden
-    cursor.execute('''
-        SELECT o.*, d.nombre as doctor_nombre 
-        FROM ordenes o 
-        LEFT JOIN doctores d ON o.doctor_id = d.id 
-        WHERE o.id = ?
-    ''', (order_id,))
-    
-    orden = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Obtener datos de la orden
+        cursor.execute('''
+            SELECT o.*, d.nombre as doctor_nombre, d.clinica
+            FROM ordenes o 
+            LEFT JOIN doctores d ON o.doctor_id = d.id 
+            WHERE o.id = ?
+        ''', (order_id,))
+        
+        orden = cursor.fetchone()
     
     if orden:
         # Convertir a diccionario para fácil acceso
@@ -1278,11 +1988,11 @@ def show_order_details(order_id):
         col1, col2, col3 = st.columns(3)
         with col2:
             if st.button("📄 Descargar PDF", use_container_width=True):
-                pdf_buffer = generate_order_pdf(orden_dict)
-                if pdf_buffer:
+                pdf_bytes = get_order_pdf(order_pdf_data(orden_dict))
+                if pdf_bytes:
                     st.download_button(
                         label="⬇️ Descargar Orden PDF",
-                        data=pdf_buffer,
+                        data=pdf_bytes,
                         file_name=f"orden_{orden_dict['numero_orden']}.pdf",
                         mime="application/pdf",
                         use_container_width=True
@@ -1292,19 +2002,167 @@ def show_order_details(order_id):
     else:
         st.error("❌ Orden no encontrada")
 
-def update_order_status(order_id, new_status):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE ordenes SET estado = ? WHERE id = ?', (new_status, order_id))
-    conn.commit()
-    conn.close()
+# Módulo de concurrencia optimista: cada cambio de una orden es un solo UPDATE que compara la
+# versión que leyó la sesión y el estado de origen permitido; si otra sesión escribió antes, no
+# afecta filas y la interfaz lo informa. No hay bloqueos más allá del de escritura de SQLite.
+ORDER_TRANSITIONS = {
+    'Creada': ('En Proceso', 'Empacada'),
+    'En Proceso': ('Creada', 'Empacada'),
+    'Empacada': ('En Proceso', 'En Transporte'),
+    'En Transporte': ('Empacada', 'Entregada'),
+    'Entregada': (),
+}
 
-def assign_technician(order_id, technician):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE ordenes SET tecnico_asignado = ? WHERE id = ?', (technician, order_id))
-    conn.commit()
-    conn.close()
+def allowed_sources(estado):
+    return [origen for origen, destinos in ORDER_TRANSITIONS.items() if estado in destinos]
+
+def compare_and_set_order(order_id, version, asignaciones, params, estados_origen=None):
+    """Actualizar la orden solo si sigue en la versión leída; True si se aplicó el cambio"""
+    sql = f"UPDATE ordenes SET {asignaciones}, version = version + 1 WHERE id = ? AND version = ?"
+    params = list(params) + [order_id, version]
+    if estados_origen is not None:
+        sql += f" AND estado IN ({', '.join('?' * len(estados_origen))})"
+        params.extend(estados_origen)
+    with get_connection() as conn:
+        return conn.execute(sql, params).rowcount == 1
+
+def seen_order_version(orden):
+    """Versión que el usuario tenía en pantalla: la del render anterior de esta orden.
+
+    Al pulsar un botón Streamlit vuelve a leer la orden antes de atender el clic, así que
+    comparar contra la versión recién leída no detectaría cambios hechos mientras se veía.
+    """
+    clave = f"version_orden_{orden['id']}"
+    vista = st.session_state.get(clave, orden['version'])
+    st.session_state[clave] = orden['version']
+    return vista
+
+def show_order_conflict(order_id, version):
+    with get_connection() as conn:
+        orden = conn.execute('SELECT numero_orden, estado, version FROM ordenes WHERE id = ?', (order_id,)).fetchone()
+    if orden is None:
+        st.error("❌ Orden no encontrada")
+    elif orden[2] != version:
+        st.warning(f"⚠️ Otro usuario modificó la orden {orden[0]} mientras la veías (ahora está '{orden[1]}'). "
+                   "Revisa los datos actuales y vuelve a intentarlo si aún aplica.")
+    else:
+        st.warning(f"⚠️ La orden {orden[0]} está '{orden[1]}' y no puede pasar a ese estado.")
+
+def update_order_status(order_id, new_status, version, usuario_id=None):
+    return bool(update_orders_status([(order_id, version)], new_status, usuario_id))
+
+def update_orders_status(cambios, new_status, usuario_id=None):
+    """Cambiar de estado varias órdenes [(order_id, versión leída)] junto con sus materiales.
+
+    Todo ocurre en una transacción con un número fijo de sentencias, sin importar cuántas órdenes
+    cambien. Devuelve los ids que cambiaron; las demás tenían otra versión, un estado de origen
+    no permitido o, para En Transporte, ningún mensajero asignado.
+    """
+    origenes = allowed_sources(new_status)
+    with get_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        # Con el bloqueo de escritura tomado, la lectura y el UPDATE no se pueden intercalar con otra sesión.
+        # CROSS JOIN fija el orden: recorrer la lista y buscar cada orden por id, nunca al revés
+        ids = [row[0] for row in conn.execute(f'''
+            SELECT o.id FROM json_each(?) p
+            CROSS JOIN ordenes o ON o.id = json_extract(p.value, '$[0]') AND o.version = json_extract(p.value, '$[1]')
+            WHERE o.estado IN ({', '.join('?' * len(origenes))})
+              AND (? <> 'En Transporte' OR o.mensajero_id IS NOT NULL)
+        ''', [json.dumps([[int(order_id), int(version)] for order_id, version in cambios])] + origenes + [new_status])]
+        if ids:
+            ids_json = json.dumps(ids)
+            conn.execute('UPDATE ordenes SET estado = ?, version = version + 1 WHERE id IN (SELECT value FROM json_each(?))',
+                         (new_status, ids_json))
+            apply_order_materials(conn, ids_json, new_status, usuario_id)
+    return ids
+
+def assign_technician(order_id, technician_id, version):
+    return compare_and_set_order(order_id, version,
+                                 'tecnico_id = ?, tecnico_asignado = (SELECT nombre FROM usuarios WHERE id = ?)',
+                                 (technician_id, technician_id))
+
+# Módulo de materiales por orden: la lista de materiales del servicio (servicios_materiales) se
+# reserva al pasar a En Proceso y se consume al pasar a Empacada, en conjunto para todas las
+# órdenes que cambian a la vez
+RESERVE_MATERIALS_SQL = '''
+    INSERT INTO ordenes_materiales (orden_id, item_id, cantidad, estado)
+    SELECT o.id, b.item_id, SUM(b.cantidad * COALESCE(o.cantidad, 1)), 'reservado'
+    FROM ordenes o
+    JOIN servicios s ON s.nombre = o.trabajo
+    JOIN servicios_materiales b ON b.servicio_id = s.id
+    WHERE o.id IN (SELECT value FROM json_each(?))
+      AND NOT EXISTS (SELECT 1 FROM ordenes_materiales m WHERE m.orden_id = o.id)
+    GROUP BY o.id, b.item_id
+'''
+
+CONSUME_MATERIALS_SQL = '''
+    INSERT INTO inventario_movimientos (item_id, tipo, cantidad, referencia, usuario_id, fecha)
+    SELECT m.item_id, 'consumo', -m.cantidad, o.numero_orden, ?, ?
+    FROM ordenes_materiales m
+    JOIN ordenes o ON o.id = m.orden_id
+    WHERE m.orden_id IN (SELECT value FROM json_each(?)) AND m.estado = 'reservado'
+'''
+
+def apply_order_materials(conn, ids_json, new_status, usuario_id=None):
+    """Reservar, consumir o liberar los materiales de las órdenes que pasaron a new_status"""
+    if new_status == 'En Proceso':
+        # Si vuelve desde Empacada ya tiene filas consumidas y no se reserva de nuevo
+        conn.execute(RESERVE_MATERIALS_SQL, (ids_json,))
+    elif new_status == 'Empacada':
+        # Las que saltaron En Proceso reservan aquí mismo para consumir
+        conn.execute(RESERVE_MATERIALS_SQL, (ids_json,))
+        conn.execute(CONSUME_MATERIALS_SQL, (usuario_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), ids_json))
+        conn.execute('''
+            UPDATE ordenes_materiales SET estado = 'consumido'
+            WHERE orden_id IN (SELECT value FROM json_each(?)) AND estado = 'reservado'
+        ''', (ids_json,))
+    elif new_status == 'Creada':
+        conn.execute('''
+            DELETE FROM ordenes_materiales
+            WHERE orden_id IN (SELECT value FROM json_each(?)) AND estado = 'reservado'
+        ''', (ids_json,))
+
+def set_service_material(servicio_id, item_id, cantidad):
+    """Definir la cantidad por unidad de un material en el servicio; 0 lo quita"""
+    with get_connection() as conn:
+        if cantidad > 0:
+            conn.execute('''
+                INSERT INTO servicios_materiales (servicio_id, item_id, cantidad) VALUES (?, ?, ?)
+                ON CONFLICT (servicio_id, item_id) DO UPDATE SET cantidad = excluded.cantidad
+            ''', (servicio_id, item_id, cantidad))
+        else:
+            conn.execute('DELETE FROM servicios_materiales WHERE servicio_id = ? AND item_id = ?', (servicio_id, item_id))
+
+def show_service_materials_editor():
+    with st.expander("🧾 Materiales por servicio"):
+        with get_connection() as conn:
+            servicios = dict(conn.execute("SELECT nombre, id FROM servicios WHERE activo = 1 ORDER BY nombre").fetchall())
+            items = dict(conn.execute("SELECT nombre, id FROM inventario ORDER BY nombre").fetchall())
+            if not servicios or not items:
+                st.info("📭 Se necesitan servicios e items de inventario")
+                return
+            servicio = st.selectbox("🦷 Servicio", list(servicios), key="bom_servicio")
+            df_materiales = pd.read_sql_query('''
+                SELECT i.nombre AS material, b.cantidad AS "cantidad por unidad"
+                FROM servicios_materiales b JOIN inventario i ON i.id = b.item_id
+                WHERE b.servicio_id = ? ORDER BY i.nombre
+            ''', conn, params=(servicios[servicio],))
+        
+        if df_materiales.empty:
+            st.info("Este servicio no tiene materiales definidos")
+        else:
+            st.dataframe(df_materiales, use_container_width=True, hide_index=True)
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            material = st.selectbox("📦 Material", list(items), key="bom_material")
+        with col2:
+            cantidad = st.number_input("Cantidad por unidad (0 lo quita)", min_value=0, value=1, key="bom_cantidad")
+        with col3:
+            if st.button("💾 Guardar material", key="bom_guardar"):
+                set_service_material(servicios[servicio], items[material], cantidad)
+                st.success("Lista de materiales actualizada")
+                st.rerun()
 
 # Módulo de Doctores
 def show_doctors_module():
@@ -1321,9 +2179,8 @@ def show_doctors_module():
             st.rerun()
     else:
         # Lista de doctores (sin duplicados)
-        conn = sqlite3.connect('glab.db')
-        df_doctores = pd.read_sql_query("SELECT * FROM doctores WHERE activo = 1 ORDER BY nombre", conn)
-        conn.close()
+        with get_connection() as conn:
+            df_doctores = pd.read_sql_query("SELECT * FROM doctores WHERE activo = 1 ORDER BY nombre", conn)
         
         if not df_doctores.empty:
             # Eliminar duplicados basados en el nombre
@@ -1409,51 +2266,50 @@ def show_new_doctor_form():
                 st.error("❌ Por favor complete todos los campos obligatorios")
 
 def create_new_doctor(nombre, clinica, especialidad, telefono, email, categoria):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    
-    descuento = 15.0 if categoria == 'VIP' else 0.0
-    
-    # Insertar doctor
-    cursor.execute('''
-        INSERT INTO doctores (nombre, clinica, especialidad, telefono, email, categoria, descuento)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (nombre, clinica, especialidad, telefono, email, categoria, descuento))
-    
-    # Crear usuario para el doctor
-    username = nombre.lower().replace(' ', '.').replace('dr.', 'dr').replace('dra.', 'dra')
-    password = hashlib.md5('123456'.encode()).hexdigest()
-    
-    cursor.execute('''
-        INSERT OR IGNORE INTO usuarios (username, password, nombre, email, telefono, rol)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (username, password, nombre, email, telefono, 'Doctor'))
-    
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        descuento = 15.0 if categoria == 'VIP' else 0.0
+        
+        # Insertar doctor
+        cursor.execute('''
+            INSERT INTO doctores (nombre, clinica, especialidad, telefono, email, categoria, descuento)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (nombre, clinica, especialidad, telefono, email, categoria, descuento))
+        doctor_id = cursor.lastrowid
+        
+        # Crear usuario para el doctor
+        username = nombre.lower().replace(' ', '.').replace('dr.', 'dr').replace('dra.', 'dra')
+        password = hashlib.md5('123456'.encode()).hexdigest()
+        
+        cursor.execute('''
+            INSERT OR IGNORE INTO usuarios (username, password, nombre, email, telefono, rol, doctor_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (username, password, nombre, email, telefono, 'Doctor', doctor_id))
+        link_doctor_users(cursor)
+    invalidate_reference_data()
 
 def update_doctor(doctor_id, nombre, clinica, especialidad, telefono, email, categoria):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    
-    descuento = 15.0 if categoria == 'VIP' else 0.0
-    
-    cursor.execute('''
-        UPDATE doctores 
-        SET nombre = ?, clinica = ?, especialidad = ?, telefono = ?, email = ?, categoria = ?, descuento = ?
-        WHERE id = ?
-    ''', (nombre, clinica, especialidad, telefono, email, categoria, descuento, doctor_id))
-    
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        descuento = 15.0 if categoria == 'VIP' else 0.0
+        
+        cursor.execute('''
+            UPDATE doctores 
+            SET nombre = ?, clinica = ?, especialidad = ?, telefono = ?, email = ?, categoria = ?, descuento = ?
+            WHERE id = ?
+        ''', (nombre, clinica, especialidad, telefono, email, categoria, descuento, doctor_id))
+        # Con el nombre nuevo puede coincidir un usuario Doctor que aún no estaba vinculado
+        link_doctor_users(cursor)
+    invalidate_reference_data()
 
 # Módulo de Servicios (para doctores)
 def show_services_catalog():
     st.markdown("## 🦷 Catálogo de Servicios")
     
-    conn = sqlite3.connect('glab.db')
-    df_servicios = pd.read_sql_query("SELECT * FROM servicios WHERE activo = 1 ORDER BY categoria, nombre", conn)
-    conn.close()
+    with get_connection() as conn:
+        df_servicios = pd.read_sql_query("SELECT * FROM servicios WHERE activo = 1 ORDER BY categoria, nombre", conn)
     
     if not df_servicios.empty:
         # Agrupar por categoría para evitar duplicados
@@ -1593,7 +2449,187 @@ def generate_ai_response(prompt):
         return "🤖 **Gracias por tu consulta.**\n\nNo tengo información específica sobre esa pregunta, pero puedes:\n\n📞 **Contacto Directo:**\n- Teléfono: 313-222-1878\n- Email: mrlaboratoriodental@gmail.com\n\n💡 **Sugerencias:**\n- Usa los botones de preguntas frecuentes\n- Sé más específico en tu consulta\n\n**¿Hay algo más en lo que pueda ayudarte?**"
 
 
+# Módulo de tablas editables: st.data_editor sobre una sola página, con paginación por llave como
+# la lista de órdenes. Los cambios se leen de edited_rows (solo las celdas editadas) y se guardan
+# juntos en una transacción.
+GRID_PAGE_SIZE = int(os.environ.get('GLAB_GRID_PAGE_SIZE', '50'))
+
+def get_grid_cursors(nombre, firma):
+    """Pila de cursores de página de una tabla; se reinicia cuando cambia la firma (filtros)"""
+    if f"{nombre}_cursores" not in st.session_state or st.session_state.get(f"{nombre}_firma") != firma:
+        st.session_state[f"{nombre}_firma"] = firma
+        st.session_state[f"{nombre}_cursores"] = [None]
+    return st.session_state[f"{nombre}_cursores"]
+
+def grid_editor_key(nombre, pagina):
+    # La revisión cambia al guardar para que el editor descarte sus ediciones y relea la página
+    return f"{nombre}_editor_{pagina}_{st.session_state.get(f'{nombre}_revision', 0)}"
+
+def grid_changes(df_pagina, key):
+    """Ediciones del data_editor como {id: {columna: valor}}, sin comparar la página completa"""
+    editadas = st.session_state.get(key, {}).get('edited_rows', {})
+    ids = df_pagina['id'].tolist()
+    return {int(ids[int(fila)]): cambios for fila, cambios in editadas.items() if cambios}
+
+def reset_grid(nombre):
+    st.session_state[f"{nombre}_revision"] = st.session_state.get(f"{nombre}_revision", 0) + 1
+
+def show_grid_pager(nombre, cursores, hay_siguiente, siguiente):
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        if len(cursores) > 1 and st.button("⬅️ Anterior", key=f"{nombre}_anterior"):
+            cursores.pop()
+            st.rerun()
+    with col2:
+        st.write(f"📄 Página {len(cursores)}")
+    with col3:
+        if hay_siguiente and st.button("Siguiente ➡️", key=f"{nombre}_siguiente"):
+            cursores.append(siguiente)
+            st.rerun()
+
+def update_columns(conn, tabla, cambios, columnas):
+    """Un executemany por columna editada: UPDATE tabla SET columna = ? WHERE id = ?"""
+    for columna in columnas:
+        filas = [(valores[columna], row_id) for row_id, valores in cambios.items() if columna in valores]
+        if filas:
+            conn.executemany(f"UPDATE {tabla} SET {columna} = ? WHERE id = ?", filas)
+
 # Módulo de Inventario
+INVENTORY_CATEGORIES = ['Materiales', 'Herramientas', 'Equipos', 'Consumibles']
+INVENTORY_ATTRIBUTES = ['categoria', 'precio_unitario', 'proveedor', 'stock_minimo']
+
+def build_inventory_page_query(prefijo='', cursor=None, limit=GRID_PAGE_SIZE):
+    """Página del inventario por llave (nombre, id); prefijo filtra por el comienzo del nombre"""
+    condiciones = []
+    params = []
+    if prefijo:
+        condiciones.append("nombre >= ? AND nombre < ?")
+        params.extend([prefijo, prefijo + '\U0010ffff'])
+    if cursor:
+        condiciones.append("(nombre, id) > (?, ?)")
+        params.extend(cursor)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    sql = f"""
+        SELECT id, nombre, categoria, cantidad, reservado, stock_minimo, precio_unitario, proveedor, fecha_vencimiento
+        FROM inventario
+        {where}
+        ORDER BY nombre, id
+        LIMIT ?
+    """
+    return sql, params + [limit]
+
+HOT_QUERIES['pagina_inventario'] = build_inventory_page_query('Resina', ('Resina Acrílica', 3))
+
+def inventory_attributes_for(rol):
+    """Cualquiera registra conteos; solo el administrador cambia los datos del item"""
+    return INVENTORY_ATTRIBUTES if rol == 'Administrador' else []
+
+def save_inventory_changes(cambios, usuario_id=None, rol=None):
+    """Guardar las ediciones {item_id: {columna: valor}} de la tabla en una sola transacción.
+
+    Los atributos se actualizan directo (solo los que el rol puede editar, aunque el estado del
+    widget traiga otros); el conteo físico entra al libro como ajuste.
+    """
+    fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with get_connection() as conn:
+        update_columns(conn, 'inventario', cambios, inventory_attributes_for(rol))
+        conn.executemany(COUNT_ADJUSTMENT_SQL, [
+            (int(valores['conteo']), 'Conteo físico', usuario_id, fecha, item_id, int(valores['conteo']))
+            for item_id, valores in cambios.items() if valores.get('conteo') is not None
+        ])
+
+def show_inventory_grid(df_pronostico, usuario):
+    import numpy as np
+    
+    prefijo = st.text_input("🔎 Buscar item (comienza por)", key="inventario_buscar").strip()
+    cursores = get_grid_cursors('inventario', prefijo)
+    with get_connection() as conn:
+        sql, params = build_inventory_page_query(prefijo, cursores[-1], GRID_PAGE_SIZE + 1)
+        df_pagina = pd.read_sql_query(sql, conn, params=params)
+    
+    hay_siguiente = len(df_pagina) > GRID_PAGE_SIZE
+    df_pagina = df_pagina.head(GRID_PAGE_SIZE)
+    if df_pagina.empty:
+        st.info("📭 No hay items con ese nombre")
+        if len(cursores) > 1:
+            show_grid_pager('inventario', cursores, False, None)
+        return df_pagina
+    
+    plan = df_pronostico.set_index('id').reindex(df_pagina['id'])
+    df_tabla = df_pagina.assign(
+        alerta=np.where(plan['pedir'].to_numpy() > 0, '🔴', '🟢'),
+        conteo=df_pagina['cantidad'],
+        disponible=df_pagina['cantidad'] - df_pagina['reservado'],
+        punto_reorden=plan['punto_reorden'].to_numpy(),
+        agotamiento=plan['agotamiento'].to_numpy(),
+    )[['id', 'alerta', 'nombre', 'categoria', 'conteo', 'reservado', 'disponible', 'punto_reorden', 'agotamiento',
+       'stock_minimo', 'precio_unitario', 'proveedor', 'fecha_vencimiento']]
+    
+    editables = ['conteo'] + inventory_attributes_for(usuario['rol'])
+    key = grid_editor_key('inventario', len(cursores))
+    st.data_editor(
+        df_tabla, key=key, hide_index=True, use_container_width=True, num_rows="fixed",
+        disabled=[columna for columna in df_tabla.columns if columna not in editables],
+        column_config={
+            'id': None,
+            'alerta': st.column_config.TextColumn("", width="small"),
+            'nombre': "Item",
+            'categoria': st.column_config.SelectboxColumn("Categoría", options=INVENTORY_CATEGORIES, required=True),
+            'conteo': st.column_config.NumberColumn("Conteo físico", min_value=0, step=1, required=True),
+            'reservado': "Reservado",
+            'disponible': "Disponible",
+            'punto_reorden': "Punto de reorden",
+            'agotamiento': st.column_config.DateColumn("Se agota"),
+            'stock_minimo': st.column_config.NumberColumn("Stock mínimo", min_value=0, step=1, required=True),
+            'precio_unitario': st.column_config.NumberColumn("Precio unitario", min_value=0, format="$%d", required=True),
+            'proveedor': "Proveedor",
+            'fecha_vencimiento': "Próximo vencimiento",
+        },
+    )
+    
+    cambios = grid_changes(df_tabla, key)
+    if st.button(f"💾 Guardar cambios ({len(cambios)})", disabled=not cambios, key="inventario_guardar"):
+        save_inventory_changes(cambios, usuario['id'], usuario['rol'])
+        reset_grid('inventario')
+        st.rerun()
+    
+    show_grid_pager('inventario', cursores, hay_siguiente,
+                    (df_pagina['nombre'].iloc[-1], int(df_pagina['id'].iloc[-1])))
+    return df_pagina
+
+def show_inventory_movement_form(df_pagina, usuario_id):
+    with st.expander("📝 Registrar movimiento"):
+        # El ajuste por conteo se hace en la columna "Conteo físico" de la tabla
+        opciones = dict(zip(df_pagina['nombre'], df_pagina['id']))
+        nombre = st.selectbox("Item (de esta página)", list(opciones), key="movimiento_item")
+        tipo = st.selectbox("Movimiento", [tipo for tipo in INVENTORY_MOVEMENTS if tipo != 'ajuste'],
+                            format_func=INVENTORY_MOVEMENTS.get, key="movimiento_tipo")
+        cantidad = st.number_input("Cantidad", min_value=1, value=1, key="movimiento_cantidad")
+        lote, vencimiento = None, None
+        if tipo == 'entrada':
+            lote = st.text_input("Lote", key="movimiento_lote") or None
+            vencimiento = st.date_input("Vencimiento del lote", value=None, key="movimiento_vence")
+        
+        usar_reservado = False
+        if tipo != 'entrada':
+            usar_reservado = st.checkbox("Tomar también el stock reservado para órdenes en proceso",
+                                         key="movimiento_reservado")
+        
+        for lote_item, vence, cantidad_lote, inicial in get_item_lots(opciones[nombre]):
+            st.caption(f"Lote {lote_item or 's/n'} · vence {vence or 'no vence'} · {cantidad_lote} de {inicial}")
+        
+        if st.button("💾 Registrar", key="movimiento_registrar"):
+            if apply_inventory_movement(opciones[nombre], tipo, cantidad, usuario_id=usuario_id, lote=lote,
+                                        vencimiento=vencimiento and vencimiento.isoformat(),
+                                        usar_reservado=usar_reservado):
+                reset_grid('inventario')
+                st.success("Movimiento registrado")
+                st.rerun()
+            elif usar_reservado:
+                st.error("❌ No hay stock suficiente para ese movimiento")
+            else:
+                st.error("❌ No hay stock disponible suficiente: el resto está reservado para órdenes en proceso")
+
 def show_inventory_module():
     st.markdown("## 📦 Gestión de Inventario")
     
@@ -1607,47 +2643,29 @@ def show_inventory_module():
             st.session_state.show_new_item = False
             st.rerun()
     else:
-        # Lista de inventario
-        conn = sqlite3.connect('glab.db')
-        df_inventario = pd.read_sql_query("SELECT * FROM inventario ORDER BY nombre", conn)
-        conn.close()
+        usuario = st.session_state.user_data
+        # El pronóstico cubre todos los items (sin widgets); la tabla solo dibuja una página
+        with get_connection() as conn:
+            df_inventario = pd.read_sql_query(
+                "SELECT id, nombre, cantidad, reservado, stock_minimo FROM inventario ORDER BY nombre", conn)
         
         if not df_inventario.empty:
-            # Alertas de stock crítico
-            stock_critico = df_inventario[df_inventario['cantidad'] <= df_inventario['stock_minimo']]
-            if not stock_critico.empty:
-                st.warning(f"⚠️ {len(stock_critico)} items con stock crítico")
+            # Alertas de reorden según el pronóstico de consumo
+            df_pronostico = get_inventory_forecast(df_inventario)
+            en_reorden = df_pronostico[df_pronostico['pedir'] > 0]
+            if not en_reorden.empty:
+                st.warning(f"⚠️ {len(en_reorden)} items en su punto de reorden")
+            show_inventory_forecast(df_pronostico)
+            show_expiring_lots()
             
-            for _, item in df_inventario.iterrows():
-                color = "🔴" if item['cantidad'] <= item['stock_minimo'] else "🟢"
-                
-                with st.expander(f"{color} {item['nombre']} - Stock: {item['cantidad']}"):
-                    col1, col2, col3 = st.columns(3)
-                    
-                    with col1:
-                        st.write(f"📦 **Categoría:** {item['categoria']}")
-                        st.write(f"📊 **Cantidad:** {item['cantidad']}")
-                        st.write(f"⚠️ **Stock Mínimo:** {item['stock_minimo']}")
-                    
-                    with col2:
-                        st.write(f"💰 **Precio Unitario:** ${item['precio_unitario']:,.0f}")
-                        st.write(f"🏭 **Proveedor:** {item['proveedor']}")
-                        st.write(f"📅 **Vencimiento:** {item['fecha_vencimiento']}")
-                    
-                    with col3:
-                        # Actualizar cantidad
-                        nueva_cantidad = st.number_input(
-                            f"Nueva cantidad {item['nombre']}", 
-                            min_value=0, 
-                            value=item['cantidad'],
-                            key=f"cantidad_{item['id']}"
-                        )
-                        
-                        if nueva_cantidad != item['cantidad']:
-                            if st.button(f"💾 Actualizar", key=f"update_inv_{item['id']}"):
-                                update_inventory_quantity(item['id'], nueva_cantidad)
-                                st.success("Cantidad actualizada")
-                                st.rerun()
+            df_pagina = show_inventory_grid(df_pronostico, usuario)
+            if not df_pagina.empty:
+                show_inventory_movement_form(df_pagina, usuario['id'])
+            show_inventory_movements()
+        
+        show_supplier_delivery_import()
+        if usuario['rol'] == 'Administrador':
+            show_service_materials_editor()
 
 def show_new_item_form():
     st.markdown("### ➕ Nuevo Item de Inventario")
@@ -1657,7 +2675,7 @@ def show_new_item_form():
         
         with col1:
             nombre = st.text_input("📦 Nombre del Item")
-            categoria = st.selectbox("🏷️ Categoría", ['Materiales', 'Herramientas', 'Equipos', 'Consumibles'])
+            categoria = st.selectbox("🏷️ Categoría", INVENTORY_CATEGORIES)
             cantidad = st.number_input("📊 Cantidad Inicial", min_value=0, value=0)
         
         with col2:
@@ -1677,23 +2695,361 @@ def show_new_item_form():
                 st.error("❌ Por favor complete todos los campos obligatorios")
 
 def create_new_inventory_item(nombre, categoria, cantidad, precio_unitario, proveedor, fecha_vencimiento, stock_minimo):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO inventario (nombre, categoria, cantidad, precio_unitario, proveedor, fecha_vencimiento, stock_minimo)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (nombre, categoria, cantidad, precio_unitario, proveedor, fecha_vencimiento, stock_minimo))
-    
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        # La cantidad inicial entra al libro como movimiento; el trigger la suma al saldo
+        cursor.execute('''
+            INSERT INTO inventario (nombre, categoria, cantidad, precio_unitario, proveedor, fecha_vencimiento, stock_minimo)
+            VALUES (?, ?, 0, ?, ?, ?, ?)
+        ''', (nombre, categoria, precio_unitario, proveedor, fecha_vencimiento, stock_minimo))
+        if cantidad:
+            record_inventory_movements(cursor, [(cursor.lastrowid, 'entrada', cantidad, 'Inventario inicial',
+                                                 None, fecha_vencimiento)],
+                                       usuario_id=st.session_state.get('user_data', {}).get('id'))
 
-def update_inventory_quantity(item_id, new_quantity):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE inventario SET cantidad = ? WHERE id = ?', (new_quantity, item_id))
-    conn.commit()
-    conn.close()
+# Módulo de movimientos de inventario: todo cambio de stock es una fila en inventario_movimientos
+# y el trigger trg_movimientos_saldo lo aplica como cantidad = cantidad + ? en la misma transacción
+INVENTORY_MOVEMENTS = {
+    'entrada': 'Entrada',
+    'consumo': 'Consumo',
+    'vencimiento': 'Baja por vencimiento',
+    'ajuste': 'Ajuste por conteo',
+}
+
+# Ajuste por conteo físico: la diferencia contra el saldo se calcula dentro del mismo INSERT
+COUNT_ADJUSTMENT_SQL = '''
+    INSERT INTO inventario_movimientos (item_id, tipo, cantidad, referencia, usuario_id, fecha)
+    SELECT id, 'ajuste', ? - cantidad, ?, ?, ? FROM inventario WHERE id = ? AND cantidad <> ?
+'''
+
+def record_inventory_movements(cursor, movimientos, usuario_id=None):
+    """Agregar movimientos (item_id, tipo, cantidad con signo, referencia[, lote, vencimiento]) en un solo executemany"""
+    fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany('''
+        INSERT INTO inventario_movimientos (item_id, tipo, cantidad, referencia, lote, vencimiento, usuario_id, fecha)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(item_id, tipo, cantidad, referencia, *(lote or (None, None)), usuario_id, fecha)
+          for item_id, tipo, cantidad, referencia, *lote in movimientos])
+
+def apply_inventory_movement(item_id, tipo, cantidad, referencia=None, usuario_id=None, lote=None, vencimiento=None,
+                             usar_reservado=False):
+    """Registrar un movimiento desde la interfaz; False si no alcanza el stock disponible para una salida.
+
+    Las entradas forman un lote con su vencimiento; las salidas descuentan los lotes en orden FEFO.
+    Una salida solo toma lo reservado para órdenes "En Proceso" si se pide con usar_reservado.
+    """
+    fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with get_connection() as conn:
+        if tipo == 'ajuste':
+            conn.execute(COUNT_ADJUSTMENT_SQL, (cantidad, referencia or 'Conteo físico', usuario_id, fecha, item_id, cantidad))
+            return True
+        if tipo == 'entrada':
+            record_inventory_movements(conn, [(item_id, tipo, cantidad, referencia, lote, vencimiento)], usuario_id)
+            return True
+        # Salidas: solo si alcanza el stock, comprobado y descontado de forma atómica
+        cursor = conn.execute('''
+            INSERT INTO inventario_movimientos (item_id, tipo, cantidad, referencia, usuario_id, fecha)
+            SELECT id, ?, -?, ?, ?, ? FROM inventario
+            WHERE id = ? AND cantidad - CASE WHEN ? THEN 0 ELSE reservado END >= ?
+        ''', (tipo, cantidad, referencia, usuario_id, fecha, item_id, usar_reservado, cantidad))
+        return cursor.rowcount == 1
+
+def import_supplier_delivery(entregas, referencia, usuario_id=None):
+    """Aplicar una entrega de proveedor [(nombre, cantidad[, lote, vencimiento])] en una sola transacción.
+
+    Devuelve los nombres que no existen en el inventario; si hay alguno no se aplica nada.
+    """
+    with get_connection() as conn:
+        ids = dict(conn.execute('SELECT nombre, id FROM inventario').fetchall())
+        faltantes = sorted({nombre for nombre, *_ in entregas if nombre not in ids})
+        if not faltantes:
+            record_inventory_movements(conn, [(ids[nombre], 'entrada', cantidad, referencia, *lote)
+                                              for nombre, cantidad, *lote in entregas], usuario_id)
+    return faltantes
+
+def inventory_ledger_differences(conn):
+    """Items cuyo saldo no coincide con la suma de sus movimientos"""
+    return pd.read_sql_query('''
+        SELECT i.id, i.nombre, i.cantidad, COALESCE(SUM(m.cantidad), 0) AS libro
+        FROM inventario i LEFT JOIN inventario_movimientos m ON m.item_id = i.id
+        GROUP BY i.id
+        HAVING i.cantidad <> COALESCE(SUM(m.cantidad), 0)
+    ''', conn)
+
+def show_inventory_movements():
+    with st.expander("📜 Últimos movimientos"):
+        with get_connection() as conn:
+            df_movimientos = pd.read_sql_query('''
+                SELECT m.fecha, i.nombre AS item, m.tipo, m.cantidad, m.referencia, u.nombre AS usuario
+                FROM inventario_movimientos m
+                JOIN inventario i ON i.id = m.item_id
+                LEFT JOIN usuarios u ON u.id = m.usuario_id
+                ORDER BY m.id DESC LIMIT 50
+            ''', conn)
+        df_movimientos['tipo'] = df_movimientos['tipo'].map(INVENTORY_MOVEMENTS).fillna(df_movimientos['tipo'])
+        st.dataframe(df_movimientos, use_container_width=True, hide_index=True)
+
+def parse_supplier_delivery(archivo):
+    """Leer el CSV de una entrega: [(nombre, cantidad, lote, vencimiento)], lote y vencimiento opcionales"""
+    df_entrega = pd.read_csv(archivo, dtype={'lote': str, 'vencimiento': str})
+    for columna in ('lote', 'vencimiento'):
+        if columna not in df_entrega:
+            df_entrega[columna] = None
+    return [(str(nombre).strip(), int(cantidad), lote if pd.notna(lote) else None,
+             datetime.strptime(vence, '%Y-%m-%d').date().isoformat() if pd.notna(vence) else None)
+            for nombre, cantidad, lote, vence
+            in df_entrega[['nombre', 'cantidad', 'lote', 'vencimiento']].itertuples(index=False)]
+
+def show_supplier_delivery_import():
+    with st.expander("📥 Importar entrega de proveedor"):
+        st.caption("Archivo CSV con columnas `nombre` y `cantidad` (y opcionalmente `lote` y `vencimiento` "
+                   "AAAA-MM-DD); se aplica completo o no se aplica.")
+        archivo = st.file_uploader("Archivo de la entrega", type=['csv'], key="entrega_proveedor")
+        referencia = st.text_input("Referencia (factura o remisión)", key="entrega_referencia")
+        
+        if archivo is not None and st.button("📥 Aplicar entrega", key="aplicar_entrega"):
+            try:
+                entregas = parse_supplier_delivery(archivo)
+            except (KeyError, ValueError) as e:
+                st.error(f"❌ Archivo inválido: {str(e)}")
+                return
+            if any(cantidad <= 0 for _, cantidad, *_ in entregas):
+                st.error("❌ Todas las cantidades deben ser mayores a 0")
+                return
+            
+            faltantes = import_supplier_delivery(entregas, referencia or archivo.name, st.session_state.user_data['id'])
+            if faltantes:
+                st.error(f"❌ Items no encontrados: {', '.join(faltantes)}. No se aplicó la entrega.")
+            else:
+                st.success(f"✅ Entrega aplicada: {len(entregas)} líneas")
+
+# Módulo de lotes de inventario: cada entrada del libro forma un lote con su vencimiento y cada
+# salida descuenta los lotes en orden FEFO dentro del trigger trg_movimientos_saldo
+HOT_QUERIES['lotes_fefo'] = ('''
+    SELECT id, cantidad FROM inventario_lotes
+    WHERE item_id = ? AND cantidad > 0
+    ORDER BY vence_orden, id
+''', (1,))
+
+HOT_QUERIES['lotes_por_vencer'] = ('''
+    SELECT fecha_vencimiento, nombre, lote, cantidad FROM lotes_por_vencer
+    WHERE fecha_vencimiento <= ?
+    ORDER BY fecha_vencimiento
+''', ('2025-01-31',))
+
+def get_item_lots(item_id):
+    """Lotes con saldo de un item (lote, vencimiento, cantidad, inicial) en el orden en que se consumen"""
+    with get_connection() as conn:
+        return conn.execute('''
+            SELECT lote, fecha_vencimiento, cantidad, inicial FROM inventario_lotes
+            WHERE item_id = ? AND cantidad > 0
+            ORDER BY vence_orden, id
+        ''', (item_id,)).fetchall()
+
+def get_expiring_lots(dias):
+    hasta = (datetime.now().date() + timedelta(days=dias)).isoformat()
+    with get_connection() as conn:
+        return pd.read_sql_query(HOT_QUERIES['lotes_por_vencer'][0], conn, params=(hasta,))
+
+def write_off_expired_lots(usuario_id=None):
+    """Dar de baja el saldo vencido no reservado con un movimiento por item.
+    
+    Devuelve cuántos items se dieron de baja y los números de las órdenes con materiales
+    reservados de items que conservan saldo vencido.
+    """
+    hoy = datetime.now().date().isoformat()
+    with get_connection() as conn:
+        # Los lotes vencidos son los primeros en orden FEFO: la baja los descuenta a ellos. Lo
+        # reservado por órdenes en proceso no se da de baja: quedaría reservado sin existencias
+        cursor = conn.execute('''
+            INSERT INTO inventario_movimientos (item_id, tipo, cantidad, referencia, usuario_id, fecha)
+            SELECT v.item_id, 'vencimiento', -MIN(v.vencido, i.cantidad - i.reservado), 'Lotes vencidos', ?, ?
+            FROM (
+                SELECT item_id, SUM(cantidad) AS vencido
+                FROM inventario_lotes
+                WHERE cantidad > 0 AND fecha_vencimiento < ?
+                GROUP BY item_id
+            ) v
+            JOIN inventario i ON i.id = v.item_id
+            WHERE i.cantidad - i.reservado > 0
+        ''', (usuario_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), hoy))
+        ordenes = [row[0] for row in conn.execute('''
+            SELECT DISTINCT o.numero_orden
+            FROM ordenes_materiales m
+            JOIN ordenes o ON o.id = m.orden_id
+            WHERE m.estado = 'reservado' AND m.item_id IN (
+                SELECT item_id FROM inventario_lotes WHERE cantidad > 0 AND fecha_vencimiento < ?
+            )
+            ORDER BY o.numero_orden
+        ''', (hoy,))]
+        return cursor.rowcount, ordenes
+
+def inventory_lot_differences(conn):
+    """Items cuyo saldo positivo no coincide con la suma de sus lotes"""
+    return pd.read_sql_query('''
+        SELECT i.id, i.nombre, i.cantidad, COALESCE(SUM(l.cantidad), 0) AS lotes
+        FROM inventario i LEFT JOIN inventario_lotes l ON l.item_id = i.id AND l.cantidad > 0
+        GROUP BY i.id
+        HAVING MAX(i.cantidad, 0) <> COALESCE(SUM(l.cantidad), 0)
+    ''', conn)
+
+def show_expiring_lots():
+    with st.expander("⏰ Lotes por vencer"):
+        dias = st.number_input("Vencen en los próximos (días)", min_value=0, value=EXPIRY_ALERT_DAYS,
+                               key="lotes_dias")
+        df_lotes = get_expiring_lots(dias)
+        if df_lotes.empty:
+            st.success(f"✅ Ningún lote vence en los próximos {dias} días")
+            return
+        hoy = datetime.now().date().isoformat()
+        vencidos = df_lotes[df_lotes['fecha_vencimiento'] < hoy]
+        st.dataframe(df_lotes.rename(columns={
+            'fecha_vencimiento': 'Vence', 'nombre': 'Item', 'lote': 'Lote', 'cantidad': 'Cantidad'
+        }), use_container_width=True, hide_index=True)
+        if not vencidos.empty and st.button(f"🗑️ Dar de baja {len(vencidos)} lotes vencidos", key="baja_vencidos"):
+            items, ordenes = write_off_expired_lots(st.session_state.user_data['id'])
+            st.success(f"✅ Baja por vencimiento registrada en {items} items")
+            if not ordenes:
+                st.rerun()
+            st.warning("⚠️ Parte del saldo vencido está reservado y no se dio de baja; revisa los materiales "
+                       f"de estas órdenes: {', '.join(ordenes)}")
+
+# Módulo de pronóstico de demanda: serie diaria de consumos por material (resumen del libro en
+# inventario_consumo_diario), suavizado exponencial semanal con perfil por día de la semana, todo
+# con NumPy sobre la matriz items × días de una vez. El ajuste se cachea; el punto de reorden se
+# calcula contra el stock actual.
+FORECAST_TTL = 600
+FORECAST_WEEKS = 26
+FORECAST_HORIZON_DAYS = 365
+FORECAST_ALPHA = 0.3
+FORECAST_SERVICE_Z = 1.65
+FORECAST_LEAD_DAYS = int(os.environ.get('GLAB_LEAD_TIME_DAYS', '7'))
+FORECAST_REVIEW_DAYS = int(os.environ.get('GLAB_REVIEW_DAYS', '14'))
+
+HOT_QUERIES['serie_consumos'] = ('''
+    SELECT item_id, CAST(julianday(?) - julianday(dia) AS INTEGER), cantidad
+    FROM inventario_consumo_diario
+    WHERE dia >= ? AND dia < ?
+''', ('2025-01-01', '2024-07-01', '2025-01-01'))
+
+HOT_QUERIES['demanda_pendiente'] = ('''
+    SELECT b.item_id, SUM(b.cantidad * COALESCE(o.cantidad, 1))
+    FROM ordenes o
+    JOIN servicios s ON s.nombre = o.trabajo
+    JOIN servicios_materiales b ON b.servicio_id = s.id
+    WHERE o.estado = 'Creada'
+    GROUP BY b.item_id
+''', ())
+
+def fit_demand(serie, alpha=FORECAST_ALPHA):
+    """Ajustar el consumo de todos los items a la vez.
+
+    serie es una matriz items × días cuya última columna es ayer y cuyo largo es múltiplo de 7.
+    Devuelve el nivel diario (suavizado exponencial de los totales semanales), el índice por día
+    de la semana alineado para que la columna 0 sea hoy y la desviación de los totales semanales.
+    """
+    import numpy as np
+    
+    items, dias = serie.shape
+    semanas = serie.reshape(items, dias // 7, 7)
+    totales = semanas.sum(axis=2)
+    # Suavizado exponencial en forma cerrada: un producto matriz-vector en lugar de un bucle
+    pesos = alpha * (1 - alpha) ** np.arange(totales.shape[1] - 1, -1, -1)
+    nivel = (totales @ pesos + (1 - alpha) ** totales.shape[1] * totales.mean(axis=1)) / 7
+    # Perfil semanal: la columna j de cada semana cae el mismo día de la semana que hoy + j
+    por_dia = semanas.sum(axis=1)
+    total = por_dia.sum(axis=1, keepdims=True)
+    indice = np.divide(por_dia * 7, total, out=np.ones_like(por_dia, dtype=float), where=total > 0)
+    # Desviación semanal contando solo desde la primera semana con consumo de cada item
+    activas = np.cumsum(totales, axis=1) > 0
+    semanas_activas = activas.sum(axis=1)
+    media = np.divide((totales * activas).sum(axis=1), semanas_activas,
+                      out=np.zeros(items), where=semanas_activas > 0)
+    varianza = np.divide((((totales - media[:, None]) * activas) ** 2).sum(axis=1), semanas_activas - 1,
+                         out=np.zeros(items), where=semanas_activas > 1)
+    return nivel, indice, np.sqrt(varianza)
+
+def plan_reorders(nivel, indice, sigma, disponible, pendiente, minimo,
+                  plazo=FORECAST_LEAD_DAYS, revision=FORECAST_REVIEW_DAYS, horizonte=FORECAST_HORIZON_DAYS):
+    """Punto de reorden, cantidad a pedir y días hasta agotarse para todos los items.
+
+    pendiente es el material de las órdenes aún en 'Creada': demanda conocida que sirve de piso
+    al pronóstico. Los items sin consumos registrados conservan su stock mínimo como punto de reorden.
+    """
+    import numpy as np
+    
+    diario = nivel[:, None] * np.take(indice, np.arange(horizonte) % 7, axis=1)
+    acumulado = np.maximum(np.cumsum(diario, axis=1), pendiente[:, None])
+    seguridad = FORECAST_SERVICE_Z * sigma * np.sqrt(plazo / 7)
+    punto = acumulado[:, plazo - 1] + seguridad
+    punto = np.where(nivel > 0, punto, np.maximum(punto, minimo))
+    objetivo = punto + acumulado[:, plazo + revision - 1] - acumulado[:, plazo - 1]
+    pedir = np.where(disponible <= punto, np.ceil(np.maximum(objetivo - disponible, 0)), 0)
+    agotado = acumulado >= disponible[:, None]
+    dias = np.where(agotado.any(axis=1) & ((nivel > 0) | (disponible <= 0)), agotado.argmax(axis=1), -1)
+    return punto, pedir, dias
+
+@st.cache_data(ttl=FORECAST_TTL, show_spinner=False)
+def get_demand_model():
+    """Ajuste del consumo de las últimas FORECAST_WEEKS semanas: nivel, sigma y d0..d6 por item"""
+    import numpy as np
+    
+    hoy = datetime.now().date()
+    dias = FORECAST_WEEKS * 7
+    with get_connection() as conn:
+        ids = np.array([row[0] for row in conn.execute('SELECT id FROM inventario ORDER BY id')], dtype=np.int64)
+        filas = conn.execute(HOT_QUERIES['serie_consumos'][0], (
+            hoy.isoformat(), (hoy - timedelta(days=dias)).isoformat(), hoy.isoformat())).fetchall()
+    consumos = np.fromiter(itertools.chain.from_iterable(filas), dtype=float, count=3 * len(filas)).reshape(-1, 3)
+    # Matriz items × días armada de una vez (una fila por día e item); la última columna es ayer
+    consumos = consumos[np.isin(consumos[:, 0], ids)]
+    serie = np.zeros((len(ids), dias))
+    serie[np.searchsorted(ids, consumos[:, 0]), dias - consumos[:, 1].astype(int)] = consumos[:, 2]
+    nivel, indice, sigma = fit_demand(serie)
+    modelo = pd.DataFrame(indice, index=ids, columns=[f"d{j}" for j in range(7)])
+    modelo['nivel'] = nivel
+    modelo['sigma'] = sigma
+    return modelo
+
+def get_inventory_forecast(df_inventario):
+    """Pronóstico y reorden de cada item de df_inventario contra su stock disponible actual"""
+    import numpy as np
+    
+    with get_connection() as conn:
+        pendiente = dict(conn.execute(HOT_QUERIES['demanda_pendiente'][0]).fetchall())
+    # Los items creados después del último ajuste aún no tienen consumos
+    modelo = get_demand_model().reindex(df_inventario['id'].to_numpy())
+    modelo[['nivel', 'sigma']] = modelo[['nivel', 'sigma']].fillna(0)
+    indice = modelo[[f"d{j}" for j in range(7)]].fillna(1).to_numpy()
+    disponible = (df_inventario['cantidad'] - df_inventario['reservado']).to_numpy(dtype=float)
+    punto, pedir, dias = plan_reorders(modelo['nivel'].to_numpy(), indice, modelo['sigma'].to_numpy(), disponible,
+                                       df_inventario['id'].map(pendiente).fillna(0).to_numpy(dtype=float),
+                                       df_inventario['stock_minimo'].fillna(0).to_numpy(dtype=float))
+    hoy = pd.Timestamp(datetime.now().date())
+    return pd.DataFrame({
+        'id': df_inventario['id'].to_numpy(),
+        'nombre': df_inventario['nombre'].to_numpy(),
+        'disponible': disponible.astype(int),
+        'consumo_diario': modelo['nivel'].to_numpy().round(2),
+        'punto_reorden': np.ceil(punto).astype(int),
+        'pedir': pedir.astype(int),
+        'agotamiento': pd.Series(hoy + pd.to_timedelta(np.maximum(dias, 0), unit='D')).where(dias >= 0),
+    })
+
+def show_inventory_forecast(df_pronostico):
+    with st.expander("📈 Pronóstico de demanda y reorden"):
+        df_reorden = df_pronostico[df_pronostico['pedir'] > 0].sort_values('agotamiento', na_position='last')
+        if df_reorden.empty:
+            st.success("✅ Ningún item llega a su punto de reorden")
+        else:
+            st.dataframe(df_reorden.drop(columns=['id']).rename(columns={
+                'nombre': 'Item', 'disponible': 'Disponible', 'consumo_diario': 'Consumo diario',
+                'punto_reorden': 'Punto de reorden', 'pedir': 'Pedir', 'agotamiento': 'Se agota'
+            }), use_container_width=True, hide_index=True)
+        st.caption(f"Consumos de las últimas {FORECAST_WEEKS} semanas; entrega del proveedor en "
+                   f"{FORECAST_LEAD_DAYS} días y pedido para {FORECAST_REVIEW_DAYS} días más. "
+                   f"Se actualiza cada {FORECAST_TTL // 60} minutos.")
 
 # Módulo de Reportes Mejorado
 def show_reports_module():
@@ -1702,25 +3058,28 @@ def show_reports_module():
     # Selector de tipo de reporte
     tipo_reporte = st.selectbox(
         "📋 Seleccionar Tipo de Reporte",
-        ["Órdenes", "Técnicos", "Financiero", "Inventario", "Doctores"]
+        ["Órdenes", "Técnicos", "Tiempos por Etapa", "Financiero", "Inventario", "Doctores"]
     )
     
-    conn = sqlite3.connect('glab.db')
-    
-    if tipo_reporte == "Órdenes":
-        show_orders_report(conn)
-    elif tipo_reporte == "Técnicos":
-        show_technicians_report(conn)
-    elif tipo_reporte == "Financiero":
-        show_financial_report(conn)
-    elif tipo_reporte == "Inventario":
-        show_inventory_report(conn)
-    elif tipo_reporte == "Doctores":
-        show_doctors_report(conn)
-    
-    conn.close()
+    with get_connection() as conn:
+        
+        if tipo_reporte == "Órdenes":
+            show_orders_report(conn)
+        elif tipo_reporte == "Técnicos":
+            show_technicians_report(conn)
+        elif tipo_reporte == "Tiempos por Etapa":
+            show_stage_times_report()
+        elif tipo_reporte == "Financiero":
+            show_financial_report(conn)
+        elif tipo_reporte == "Inventario":
+            show_inventory_report(conn)
+        elif tipo_reporte == "Doctores":
+            show_doctors_report(conn)
+        
 
 def show_orders_report(conn):
+    import plotly.express as px
+    
     st.markdown("### 📋 Reporte de Órdenes")
     
     # Métricas principales
@@ -1756,33 +3115,31 @@ def show_orders_report(conn):
             st.plotly_chart(fig, use_container_width=True)
 
 def show_technicians_report(conn):
+    import plotly.express as px
+    
     st.markdown("### 👨‍🔧 Reporte de Técnicos")
     
-    # Órdenes por técnico con estados
-    df_tecnicos = pd.read_sql_query("""
-        SELECT tecnico_asignado, estado, COUNT(*) as cantidad 
-        FROM ordenes 
-        WHERE tecnico_asignado IS NOT NULL 
-        GROUP BY tecnico_asignado, estado
-        ORDER BY tecnico_asignado, estado
-    """, conn)
+    # Misma consulta agregada que el PDF: una fila por técnico con el conteo de cada estado
+    df_tecnicos = pd.DataFrame(
+        conn.execute(TECHNICIANS_REPORT_SQL, ORDER_STATES).fetchall(),
+        columns=['tecnico_asignado', 'total_ordenes'] + ORDER_STATES +
+                ['ciclo_promedio', 'ciclo_maximo', 'ingresos', 'ingresos_entregados'])
     
     if not df_tecnicos.empty:
         # Tabla resumen por técnico
         st.markdown("### 📊 Órdenes por Técnico y Estado")
         
-        tecnicos = df_tecnicos['tecnico_asignado'].unique()
-        
-        for tecnico in tecnicos:
+        for _, fila in df_tecnicos.iterrows():
+            tecnico = fila['tecnico_asignado']
+            df_tecnico = pd.DataFrame({'estado': ORDER_STATES, 'cantidad': fila[ORDER_STATES].astype(int).values})
+            df_tecnico = df_tecnico[df_tecnico['cantidad'] > 0]
+            
             with st.expander(f"👨‍🔧 {tecnico}"):
-                df_tecnico = df_tecnicos[df_tecnicos['tecnico_asignado'] == tecnico]
-                
                 col1, col2 = st.columns(2)
                 
                 with col1:
                     # Métricas del técnico
-                    total_tecnico = df_tecnico['cantidad'].sum()
-                    st.metric(f"Total Órdenes - {tecnico}", total_tecnico)
+                    st.metric(f"Total Órdenes - {tecnico}", int(fila['total_ordenes']))
                     
                     # Desglose por estado
                     for _, row in df_tecnico.iterrows():
@@ -1796,21 +3153,14 @@ def show_technicians_report(conn):
         
         # Gráfico general de técnicos
         st.markdown("### 📊 Comparación General de Técnicos")
-        df_total_tecnicos = pd.read_sql_query("""
-            SELECT tecnico_asignado, COUNT(*) as total_ordenes 
-            FROM ordenes 
-            WHERE tecnico_asignado IS NOT NULL 
-            GROUP BY tecnico_asignado
-        """, conn)
-        
-        if not df_total_tecnicos.empty:
-            fig = px.bar(df_total_tecnicos, x='tecnico_asignado', y='total_ordenes',
-                        title="Total de Órdenes por Técnico")
-            st.plotly_chart(fig, use_container_width=True)
+        fig = px.bar(df_tecnicos, x='tecnico_asignado', y='total_ordenes',
+                    title="Total de Órdenes por Técnico")
+        st.plotly_chart(fig, use_container_width=True)
     
     # Botón para exportar a PDF
+    detalle = st.checkbox("Incluir detalle por orden", key="reporte_tecnicos_detalle")
     if st.button("📄 Exportar Reporte de Técnicos a PDF"):
-        pdf_buffer = generate_technicians_report_pdf(df_tecnicos)
+        pdf_buffer = generate_technicians_report_pdf(conn, detalle=detalle)
         if pdf_buffer:
             st.download_button(
                 label="⬇️ Descargar Reporte PDF",
@@ -1820,32 +3170,40 @@ def show_technicians_report(conn):
             )
 
 def show_financial_report(conn):
+    import plotly.express as px
+    
     st.markdown("### 💰 Reporte Financiero")
     
     # Métricas financieras
     col1, col2, col3, col4 = st.columns(4)
     
-    ingresos_total = pd.read_sql_query("SELECT SUM(precio) as total FROM ordenes", conn).iloc[0]['total'] or 0
+    # Totales desde el resumen diario (no recorre ordenes)
+    total_ordenes, ingresos_total, ordenes_entregadas = conn.execute("""
+        SELECT SUM(ordenes), SUM(ingresos), SUM(CASE WHEN estado = 'Entregada' THEN ordenes ELSE 0 END)
+        FROM ordenes_daily_rollup
+    """).fetchone()
+    ingresos_total = ingresos_total or 0
     with col1:
         st.metric("💰 Ingresos Total", f"${ingresos_total:,.0f}")
     
-    ingresos_mes = pd.read_sql_query("SELECT SUM(precio) as total FROM ordenes WHERE fecha_ingreso LIKE '2025-07%'", conn).iloc[0]['total'] or 0
+    periodo = st.selectbox("📅 Periodo", ['Mes', 'Trimestre', 'Año'], key="periodo_financiero")
+    inicio, fin = period_bounds(periodo)
+    _, ingresos_periodo = get_period_summary(conn, inicio, fin)
     with col2:
-        st.metric("📅 Ingresos del Mes", f"${ingresos_mes:,.0f}")
+        st.metric(f"📅 Ingresos del {periodo}", f"${ingresos_periodo:,.0f}")
     
-    promedio_orden = pd.read_sql_query("SELECT AVG(precio) as promedio FROM ordenes", conn).iloc[0]['promedio'] or 0
+    promedio_orden = ingresos_total / total_ordenes if total_ordenes else 0
     with col3:
         st.metric("📊 Promedio por Orden", f"${promedio_orden:,.0f}")
     
-    ordenes_entregadas = pd.read_sql_query("SELECT COUNT(*) as total FROM ordenes WHERE estado = 'Entregada'", conn).iloc[0]['total']
     with col4:
-        st.metric("✅ Órdenes Entregadas", ordenes_entregadas)
+        st.metric("✅ Órdenes Entregadas", ordenes_entregadas or 0)
     
     # Gráfico de ingresos por doctor
     df_ingresos_doctor = pd.read_sql_query("""
-        SELECT d.nombre, SUM(o.precio) as ingresos
-        FROM ordenes o
-        JOIN doctores d ON o.doctor_id = d.id
+        SELECT d.nombre, SUM(r.ingresos) as ingresos
+        FROM ordenes_daily_rollup r
+        JOIN doctores d ON r.doctor_id = d.id
         GROUP BY d.nombre
         ORDER BY ingresos DESC
     """, conn)
@@ -1866,7 +3224,7 @@ def show_inventory_report(conn):
     with col1:
         st.metric("📦 Total Items", total_items)
     
-    stock_critico = pd.read_sql_query("SELECT COUNT(*) as total FROM inventario WHERE cantidad <= stock_minimo", conn).iloc[0]['total']
+    stock_critico = pd.read_sql_query("SELECT COUNT(*) as total FROM inventario WHERE cantidad - stock_minimo <= 0", conn).iloc[0]['total']
     with col2:
         st.metric("⚠️ Stock Crítico", stock_critico)
     
@@ -1875,12 +3233,30 @@ def show_inventory_report(conn):
         st.metric("💰 Valor Total", f"${valor_inventario:,.0f}")
     
     # Items con stock crítico
-    df_critico = pd.read_sql_query("SELECT nombre, cantidad, stock_minimo FROM inventario WHERE cantidad <= stock_minimo", conn)
+    df_critico = pd.read_sql_query("SELECT nombre, cantidad, stock_minimo FROM inventario WHERE cantidad - stock_minimo <= 0", conn)
     if not df_critico.empty:
         st.markdown("### ⚠️ Items con Stock Crítico")
         st.dataframe(df_critico, use_container_width=True)
+    
+    show_inventory_forecast(get_inventory_forecast(
+        pd.read_sql_query("SELECT id, nombre, cantidad, reservado, stock_minimo FROM inventario", conn)))
+    
+    # Conciliación del saldo contra el libro de movimientos
+    df_diferencias = inventory_ledger_differences(conn)
+    if df_diferencias.empty:
+        st.success("✅ El stock de todos los items cuadra con el libro de movimientos")
+    else:
+        st.markdown("### 🧮 Diferencias contra el libro de movimientos")
+        st.dataframe(df_diferencias, use_container_width=True, hide_index=True)
+    
+    df_lotes = inventory_lot_differences(conn)
+    if not df_lotes.empty:
+        st.markdown("### 🧮 Diferencias contra los lotes")
+        st.dataframe(df_lotes, use_container_width=True, hide_index=True)
 
 def show_doctors_report(conn):
+    import plotly.express as px
+    
     st.markdown("### 👨‍⚕️ Reporte de Doctores")
     
     # Órdenes por doctor
@@ -1900,56 +3276,316 @@ def show_doctors_report(conn):
                     color='categoria', title="Órdenes por Doctor")
         st.plotly_chart(fig, use_container_width=True)
 
-def generate_technicians_report_pdf(df_tecnicos):
+# Módulo de reportes PDF: tablas platypus paginadas a mano sobre un Frame por página, de
+# modo que las filas se leen por bloques y solo se arma la tabla de la página en curso. El
+# canvas de reportlab conserva cada página terminada hasta save(): la memoria sigue creciendo
+# con el número de páginas (del orden de 1 KB por fila), aunque mucho menos que con toda la
+# tabla armada de una vez. Acotarla de verdad exigiría escribir el PDF por partes y unirlas
+# con una librería de PDF que la aplicación no usa
+REPORT_CHUNK_ROWS = 200
+
+def _clip(texto, largo):
+    texto = '' if texto is None else str(texto)
+    return texto if len(texto) <= largo else texto[:largo - 1] + '…'
+
+def _fill_report_frame(frame, pendientes, c):
+    """Agregar tablas al marco partiéndolas donde se acabe la página; False si la página se llenó"""
+    while pendientes:
+        if frame.add(pendientes[0], c):
+            pendientes.pop(0)
+            continue
+        partes = frame.split(pendientes[0], c)
+        if partes and frame.add(partes[0], c):
+            pendientes[0:1] = partes[1:]
+        return False
+    return True
+
+def render_table_report(destino, titulo, columnas, filas, col_widths, totales=None):
+    """Escribir en destino un reporte PDF con una tabla paginada.
+    
+    filas puede ser cualquier iterable (por ejemplo un cursor); totales es una función que
+    devuelve la fila final, y se llama después de consumir todas las filas.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter, landscape
+    from reportlab.pdfgen import canvas
+    from reportlab.platypus import Frame, Table, TableStyle
+    
+    width, height = landscape(letter)
+    c = canvas.Canvas(destino, pagesize=(width, height))
+    fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    estilo_filas = TableStyle([
+        ('FONT', (0, 0), (-1, -1), 'Helvetica', 8),
+        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+        ('LINEBELOW', (0, 0), (-1, -1), 0.25, colors.HexColor('#bbdefb')),
+    ])
+    estilo_encabezado = TableStyle([
+        ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold', 8),
+        ('TEXTCOLOR', (0, 0), (-1, -1), colors.white),
+        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#1565c0')),
+        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+    ])
+    estilo_totales = TableStyle([
+        ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold', 8),
+        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+        ('LINEABOVE', (0, 0), (-1, -1), 1, colors.HexColor('#1565c0')),
+    ])
+    
+    filas = iter(filas)
+    pendientes = []
+    pagina = 0
+    terminado = False
+    while not terminado:
+        pagina += 1
+        c.setFont("Helvetica-Bold", 14)
+        c.drawString(36, height - 40, titulo)
+        c.setFont("Helvetica", 9)
+        c.drawString(36, height - 56, f"Mónica Riano Laboratorio Dental S.A.S - {fecha}")
+        c.drawRightString(width - 36, 24, f"Página {pagina}")
+        
+        frame = Frame(36, 36, width - 72, height - 108, leftPadding=0, rightPadding=0, topPadding=0, bottomPadding=0)
+        frame.add(Table([columnas], colWidths=col_widths, style=estilo_encabezado), c)
+        
+        while _fill_report_frame(frame, pendientes, c):
+            bloque = [list(fila) for fila in itertools.islice(filas, REPORT_CHUNK_ROWS)]
+            if bloque:
+                pendientes.append(Table(bloque, colWidths=col_widths, style=estilo_filas))
+            elif totales:
+                pendientes.append(Table([totales()], colWidths=col_widths, style=estilo_totales))
+                totales = None
+            else:
+                terminado = True
+                break
+        c.showPage()
+    
+    c.save()
+
+# Consulta agregada del reporte de técnicos: una fila por técnico, un solo recorrido de ordenes
+TECHNICIANS_REPORT_SQL = f"""
+    SELECT tecnico_asignado,
+           COUNT(*) AS total,
+           {', '.join('SUM(estado = ?)' for _ in ORDER_STATES)},
+           AVG(julianday(fecha_entrega) - julianday(fecha_ingreso)) AS ciclo_promedio,
+           MAX(julianday(fecha_entrega) - julianday(fecha_ingreso)) AS ciclo_maximo,
+           SUM(precio) AS ingresos,
+           SUM(CASE WHEN estado = 'Entregada' THEN precio ELSE 0 END) AS ingresos_entregados
+    FROM ordenes
+    WHERE tecnico_asignado IS NOT NULL AND tecnico_asignado <> ''
+    GROUP BY tecnico_asignado
+    ORDER BY tecnico_asignado
+"""
+
+# Detalle por orden, en el orden del índice (tecnico_asignado, fecha_ingreso)
+TECHNICIANS_DETAIL_SQL = """
+    SELECT tecnico_asignado, numero_orden, paciente, trabajo, estado, substr(fecha_ingreso, 1, 10),
+           fecha_entrega, julianday(fecha_entrega) - julianday(fecha_ingreso), precio
+    FROM ordenes
+    WHERE tecnico_asignado IS NOT NULL AND tecnico_asignado <> ''
+    ORDER BY tecnico_asignado, fecha_ingreso
+"""
+
+HOT_QUERIES['reporte_tecnicos'] = (TECHNICIANS_REPORT_SQL, ORDER_STATES)
+HOT_QUERIES['detalle_tecnicos'] = (TECHNICIANS_DETAIL_SQL, ())
+
+def _format_days(dias):
+    return '-' if dias is None else f"{dias:.1f}"
+
+def technicians_summary_rows(conn, acumulado):
+    for row in conn.execute(TECHNICIANS_REPORT_SQL, ORDER_STATES):
+        tecnico, total = row[0], row[1]
+        por_estado = row[2:2 + len(ORDER_STATES)]
+        ciclo_promedio, ciclo_maximo, ingresos, entregados = row[2 + len(ORDER_STATES):]
+        acumulado['total'] += total
+        acumulado['ingresos'] += ingresos or 0
+        acumulado['entregados'] += entregados or 0
+        yield ([_clip(tecnico, 28), f"{total:,}"] + [f"{n:,}" for n in por_estado] +
+               [_format_days(ciclo_promedio), _format_days(ciclo_maximo),
+                f"${ingresos or 0:,.0f}", f"${entregados or 0:,.0f}"])
+
+def technicians_detail_rows(conn):
+    for tecnico, numero, paciente, trabajo, estado, ingreso, entrega, ciclo, precio in conn.execute(TECHNICIANS_DETAIL_SQL):
+        yield [_clip(tecnico, 22), numero, _clip(paciente, 24), _clip(trabajo, 26), estado,
+               ingreso, entrega or '', _format_days(ciclo), f"${precio or 0:,.0f}"]
+
+def generate_technicians_report_pdf(conn, detalle=False, destino=None):
+    """Reporte de técnicos (resumen o detalle por orden) escrito en destino, por defecto un BytesIO"""
     try:
-        from reportlab.lib.pagesizes import letter
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.units import inch
-        
-        buffer = BytesIO()
-        c = canvas.Canvas(buffer, pagesize=letter)
-        width, height = letter
-        
-        # Header
-        c.setFont("Helvetica-Bold", 16)
-        c.drawString(50, height - 50, "Reporte de Técnicos - Mónica Riano Laboratorio Dental")
-        
-        c.setFont("Helvetica", 12)
-        c.drawString(50, height - 80, f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        
-        # Contenido del reporte
-        y_pos = height - 120
-        
-        if not df_tecnicos.empty:
-            tecnicos = df_tecnicos['tecnico_asignado'].unique()
-            
-            for tecnico in tecnicos:
-                c.setFont("Helvetica-Bold", 14)
-                c.drawString(50, y_pos, f"Técnico: {tecnico}")
-                y_pos -= 20
-                
-                df_tecnico = df_tecnicos[df_tecnicos['tecnico_asignado'] == tecnico]
-                
-                c.setFont("Helvetica", 10)
-                for _, row in df_tecnico.iterrows():
-                    c.drawString(70, y_pos, f"• {row['estado']}: {row['cantidad']} órdenes")
-                    y_pos -= 15
-                
-                y_pos -= 10
-                
-                if y_pos < 100:
-                    c.showPage()
-                    y_pos = height - 50
-        
-        c.save()
-        buffer.seek(0)
+        buffer = destino if destino is not None else BytesIO()
+        
+        if detalle:
+            render_table_report(
+                buffer, "Reporte de Técnicos - Detalle por Orden",
+                ['Técnico', 'Orden', 'Paciente', 'Trabajo', 'Estado', 'Ingreso', 'Entrega', 'Días', 'Precio'],
+                technicians_detail_rows(conn),
+                [110, 80, 115, 125, 70, 60, 60, 40, 60])
+        else:
+            acumulado = {'total': 0, 'ingresos': 0, 'entregados': 0}
+            render_table_report(
+                buffer, "Reporte de Técnicos - Mónica Riano Laboratorio Dental",
+                ['Técnico', 'Total'] + ORDER_STATES + ['Ciclo prom.', 'Ciclo máx.', 'Ingresos', 'Entregado'],
+                technicians_summary_rows(conn, acumulado),
+                [120, 45] + [55] * len(ORDER_STATES) + [50, 50, 80, 80],
+                totales=lambda: (['TOTAL', f"{acumulado['total']:,}"] + [''] * (len(ORDER_STATES) + 2) +
+                                 [f"${acumulado['ingresos']:,.0f}", f"${acumulado['entregados']:,.0f}"]))
+        
+        if destino is None:
+            buffer.seek(0)
         return buffer
         
     except Exception as e:
         st.error(f"Error generando PDF: {str(e)}")
         return None
 
+# Módulo de tiempos por etapa: percentiles de ordenes_etapas con funciones de ventana. Cada
+# partición se lee ya ordenada por horas desde su índice parcial, sin ordenar en memoria.
+STAGE_STATS_TTL = 600
+STAGE_GROUPS = {'Etapa': None, 'Técnico': 'tecnico_id', 'Trabajo': 'trabajo'}
+
+def stage_percentiles_sql(columna=None):
+    """Órdenes, promedio, p50 y p95 de horas por etapa y, opcionalmente, por columna"""
+    particion = f"etapa, {columna}" if columna else "etapa"
+    return f"""
+        SELECT etapa, grupo, n AS ordenes, promedio,
+               MAX(CASE WHEN fila = CAST((n - 1) * 0.50 AS INTEGER) + 1 THEN horas END) AS p50,
+               MAX(CASE WHEN fila = CAST((n - 1) * 0.95 AS INTEGER) + 1 THEN horas END) AS p95
+        FROM (
+            SELECT etapa, {columna or 'NULL'} AS grupo, horas,
+                   ROW_NUMBER() OVER particion AS fila,
+                   COUNT(*) OVER particion AS n,
+                   AVG(horas) OVER particion AS promedio
+            FROM ordenes_etapas
+            WHERE horas IS NOT NULL
+            WINDOW particion AS (PARTITION BY {particion} ORDER BY horas
+                                 ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+        )
+        WHERE fila IN (CAST((n - 1) * 0.50 AS INTEGER) + 1, CAST((n - 1) * 0.95 AS INTEGER) + 1)
+        GROUP BY etapa, grupo
+    """
+
+HOT_QUERIES['etapas_percentiles'] = (stage_percentiles_sql(), ())
+HOT_QUERIES['etapas_por_tecnico'] = (stage_percentiles_sql('tecnico_id'), ())
+HOT_QUERIES['etapas_por_trabajo'] = (stage_percentiles_sql('trabajo'), ())
+
+@st.cache_data(ttl=STAGE_STATS_TTL, show_spinner=False)
+def get_stage_percentiles(agrupacion):
+    columna = STAGE_GROUPS[agrupacion]
+    with get_connection() as conn:
+        df = pd.read_sql_query(stage_percentiles_sql(columna), conn)
+        if columna == 'tecnico_id':
+            nombres = dict(conn.execute("SELECT id, nombre FROM usuarios WHERE rol = 'Técnico'").fetchall())
+            df['grupo'] = df['grupo'].map(nombres).fillna('Sin asignar')
+    df['etapa'] = pd.Categorical(df['etapa'], ORDER_STATES, ordered=True)
+    return df.sort_values(['etapa', 'p95'], ascending=[True, False])
+
+def show_stage_times_report():
+    import plotly.express as px
+    
+    st.markdown("### ⏱️ Tiempos por Etapa")
+    
+    agrupacion = st.radio("Agrupar por", list(STAGE_GROUPS), horizontal=True, key="etapas_agrupacion")
+    df_etapas = get_stage_percentiles(agrupacion)
+    
+    if df_etapas.empty:
+        st.info("📭 Aún no hay etapas completadas")
+        return
+    
+    df_tabla = df_etapas.rename(columns={
+        'etapa': 'Etapa', 'grupo': agrupacion, 'ordenes': 'Órdenes',
+        'promedio': 'Promedio (h)', 'p50': 'p50 (h)', 'p95': 'p95 (h)'
+    })
+    if agrupacion == 'Etapa':
+        df_tabla = df_tabla.drop(columns=[agrupacion])
+    st.dataframe(df_tabla.round(1), use_container_width=True, hide_index=True)
+    
+    fig = px.bar(df_etapas, x='etapa', y='p95', color='grupo' if agrupacion != 'Etapa' else None,
+                 barmode='group', labels={'etapa': 'Etapa', 'p95': 'p95 (horas)', 'grupo': agrupacion},
+                 title=f"p95 de horas por etapa ({agrupacion.lower()})")
+    st.plotly_chart(fig, use_container_width=True)
+    st.caption(f"Calculado sobre las etapas cerradas; se actualiza cada {STAGE_STATS_TTL // 60} minutos.")
+
 # Módulo de Usuarios
+USER_ATTRIBUTES = ['nombre', 'email', 'telefono', 'rol', 'activo']
+
+def build_users_page_query(cursor=None, limit=GRID_PAGE_SIZE):
+    """Página de usuarios por llave (rol, nombre, id)"""
+    where = "WHERE (rol, nombre, id) > (?, ?, ?)" if cursor else ""
+    sql = f"""
+        SELECT id, username, nombre, email, telefono, rol, activo
+        FROM usuarios
+        {where}
+        ORDER BY rol, nombre, id
+        LIMIT ?
+    """
+    return sql, list(cursor or ()) + [limit]
+
+HOT_QUERIES['pagina_usuarios'] = build_users_page_query(('Técnico', 'María García', 4))
+
+def save_user_changes(cambios):
+    """Guardar las ediciones {user_id: {columna: valor}} de la tabla en una sola transacción"""
+    cambios = {user_id: {columna: int(valor) if columna == 'activo' else valor for columna, valor in valores.items()}
+               for user_id, valores in cambios.items()}
+    with get_connection() as conn:
+        update_columns(conn, 'usuarios', cambios, USER_ATTRIBUTES)
+        link_doctor_users(conn)
+    invalidate_reference_data()
+
+def show_users_grid():
+    cursores = get_grid_cursors('usuarios', None)
+    with get_connection() as conn:
+        sql, params = build_users_page_query(cursores[-1], GRID_PAGE_SIZE + 1)
+        df_pagina = pd.read_sql_query(sql, conn, params=params)
+    
+    hay_siguiente = len(df_pagina) > GRID_PAGE_SIZE
+    df_pagina = df_pagina.head(GRID_PAGE_SIZE)
+    if df_pagina.empty:
+        # La página quedó vacía (por ejemplo, se cambiaron de rol los usuarios que tenía)
+        st.info("📭 No hay usuarios en esta página")
+        if len(cursores) > 1:
+            show_grid_pager('usuarios', cursores, False, None)
+        return df_pagina
+    df_pagina['activo'] = df_pagina['activo'].astype(bool)
+    
+    key = grid_editor_key('usuarios', len(cursores))
+    st.data_editor(
+        df_pagina, key=key, hide_index=True, use_container_width=True, num_rows="fixed",
+        disabled=['id', 'username'],
+        column_config={
+            'id': None,
+            'username': "Usuario",
+            'nombre': st.column_config.TextColumn("Nombre", required=True),
+            'email': "Email",
+            'telefono': "Teléfono",
+            'rol': st.column_config.SelectboxColumn("Rol", options=USER_ROLES, required=True),
+            'activo': st.column_config.CheckboxColumn("Activo"),
+        },
+    )
+    
+    cambios = grid_changes(df_pagina, key)
+    if st.button(f"💾 Guardar cambios ({len(cambios)})", disabled=not cambios, key="usuarios_guardar"):
+        if any(not (valores.get('nombre', 'x') or '').strip() for valores in cambios.values()):
+            st.error("❌ El nombre no puede quedar vacío")
+        else:
+            save_user_changes(cambios)
+            reset_grid('usuarios')
+            st.rerun()
+    
+    show_grid_pager('usuarios', cursores, hay_siguiente,
+                    tuple(df_pagina[['rol', 'nombre']].iloc[-1]) + (int(df_pagina['id'].iloc[-1]),))
+    return df_pagina
+
+def show_password_form(df_pagina):
+    with st.expander("🔒 Cambiar contraseña"):
+        opciones = dict(zip(df_pagina['username'], df_pagina['id']))
+        username = st.selectbox("Usuario (de esta página)", list(opciones), key="clave_usuario")
+        password = st.text_input("Nueva contraseña", type="password", key="clave_nueva")
+        if st.button("💾 Cambiar contraseña", key="clave_guardar"):
+            if password:
+                set_user_password(opciones[username], password)
+                st.success("✅ Contraseña actualizada")
+            else:
+                st.error("❌ La contraseña no puede estar vacía")
+
 def show_users_module():
     st.markdown("## 👥 Gestión de Usuarios")
     
@@ -1963,63 +3599,10 @@ def show_users_module():
             st.session_state.show_new_user = False
             st.rerun()
     else:
-        # Lista de usuarios
-        conn = sqlite3.connect('glab.db')
-        df_usuarios = pd.read_sql_query("SELECT * FROM usuarios ORDER BY rol, nombre", conn)
-        conn.close()
-        
-        if not df_usuarios.empty:
-            for _, usuario in df_usuarios.iterrows():
-                status_icon = "🟢" if usuario['activo'] else "🔴"
-                
-                with st.expander(f"{status_icon} {usuario['nombre']} - {usuario['rol']}"):
-                    col1, col2, col3 = st.columns(3)
-                    
-                    with col1:
-                        st.write(f"👤 **Usuario:** {usuario['username']}")
-                        st.write(f"📧 **Email:** {usuario['email']}")
-                        st.write(f"📞 **Teléfono:** {usuario['telefono']}")
-                    
-                    with col2:
-                        st.write(f"🎭 **Rol:** {usuario['rol']}")
-                        st.write(f"📊 **Estado:** {'Activo' if usuario['activo'] else 'Inactivo'}")
-                        st.write(f"🔒 **Contraseña:** ••••••••")
-                    
-                    with col3:
-                        # Botón para editar
-                        if st.button(f"✏️ Editar Usuario", key=f"edit_user_{usuario['id']}"):
-                            st.session_state[f'edit_user_{usuario["id"]}'] = True
-                    
-                    # Formulario de edición
-                    if st.session_state.get(f'edit_user_{usuario["id"]}', False):
-                        with st.form(f"edit_user_form_{usuario['id']}"):
-                            col1, col2 = st.columns(2)
-                            
-                            with col1:
-                                new_nombre = st.text_input("Nombre", value=usuario['nombre'])
-                                new_email = st.text_input("Email", value=usuario['email'])
-                                new_telefono = st.text_input("Teléfono", value=usuario['telefono'])
-                            
-                            with col2:
-                                new_rol = st.selectbox("Rol", 
-                                                     ['Administrador', 'Secretaria', 'Técnico', 'Doctor', 'Mensajero'],
-                                                     index=['Administrador', 'Secretaria', 'Técnico', 'Doctor', 'Mensajero'].index(usuario['rol']))
-                                new_password = st.text_input("Nueva Contraseña (dejar vacío para mantener)", type="password")
-                                new_activo = st.checkbox("Usuario Activo", value=bool(usuario['activo']))
-                            
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                if st.form_submit_button("💾 Guardar Cambios"):
-                                    update_user(usuario['id'], new_nombre, new_email, new_telefono, 
-                                               new_rol, new_password if new_password else None, new_activo)
-                                    st.success("Usuario actualizado")
-                                    st.session_state[f'edit_user_{usuario["id"]}'] = False
-                                    st.rerun()
-                            
-                            with col2:
-                                if st.form_submit_button("❌ Cancelar"):
-                                    st.session_state[f'edit_user_{usuario["id"]}'] = False
-                                    st.rerun()
+        # Lista de usuarios: una página editable en lugar de un formulario por usuario
+        df_pagina = show_users_grid()
+        if not df_pagina.empty:
+            show_password_form(df_pagina)
 
 def show_new_user_form():
     st.markdown("### ➕ Nuevo Usuario")
@@ -2035,7 +3618,7 @@ def show_new_user_form():
         with col2:
             password = st.text_input("🔒 Contraseña", type="password")
             telefono = st.text_input("📞 Teléfono")
-            rol = st.selectbox("🎭 Rol", ['Administrador', 'Secretaria', 'Técnico', 'Doctor', 'Mensajero'])
+            rol = st.selectbox("🎭 Rol", USER_ROLES)
         
         if st.form_submit_button("💾 Crear Usuario"):
             if username and nombre and password:
@@ -2047,39 +3630,22 @@ def show_new_user_form():
                 st.error("❌ Por favor complete todos los campos obligatorios")
 
 def create_new_user(username, nombre, email, telefono, password, rol):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    
-    hashed_password = hashlib.md5(password.encode()).hexdigest()
-    
-    cursor.execute('''
-        INSERT INTO usuarios (username, password, nombre, email, telefono, rol)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (username, hashed_password, nombre, email, telefono, rol))
-    
-    conn.commit()
-    conn.close()
-
-def update_user(user_id, nombre, email, telefono, rol, new_password, activo):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    
-    if new_password:
-        hashed_password = hashlib.md5(new_password.encode()).hexdigest()
-        cursor.execute('''
-            UPDATE usuarios 
-            SET nombre = ?, email = ?, telefono = ?, rol = ?, password = ?, activo = ?
-            WHERE id = ?
-        ''', (nombre, email, telefono, rol, hashed_password, int(activo), user_id))
-    else:
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        hashed_password = hashlib.md5(password.encode()).hexdigest()
+        
         cursor.execute('''
-            UPDATE usuarios 
-            SET nombre = ?, email = ?, telefono = ?, rol = ?, activo = ?
-            WHERE id = ?
-        ''', (nombre, email, telefono, rol, int(activo), user_id))
-    
-    conn.commit()
-    conn.close()
+            INSERT INTO usuarios (username, password, nombre, email, telefono, rol)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (username, hashed_password, nombre, email, telefono, rol))
+        link_doctor_users(cursor)
+    invalidate_reference_data()
+
+def set_user_password(user_id, password):
+    with get_connection() as conn:
+        conn.execute('UPDATE usuarios SET password = ? WHERE id = ?',
+                     (hashlib.md5(password.encode()).hexdigest(), user_id))
 
 # Módulo de Seguimiento Mejorado
 def show_tracking_module():
@@ -2097,25 +3663,26 @@ def show_tracking_module():
     with col2:
         st.markdown("### 📦 Buscar por Tracking ID")
         tracking_id = st.text_input("Ej: abc123...", key="search_tracking")
+        modo = st.radio("Modo de búsqueda", ['Prefijo', 'Exacto'], horizontal=True, key="search_tracking_mode")
         
-        if tracking_id:
-            show_tracking_details(tracking_id)
+        if tracking_id.strip():
+            show_tracking_details(tracking_id.strip(), modo)
     
     # Órdenes en transporte
     st.markdown("### 🚚 Órdenes en Transporte")
     
-    conn = sqlite3.connect('glab.db')
-    df_transporte = pd.read_sql_query("""
-        SELECT o.*, d.nombre as doctor_nombre 
-        FROM ordenes o 
-        LEFT JOIN doctores d ON o.doctor_id = d.id 
-        WHERE o.estado = 'En Transporte'
-        ORDER BY o.fecha_ingreso DESC
-    """, conn)
-    conn.close()
+    with get_connection() as conn:
+        df_transporte = pd.read_sql_query("""
+            SELECT o.*, d.nombre as doctor_nombre 
+            FROM ordenes o 
+            LEFT JOIN doctores d ON o.doctor_id = d.id 
+            WHERE o.estado = 'En Transporte'
+            ORDER BY o.fecha_ingreso DESC
+        """, conn)
     
     if not df_transporte.empty:
         for _, orden in df_transporte.iterrows():
+            version = seen_order_version(orden)
             with st.container():
                 st.markdown(f"""
                 <div class="tracking-card">
@@ -2142,21 +3709,22 @@ def show_tracking_module():
                 
                 with col2:
                     if st.button(f"📍 Actualizar Ubicación", key=f"update_location_{orden['id']}"):
-                        update_order_location(orden['id'], nueva_ubicacion)
-                        st.success("Ubicación actualizada")
-                        st.rerun()
+                        if update_order_location(orden['id'], nueva_ubicacion, version):
+                            st.success("Ubicación actualizada")
+                            st.rerun()
+                        else:
+                            show_order_conflict(orden['id'], version)
     else:
         st.info("📭 No hay órdenes en transporte actualmente")
 
 def show_order_tracking(numero_orden):
-    conn = sqlite3.connect('glab.db')
-    df_orden = pd.read_sql_query("""
-        SELECT o.*, d.nombre as doctor_nombre 
-        FROM ordenes o 
-        LEFT JOIN doctores d ON o.doctor_id = d.id 
-        WHERE o.numero_orden = ?
-    """, conn, params=(numero_orden,))
-    conn.close()
+    with get_connection() as conn:
+        df_orden = pd.read_sql_query("""
+            SELECT o.*, d.nombre as doctor_nombre 
+            FROM ordenes o 
+            LEFT JOIN doctores d ON o.doctor_id = d.id 
+            WHERE o.numero_orden = ?
+        """, conn, params=(numero_orden,))
     
     if not df_orden.empty:
         orden = df_orden.iloc[0]
@@ -2174,17 +3742,35 @@ def show_order_tracking(numero_orden):
     else:
         st.warning("❌ Orden no encontrada")
 
-def show_tracking_details(tracking_id):
-    conn = sqlite3.connect('glab.db')
-    df_orden = pd.read_sql_query("""
-        SELECT o.*, d.nombre as doctor_nombre 
-        FROM ordenes o 
-        LEFT JOIN doctores d ON o.doctor_id = d.id 
-        WHERE o.tracking_id LIKE ?
-    """, conn, params=(f"%{tracking_id}%",))
-    conn.close()
-    
-    if not df_orden.empty:
+TRACKING_MAX_CANDIDATES = 10
+
+def lookup_tracking(conn, tracking_id, modo='Prefijo'):
+    """Buscar órdenes por tracking ID usando el índice único (sin distinguir mayúsculas).
+    
+    Una coincidencia exacta siempre gana. En modo 'Prefijo', si no la hay, se devuelven
+    hasta TRACKING_MAX_CANDIDATES + 1 órdenes cuyo tracking empieza por el texto; más de
+    una significa que el prefijo es ambiguo.
+    """
+    sql_exacto, _ = HOT_QUERIES['tracking_exacto']
+    df_orden = pd.read_sql_query(sql_exacto, conn, params=(tracking_id,))
+    if not df_orden.empty or modo == 'Exacto':
+        return df_orden
+    
+    sql_prefijo, _ = HOT_QUERIES['tracking_prefijo']
+    return pd.read_sql_query(sql_prefijo, conn,
+                             params=(tracking_id, tracking_id + '\uffff', TRACKING_MAX_CANDIDATES + 1))
+
+def show_tracking_details(tracking_id, modo='Prefijo'):
+    with get_connection() as conn:
+        df_orden = lookup_tracking(conn, tracking_id, modo)
+    
+    if len(df_orden) > 1:
+        # Prefijo ambiguo: no se elige una orden al azar
+        total = f"más de {TRACKING_MAX_CANDIDATES}" if len(df_orden) > TRACKING_MAX_CANDIDATES else len(df_orden)
+        st.warning(f"⚠️ El prefijo coincide con {total} órdenes. Escriba más caracteres del tracking ID.")
+        st.dataframe(df_orden.head(TRACKING_MAX_CANDIDATES)[['tracking_id', 'numero_orden', 'paciente', 'estado']],
+                     use_container_width=True, hide_index=True)
+    elif not df_orden.empty:
         orden = df_orden.iloc[0]
         
         st.markdown(f"""
@@ -2199,12 +3785,8 @@ def show_tracking_details(tracking_id):
     else:
         st.warning("❌ Tracking ID no encontrado")
 
-def update_order_location(order_id, location):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE ordenes SET ubicacion_actual = ? WHERE id = ?', (location, order_id))
-    conn.commit()
-    conn.close()
+def update_order_location(order_id, location, version):
+    return compare_and_set_order(order_id, version, 'ubicacion_actual = ?', (location,))
 
 # Funciones para otros roles
 def show_doctor_orders():
@@ -2212,67 +3794,65 @@ def show_doctor_orders():
     
     user_data = st.session_state.user_data
     
-    conn = sqlite3.connect('glab.db')
-    # Buscar doctor por nombre de usuario
-    df_doctor = pd.read_sql_query("SELECT id FROM doctores WHERE nombre = ?", conn, params=(user_data['nombre'],))
+    # El usuario está vinculado a su doctor por usuarios.doctor_id
+    doctor_id = get_linked_doctor_id(user_data['id'])
     
-    if not df_doctor.empty:
-        doctor_id = df_doctor.iloc[0]['id']
-        
-        df_ordenes = pd.read_sql_query("""
-            SELECT * FROM ordenes WHERE doctor_id = ? ORDER BY fecha_ingreso DESC
-        """, conn, params=(doctor_id,))
+    with get_connection() as conn:
         
-        if not df_ordenes.empty:
-            for _, orden in df_ordenes.iterrows():
-                with st.expander(f"📋 {orden['numero_orden']} - {orden['paciente']} ({orden['estado']})"):
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        st.write(f"👤 **Paciente:** {orden['paciente']}")
-                        st.write(f"🦷 **Trabajo:** {orden['trabajo']}")
-                        st.write(f"📅 **Ingreso:** {orden['fecha_ingreso']}")
-                        st.write(f"💰 **Precio:** ${orden['precio']:,.0f}")
-                    
-                    with col2:
-                        st.write(f"📊 **Estado:** {orden['estado']}")
-                        st.write(f"🚚 **Entrega:** {orden['fecha_entrega']}")
-                        st.write(f"🎯 **Tracking:** {orden['tracking_id']}")
+        if doctor_id:
+            df_ordenes = pd.read_sql_query("""
+                SELECT * FROM ordenes WHERE doctor_id = ? ORDER BY fecha_ingreso DESC
+            """, conn, params=(doctor_id,))
+            
+            if not df_ordenes.empty:
+                for _, orden in df_ordenes.iterrows():
+                    with st.expander(f"📋 {orden['numero_orden']} - {orden['paciente']} ({orden['estado']})"):
+                        col1, col2 = st.columns(2)
                         
-                        # Mostrar técnico solo si la orden está en proceso o estados posteriores
-                        if orden['estado'] in ['En Proceso', 'Empacada', 'En Transporte', 'Entregada']:
-                            if orden['tecnico_asignado']:
-                                st.write(f"👨‍🔧 **Técnico:** {orden['tecnico_asignado']}")
-                            else:
-                                st.write("👨‍🔧 **Técnico:** Por asignar")
+                        with col1:
+                            st.write(f"👤 **Paciente:** {orden['paciente']}")
+                            st.write(f"🦷 **Trabajo:** {orden['trabajo']}")
+                            st.write(f"📅 **Ingreso:** {orden['fecha_ingreso']}")
+                            st.write(f"💰 **Precio:** ${orden['precio']:,.0f}")
                         
-                    # Observaciones si existen
-                    if orden['observaciones']:
-                        st.write(f"📝 **Observaciones:** {orden['observaciones']}")
+                        with col2:
+                            st.write(f"📊 **Estado:** {orden['estado']}")
+                            st.write(f"🚚 **Entrega:** {orden['fecha_entrega']}")
+                            st.write(f"🎯 **Tracking:** {orden['tracking_id']}")
+                            
+                            # Mostrar técnico solo si la orden está en proceso o estados posteriores
+                            if orden['estado'] in ['En Proceso', 'Empacada', 'En Transporte', 'Entregada']:
+                                if orden['tecnico_asignado']:
+                                    st.write(f"👨‍🔧 **Técnico:** {orden['tecnico_asignado']}")
+                                else:
+                                    st.write("👨‍🔧 **Técnico:** Por asignar")
+                            
+                        # Observaciones si existen
+                        if orden['observaciones']:
+                            st.write(f"📝 **Observaciones:** {orden['observaciones']}")
+            else:
+                st.info("📭 No tienes órdenes registradas")
         else:
-            st.info("📭 No tienes órdenes registradas")
-    else:
-        st.error("❌ Doctor no encontrado en el sistema")
-    
-    conn.close()
+            st.error("❌ Tu usuario no está vinculado a ningún doctor; pide al administrador que lo revise")
+        
 
 def show_technician_orders():
     st.markdown("## 🔧 Mis Órdenes Asignadas")
     
     user_data = st.session_state.user_data
     
-    conn = sqlite3.connect('glab.db')
-    df_ordenes = pd.read_sql_query("""
-        SELECT o.*, d.nombre as doctor_nombre 
-        FROM ordenes o 
-        LEFT JOIN doctores d ON o.doctor_id = d.id 
-        WHERE o.tecnico_asignado = ?
-        ORDER BY o.fecha_ingreso DESC
-    """, conn, params=(user_data['nombre'],))
-    conn.close()
+    with get_connection() as conn:
+        df_ordenes = pd.read_sql_query("""
+            SELECT o.*, d.nombre as doctor_nombre 
+            FROM ordenes o 
+            LEFT JOIN doctores d ON o.doctor_id = d.id 
+            WHERE o.tecnico_id = ?
+            ORDER BY o.fecha_ingreso DESC
+        """, conn, params=(user_data['id'],))
     
     if not df_ordenes.empty:
         for _, orden in df_ordenes.iterrows():
+            version = seen_order_version(orden)
             with st.expander(f"🔧 {orden['numero_orden']} - {orden['paciente']} ({orden['estado']})"):
                 col1, col2 = st.columns(2)
                 
@@ -2289,29 +3869,41 @@ def show_technician_orders():
                 # Cambiar estado de la orden
                 if orden['estado'] in ['Creada', 'En Proceso']:
                     if st.button(f"✅ Marcar como Empacada", key=f"pack_{orden['id']}"):
-                        update_order_status(orden['id'], 'Empacada')
-                        st.success("Orden marcada como empacada")
-                        st.rerun()
+                        if update_order_status(orden['id'], 'Empacada', version, user_data['id']):
+                            st.success("Orden marcada como empacada")
+                            st.rerun()
+                        else:
+                            show_order_conflict(orden['id'], version)
     else:
         st.info("🔧 No tienes órdenes asignadas")
 
+# Entregas del mensajero: las suyas más las empacadas sin tomar, cada parte por su propio índice
+# (un OR en el WHERE obliga a recorrer todas las órdenes)
+MESSENGER_DELIVERIES_SQL = """
+    SELECT o.*, d.nombre as doctor_nombre
+    FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id
+    WHERE o.mensajero_id = :mensajero_id
+    UNION ALL
+    SELECT o.*, d.nombre as doctor_nombre
+    FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id
+    WHERE o.estado = 'Empacada' AND o.mensajero_id IS NOT :mensajero_id
+    ORDER BY fecha_ingreso DESC
+"""
+
+HOT_QUERIES['entregas_mensajero'] = (MESSENGER_DELIVERIES_SQL, {'mensajero_id': 6})
+
 def show_messenger_deliveries():
     st.markdown("## 🚚 Mis Entregas")
     
     user_data = st.session_state.user_data
     
-    conn = sqlite3.connect('glab.db')
-    df_entregas = pd.read_sql_query("""
-        SELECT o.*, d.nombre as doctor_nombre 
-        FROM ordenes o 
-        LEFT JOIN doctores d ON o.doctor_id = d.id 
-        WHERE o.mensajero = ? OR o.estado = 'Empacada'
-        ORDER BY o.fecha_ingreso DESC
-    """, conn, params=(user_data['nombre'],))
-    conn.close()
+    with get_connection() as conn:
+        df_entregas = pd.read_sql_query(MESSENGER_DELIVERIES_SQL, conn,
+                                        params={'mensajero_id': user_data['id']})
     
     if not df_entregas.empty:
         for _, orden in df_entregas.iterrows():
+            version = seen_order_version(orden)
             with st.expander(f"🚚 {orden['numero_orden']} - {orden['paciente']} ({orden['estado']})"):
                 col1, col2 = st.columns(2)
                 
@@ -2328,29 +3920,42 @@ def show_messenger_deliveries():
                 # Acciones del mensajero
                 if orden['estado'] == 'Empacada':
                     if st.button(f"🚚 Tomar Entrega", key=f"take_{orden['id']}"):
-                        take_delivery(orden['id'], user_data['nombre'])
-                        st.success("Entrega tomada")
-                        st.rerun()
+                        if take_delivery(orden['id'], user_data['id'], version):
+                            st.success("Entrega tomada")
+                            st.rerun()
+                        else:
+                            show_order_conflict(orden['id'], version)
                 
-                elif orden['estado'] == 'En Transporte' and orden['mensajero'] == user_data['nombre']:
+                elif orden['estado'] == 'En Transporte' and orden['mensajero_id'] == user_data['id']:
                     if st.button(f"✅ Marcar como Entregada", key=f"deliver_{orden['id']}"):
-                        update_order_status(orden['id'], 'Entregada')
-                        st.success("Orden entregada")
-                        st.rerun()
+                        if update_order_status(orden['id'], 'Entregada', version, user_data['id']):
+                            st.success("Orden entregada")
+                            st.rerun()
+                        else:
+                            show_order_conflict(orden['id'], version)
     else:
         st.info("🚚 No hay entregas disponibles")
 
-def take_delivery(order_id, messenger_name):
-    conn = sqlite3.connect('glab.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE ordenes SET estado = ?, mensajero = ? WHERE id = ?', 
-                  ('En Transporte', messenger_name, order_id))
-    conn.commit()
-    conn.close()
+def take_delivery(order_id, messenger_id, version):
+    # Solo Empacada -> En Transporte: de varios mensajeros a la vez, gana exactamente uno
+    return compare_and_set_order(order_id, version,
+                                 "estado = 'En Transporte', mensajero_id = ?, "
+                                 "mensajero = (SELECT nombre FROM usuarios WHERE id = ?)",
+                                 (messenger_id, messenger_id), allowed_sources('En Transporte'))
 
 # Función principal
 def main():
-    # Inicializar base de datos
+    # Configuración de la página. Va aquí y no al nivel del módulo: los procesos de la exportación
+    # (spawn) vuelven a importar este script como __mp_main__ y no deben llamar a Streamlit
+    st.set_page_config(
+        page_title="G-LAB - Mónica Riano Laboratorio Dental",
+        page_icon="🦷",
+        layout="wide",
+        initial_sidebar_state="collapsed"
+    )
+    load_css()
+    
+    # Verificar el esquema (solo la primera vez en el proceso)
     init_database()
     
     # Verificar si el usuario está logueado
@@ -2363,5 +3968,9 @@ def main():
         main_app()
 
 if __name__ == "__main__":
-    main()
+    if '--bootstrap' in sys.argv[1:]:
+        bootstrap_database()
+        print("✅ Base de datos inicializada con datos de ejemplo")
+    else:
+        main()
 
@@ -0,0 +1,911 @@
+"""Benchmarks de rendimiento de G-LAB
+
+Uso:
+    python benchmark.py pool [--orders 20000] [--threads 4] [--seconds 5]
+    python benchmark.py plans [--orders 1000000]
+    python benchmark.py tracking [--sizes 10000,100000,1000000]
+    python benchmark.py allocator [--threads 16] [--orders 200] [--tracking-length 3]
+    python benchmark.py pdf [--orders 300]
+    python benchmark.py export [--orders 2000] [--workers 1,2,4]
+    python benchmark.py report [--technicians 100] [--orders 1000000] [--detail-rows 5000,50000]
+    python benchmark.py startup [--script app.py]
+    python benchmark.py events [--events 2000000]
+    python benchmark.py contention [--threads 16] [--orders 200]
+    python benchmark.py inventory [--threads 16] [--withdrawals 200] [--items 5000]
+    python benchmark.py materials [--orders 5000]
+    python benchmark.py forecast [--items 5000]
+    python benchmark.py lots [--items 1000] [--months 60]
+
+Cada benchmark crea su propia base de datos temporal con datos sintéticos,
+nunca toca glab.db.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ESTADOS = ['Creada', 'En Proceso', 'Empacada', 'En Transporte', 'Entregada']
+TECNICOS = ['Carlos López', 'María García', 'Pedro Martínez']
+TRABAJOS = ['Corona Metal-Cerámica', 'Puente 3 Unidades', 'Prótesis Total', 'Carillas de Porcelana', 'Blanqueamiento']
+
+
+def load_app(db_path):
+    """Importar app.py apuntando a la base de datos del benchmark"""
+    os.environ['GLAB_DB_PATH'] = db_path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    app.init_database()
+    app.bootstrap_database()
+    return app
+
+
+def populate_orders(conn, total, doctors=5, batch=50000, tecnicos=TECNICOS):
+    """Insertar órdenes sintéticas repartidas en los últimos dos años"""
+    rng = random.Random(42)
+    start = datetime.now() - timedelta(days=730)
+    cursor = conn.cursor()
+    base = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM ordenes').fetchone()[0]
+    tecnico_ids = dict(cursor.execute("SELECT nombre, id FROM usuarios WHERE rol = 'Técnico'").fetchall())
+    for offset in range(0, total, batch):
+        rows = []
+        for i in range(base + offset + 1, base + min(offset + batch, total) + 1):
+            fecha = start + timedelta(minutes=rng.randrange(730 * 24 * 60))
+            tecnico = rng.choice(tecnicos)
+            rows.append((f"BENCH-{i:07d}", rng.randint(1, doctors), f"Paciente {i}", rng.choice(TRABAJOS),
+                         rng.randrange(100000, 1000000, 1000), rng.choice(ESTADOS),
+                         fecha.strftime('%Y-%m-%d %H:%M:%S'), (fecha + timedelta(days=7)).strftime('%Y-%m-%d'),
+                         tecnico, tecnico_ids.get(tecnico), f"Observación {i}", f"bench{i:07d}"))
+        cursor.executemany('''
+            INSERT INTO ordenes (numero_orden, doctor_id, paciente, trabajo, precio, estado,
+                                 fecha_ingreso, fecha_entrega, tecnico_asignado, tecnico_id, observaciones, tracking_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+
+
+def populate_inventory(conn, total):
+    """Insertar materiales sintéticos en el inventario"""
+    rng = random.Random(7)
+    conn.executemany(
+        'INSERT INTO inventario (nombre, categoria, cantidad, precio_unitario, proveedor, fecha_vencimiento, stock_minimo) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(f"Material {i:05d}", 'Materiales', rng.randint(0, 200), rng.randrange(1000, 90000, 500),
+          f"Proveedor {i % 40}", f"{rng.randint(2025, 2029)}-{rng.randint(1, 12):02d}-28", rng.randint(5, 30))
+         for i in range(total)])
+    conn.commit()
+
+
+def run_threads(worker, threads, seconds):
+    """Ejecutar worker en varios hilos durante N segundos y contar iteraciones"""
+    done = [0] * threads
+    errors = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def loop(slot):
+        rng = random.Random(slot)
+        while time.perf_counter() < deadline:
+            try:
+                worker(rng)
+                done[slot] += 1
+            except sqlite3.OperationalError:
+                errors[slot] += 1
+
+    pool = [threading.Thread(target=loop, args=(slot,)) for slot in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(done) / seconds, sum(errors)
+
+
+# Consultas que hace un rerun típico del dashboard (más una escritura)
+RERUN_QUERIES = [
+    ("SELECT * FROM usuarios WHERE username = ? AND activo = 1", ('admin',)),
+    ("SELECT COUNT(*) FROM ordenes", ()),
+    ("SELECT COUNT(*) FROM inventario WHERE cantidad <= stock_minimo", ()),
+    ("SELECT estado, COUNT(*) FROM ordenes GROUP BY estado", ()),
+    ("SELECT * FROM ordenes ORDER BY id DESC LIMIT 20", ()),
+]
+
+
+def bench_pool(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'pooled.db'))
+    with app.get_connection() as conn:
+        populate_orders(conn, args.orders)
+        total = conn.execute('SELECT MAX(id) FROM ordenes').fetchone()[0]
+
+    # Copia con el modo de journal por defecto para medir el esquema anterior
+    legacy_path = os.path.join(tmp, 'legacy.db')
+    with app.get_connection() as conn:
+        conn.execute('VACUUM INTO ?', (legacy_path,))
+    legacy = sqlite3.connect(legacy_path)
+    legacy.execute('PRAGMA journal_mode=DELETE')
+    legacy.close()
+
+    def legacy_rerun(rng):
+        for sql, params in RERUN_QUERIES:
+            conn = sqlite3.connect(legacy_path)
+            conn.execute(sql, params).fetchall()
+            conn.close()
+        conn = sqlite3.connect(legacy_path)
+        conn.execute('UPDATE ordenes SET ubicacion_actual = ? WHERE id = ?', ('bench', rng.randint(1, total)))
+        conn.commit()
+        conn.close()
+
+    def pooled_rerun(rng):
+        for sql, params in RERUN_QUERIES:
+            with app.get_connection() as conn:
+                conn.execute(sql, params).fetchall()
+        with app.get_connection() as conn:
+            conn.execute('UPDATE ordenes SET ubicacion_actual = ? WHERE id = ?', ('bench', rng.randint(1, total)))
+
+    for name, worker in (('connect() por consulta', legacy_rerun), ('pool + WAL', pooled_rerun)):
+        rate, errors = run_threads(worker, args.threads, args.seconds)
+        print(f"{name:<24} {rate:10.1f} reruns/s  ({errors} errores 'database is locked')")
+
+
+def full_table_scans(conn, queries):
+    """Consultas cuyo plan recorre una tabla completa.
+
+    Un SCAN con USING INDEX también lee todas las filas (solo cambia el orden): se acepta únicamente
+    si el índice es cubriente o si la consulta termina en LIMIT.
+    """
+    problems = []
+    for name, (sql, params) in queries.items():
+        acotada = re.search(r'\bLIMIT\s+(\?|\d+)\s*$', sql, re.IGNORECASE)
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[3]
+            # SCAN (subquery-N) recorre un resultado intermedio ya filtrado, no una tabla
+            if not detail.startswith('SCAN ') or detail.startswith('SCAN (subquery'):
+                continue
+            if 'COVERING INDEX' in detail or 'VIRTUAL TABLE' in detail or acotada:
+                continue
+            problems.append((name, detail))
+    return problems
+
+
+def bench_plans(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'plans.db'))
+    with app.get_connection() as conn:
+        populate_orders(conn, args.orders)
+        populate_inventory(conn, args.items)
+        conn.execute('ANALYZE')
+
+        problems = full_table_scans(conn, app.HOT_QUERIES)
+        for name, (sql, params) in app.HOT_QUERIES.items():
+            start = time.perf_counter()
+            conn.execute(sql, params).fetchmany(50)
+            elapsed = (time.perf_counter() - start) * 1000
+            status = 'SCAN' if any(p[0] == name for p in problems) else 'ok'
+            print(f"{name:<28} {elapsed:9.2f} ms  {status}")
+
+    for name, detail in problems:
+        print(f"✗ {name}: {detail}")
+    if problems:
+        sys.exit(1)
+    print(f"✓ {len(app.HOT_QUERIES)} consultas frecuentes usan índices con {args.orders:,} órdenes")
+
+
+def time_lookups(conn, sql, params_list):
+    start = time.perf_counter()
+    for params in params_list:
+        conn.execute(sql, params).fetchall()
+    return (time.perf_counter() - start) / len(params_list) * 1e6
+
+
+def bench_tracking(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'tracking.db'))
+    sql_exacto = app.HOT_QUERIES['tracking_exacto'][0]
+    sql_prefijo = app.HOT_QUERIES['tracking_prefijo'][0]
+    sql_anterior = ("SELECT o.*, d.nombre as doctor_nombre FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id "
+                    "WHERE o.tracking_id LIKE ?")
+    rng = random.Random(3)
+
+    print(f"{'órdenes':>10} {'exacto':>12} {'prefijo':>12} {'LIKE %x%':>12}")
+    with app.get_connection() as conn:
+        total = 0
+        for size in args.sizes:
+            populate_orders(conn, size - total)
+            total = size
+            conn.execute('ANALYZE')
+            ids = [row[0] for row in conn.execute(
+                'SELECT tracking_id FROM ordenes WHERE id IN (%s)' % ','.join(
+                    str(rng.randint(1, total)) for _ in range(args.lookups)))]
+            exacto = time_lookups(conn, sql_exacto, [(t,) for t in ids])
+            prefijo = time_lookups(conn, sql_prefijo, [(t[:-2], t[:-2] + '\uffff', 11) for t in ids])
+            anterior = time_lookups(conn, sql_anterior, [(f"%{t}%",) for t in ids[:args.legacy_lookups]])
+            print(f"{total:>10,} {exacto:>9.1f} µs {prefijo:>9.1f} µs {anterior:>9.1f} µs")
+
+
+def bench_allocator(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'allocator.db'))
+    # Un alfabeto pequeño fuerza colisiones de tracking ID para ejercitar los reintentos
+    if args.tracking_length:
+        app.TRACKING_LENGTH = args.tracking_length
+    with app.get_connection() as conn:
+        inicial = conn.execute('SELECT COUNT(*) FROM ordenes').fetchone()[0]
+        tecnico_ids = [row[0] for row in conn.execute("SELECT id FROM usuarios WHERE rol = 'Técnico'")]
+    failures = []
+    barrier = threading.Barrier(args.threads)
+
+    def worker(slot):
+        barrier.wait()
+        for i in range(args.orders):
+            try:
+                with app.get_connection() as conn:
+                    app.insert_order(conn, 1, f"Paciente {slot}-{i}", TRABAJOS[i % len(TRABAJOS)], 1, 100000,
+                                     '2030-01-01', '', tecnico_ids[slot % len(tecnico_ids)])
+            except Exception as e:
+                failures.append(f"hilo {slot}: {e}")
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(slot,)) for slot in range(args.threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    esperadas = args.threads * args.orders
+    with app.get_connection() as conn:
+        total, numeros, trackings = conn.execute(
+            'SELECT COUNT(*), COUNT(DISTINCT numero_orden), COUNT(DISTINCT upper(tracking_id)) FROM ordenes'
+        ).fetchone()
+        secuencia = conn.execute("SELECT valor FROM secuencias WHERE nombre = 'orden'").fetchone()[0]
+
+    print(f"{esperadas:,} órdenes desde {args.threads} hilos en {elapsed:.2f} s ({esperadas / elapsed:.0f} órdenes/s)")
+    problems = failures[:5]
+    if total - inicial != esperadas:
+        problems.append(f"se esperaban {esperadas} órdenes nuevas, hay {total - inicial}")
+    if numeros != total or trackings != total:
+        problems.append(f"duplicados: {total} órdenes, {numeros} números, {trackings} tracking IDs")
+    if secuencia != total:
+        problems.append(f"la secuencia quedó en {secuencia} con {total} órdenes")
+    for problem in problems:
+        print(f"✗ {problem}")
+    if problems:
+        sys.exit(1)
+    print("✓ números de orden consecutivos y tracking IDs únicos")
+
+
+def load_order_dicts(conn, limit):
+    """Datos de orden tal como los recibe generate_order_pdf"""
+    rows = conn.execute('''
+        SELECT o.numero_orden, d.nombre, d.clinica, o.paciente, o.trabajo, o.precio, o.observaciones, o.tracking_id
+        FROM ordenes o LEFT JOIN doctores d ON o.doctor_id = d.id
+        ORDER BY o.id LIMIT ?
+    ''', (limit,)).fetchall()
+    keys = ('numero_orden', 'doctor', 'clinica', 'paciente', 'trabajo', 'precio', 'observaciones', 'tracking_id')
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def bench_pdf(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'pdf.db'))
+    with app.get_connection() as conn:
+        populate_orders(conn, args.orders)
+        orders = load_order_dicts(conn, args.orders)
+
+    from io import BytesIO
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    import order_pdf
+
+    def redraw(order):
+        # Formulario completo dibujado en cada PDF (comportamiento anterior)
+        c = canvas.Canvas(BytesIO(), pagesize=letter)
+        order_pdf._draw_order_form(c, *letter)
+        order_pdf._draw_order_fields(c, order, *letter)
+        c.save()
+
+    order_pdf.PDF_CACHE_DIR = os.path.join(tmp, 'pdf_cache')
+    passes = (('formulario redibujado', redraw, True), ('plantilla XObject', order_pdf.generate_order_pdf, True),
+              ('reimpresión (QR en caché)', order_pdf.generate_order_pdf, False),
+              ('caché en disco (vacía)', order_pdf.get_order_pdf, False), ('caché en disco (llena)', order_pdf.get_order_pdf, False))
+    for name, render, cold in passes:
+        if cold:
+            order_pdf.generate_qr_png.cache_clear()
+        start = time.perf_counter()
+        for order in orders:
+            render(order)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<28} {len(orders) / elapsed:8.1f} PDFs/s")
+
+    # La plantilla depende de internos de reportlab: si no están, los PDF salen bien pero más lentos
+    if not order_pdf.get_order_form_template(letter).disponible:
+        print("✗ la plantilla XObject no está disponible con esta versión de reportlab")
+        sys.exit(1)
+
+
+def bench_export(args):
+    import order_pdf
+
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'export.db'))
+    with app.get_connection() as conn:
+        populate_orders(conn, args.orders)
+
+    print(f"{os.cpu_count()} núcleos disponibles")
+    base = None
+    for workers in args.workers:
+        # Cada pasada parte de una caché de PDFs vacía dentro del directorio temporal; los procesos
+        # del pool leen la ruta de GLAB_PDF_CACHE_DIR
+        order_pdf.PDF_CACHE_DIR = os.environ['GLAB_PDF_CACHE_DIR'] = os.path.join(tmp, f"pdf_cache_{workers}")
+        order_pdf.generate_qr_png.cache_clear()
+        destino = os.path.join(tmp, f"ordenes_{workers}.zip")
+        start = time.perf_counter()
+        with app.get_connection() as conn, open(destino, 'wb') as archivo:
+            total = app.export_orders_zip(app.iter_orders_for_export(conn, {}), archivo, workers=workers)
+        rate = total / (time.perf_counter() - start)
+        base = base or rate
+        print(f"{workers:>2} procesos {rate:8.1f} PDFs/s  (x{rate / base:.2f})  "
+              f"{os.path.getsize(destino) / 1e6:.1f} MB")
+
+
+def bench_report(args):
+    import tracemalloc
+
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'report.db'))
+    tecnicos = [f"Técnico {i:03d}" for i in range(args.technicians)]
+    with app.get_connection() as conn:
+        populate_orders(conn, args.orders, tecnicos=tecnicos)
+        conn.execute('ANALYZE')
+
+        start = time.perf_counter()
+        filas = conn.execute(app.TECHNICIANS_REPORT_SQL, app.ORDER_STATES).fetchall()
+        print(f"consulta agregada: {len(filas)} técnicos, {args.orders:,} órdenes en "
+              f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        pdf = app.generate_technicians_report_pdf(conn).getvalue()
+        print(f"reporte resumen:   {(time.perf_counter() - start) * 1000:.0f} ms, {len(pdf) / 1e3:.0f} KB")
+
+        # Detalle por orden: el canvas guarda cada página hasta save(), así que el pico de memoria
+        # crece con el número de filas; se mide para vigilar cuánto
+        for rows in args.detail_rows:
+            sql = app.TECHNICIANS_DETAIL_SQL
+            app.TECHNICIANS_DETAIL_SQL = f"{sql} LIMIT {rows}"
+            destino = os.path.join(tmp, f"detalle_{rows}.pdf")
+            tracemalloc.start()
+            start = time.perf_counter()
+            with open(destino, 'wb') as archivo:
+                app.generate_technicians_report_pdf(conn, detalle=True, destino=archivo)
+            elapsed = time.perf_counter() - start
+            _, pico = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            app.TECHNICIANS_DETAIL_SQL = sql
+            print(f"detalle {rows:>8,} filas: {rows / elapsed:8.0f} filas/s, pico {pico / 1e6:6.1f} MB, "
+                  f"PDF {os.path.getsize(destino) / 1e6:.1f} MB")
+
+
+def bench_events(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'events.db'))
+    rng = random.Random(11)
+    with app.get_connection() as conn:
+        populate_orders(conn, args.events // len(ESTADOS))
+        # Se descartan los eventos de alta de populate_orders: cada orden recorre todos los estados
+        conn.execute('DELETE FROM ordenes_eventos')
+        conn.execute('DELETE FROM ordenes_etapas')
+        conn.commit()
+        tecnico_ids = [row[0] for row in conn.execute("SELECT id FROM usuarios WHERE rol = 'Técnico'")]
+        ordenes = conn.execute('SELECT id, fecha_ingreso FROM ordenes').fetchall()
+
+        total = 0
+        start = time.perf_counter()
+        for offset in range(0, len(ordenes), 50000):
+            eventos = []
+            for orden_id, fecha in ordenes[offset:offset + 50000]:
+                momento = datetime.strptime(fecha, '%Y-%m-%d %H:%M:%S')
+                tecnico = rng.choice(tecnico_ids)
+                for estado in ESTADOS:
+                    eventos.append((orden_id, 'estado', estado, tecnico, momento.strftime('%Y-%m-%d %H:%M:%S')))
+                    momento += timedelta(hours=rng.expovariate(1 / 24))
+            conn.executemany('INSERT INTO ordenes_eventos (orden_id, tipo, valor, tecnico_id, fecha) '
+                             'VALUES (?, ?, ?, ?, ?)', eventos)
+            conn.commit()
+            total += len(eventos)
+        elapsed = time.perf_counter() - start
+        print(f"{total:,} eventos en {elapsed:.1f} s ({total / elapsed:,.0f} eventos/s, etapas cerradas por trigger)")
+        conn.execute('ANALYZE')
+
+        for agrupacion, columna in app.STAGE_GROUPS.items():
+            sql = app.stage_percentiles_sql(columna)
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+            start = time.perf_counter()
+            grupos = conn.execute(sql).fetchall()
+            elapsed = (time.perf_counter() - start) * 1000
+            indice = next((p for p in plan if 'COVERING INDEX' in p), 'SIN ÍNDICE')
+            orden = 'ordena en memoria' if any('FOR ORDER BY' in p for p in plan) else 'sin ordenar'
+            print(f"p50/p95 por {agrupacion.lower():<8} {len(grupos):>4} grupos en {elapsed:8.0f} ms  ({indice}, {orden})")
+
+
+def bench_contention(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'contention.db'))
+    ordenes = []
+    for i in range(args.orders):
+        with app.get_connection() as conn:
+            ordenes.append(app.insert_order(conn, 1, f"Contención {i}", TRABAJOS[0], 1, 100000, '2030-01-01', '', None))
+    with app.get_connection() as conn:
+        conn.execute(f"UPDATE ordenes SET estado = 'Empacada', version = version + 1 "
+                     f"WHERE id IN ({','.join('?' * len(ordenes))})", ordenes)
+        mensajeros = [row[0] for row in conn.execute("SELECT id FROM usuarios WHERE rol = 'Mensajero'")]
+        versiones = dict(conn.execute(f"SELECT id, version FROM ordenes WHERE id IN ({','.join('?' * len(ordenes))})",
+                                      ordenes).fetchall())
+
+    # Todos los hilos leyeron la misma versión y pulsan "Tomar Entrega" a la vez en cada orden
+    ganadores = {orden_id: [] for orden_id in ordenes}
+    failures = []
+    barrier = threading.Barrier(args.threads)
+
+    def worker(slot):
+        for orden_id in ordenes:
+            barrier.wait()
+            try:
+                if app.take_delivery(orden_id, mensajeros[slot % len(mensajeros)], versiones[orden_id]):
+                    ganadores[orden_id].append(slot)
+            except Exception as e:
+                failures.append(f"hilo {slot}: {e}")
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(slot,)) for slot in range(args.threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with app.get_connection() as conn:
+        finales = {row[0]: row[1:] for row in conn.execute(
+            f"SELECT id, estado, version FROM ordenes WHERE id IN ({','.join('?' * len(ordenes))})", ordenes)}
+    for orden_id, hilos in ganadores.items():
+        if len(hilos) != 1:
+            failures.append(f"orden {orden_id}: {len(hilos)} ganadores")
+        if finales[orden_id] != ('En Transporte', versiones[orden_id] + 1):
+            failures.append(f"orden {orden_id}: quedó {finales[orden_id]}")
+
+    intentos = args.threads * len(ordenes)
+    print(f"{intentos:,} intentos sobre {len(ordenes)} órdenes desde {args.threads} hilos en {elapsed:.2f} s "
+          f"({intentos / elapsed:,.0f} intentos/s)")
+    for failure in failures[:20]:
+        print(f"✗ {failure}")
+    if failures:
+        sys.exit(1)
+    print("✓ exactamente un ganador por orden, sin escrituras perdidas")
+
+
+def bench_inventory(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'inventory.db'))
+    with app.get_connection() as conn:
+        item_id = conn.execute("SELECT id FROM inventario ORDER BY id LIMIT 1").fetchone()[0]
+        inicial = args.threads * args.withdrawals
+        app.apply_inventory_movement(item_id, 'ajuste', inicial)
+    failures = []
+    barrier = threading.Barrier(args.threads)
+
+    # Muchos técnicos descuentan material del mismo item a la vez: no se debe perder ningún consumo
+    def worker(slot):
+        barrier.wait()
+        for i in range(args.withdrawals):
+            try:
+                if not app.apply_inventory_movement(item_id, 'consumo', 1, f"hilo {slot}"):
+                    failures.append(f"hilo {slot}: sin stock en el consumo {i}")
+            except Exception as e:
+                failures.append(f"hilo {slot}: {e}")
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(slot,)) for slot in range(args.threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    print(f"{inicial:,} consumos desde {args.threads} hilos en {elapsed:.2f} s ({inicial / elapsed:,.0f} consumos/s)")
+
+    with app.get_connection() as conn:
+        saldo = conn.execute('SELECT cantidad FROM inventario WHERE id = ?', (item_id,)).fetchone()[0]
+        if saldo != 0:
+            failures.append(f"saldo final {saldo}, esperado 0")
+        # Una entrega de proveedor con una línea por item, aplicada en una sola transacción
+        populate_inventory(conn, args.items)
+        nombres = [row[0] for row in conn.execute('SELECT nombre FROM inventario')]
+    # La entrega llega como CSV, primero sin las columnas opcionales de lote y vencimiento
+    csv = "nombre,cantidad\n" + "".join(f"{nombre},10\n" for nombre in nombres)
+    start = time.perf_counter()
+    faltantes = app.import_supplier_delivery(app.parse_supplier_delivery(io.StringIO(csv)), 'Entrega benchmark')
+    elapsed = time.perf_counter() - start
+    if faltantes:
+        failures.append(f"items no encontrados: {faltantes[:5]}")
+    print(f"entrega de {len(nombres):,} líneas en {elapsed * 1000:.0f} ms")
+
+    csv = "nombre,cantidad,lote,vencimiento\n" + "".join(
+        f"{nombre},5,L-{i},2030-01-{i % 28 + 1:02d}\n" for i, nombre in enumerate(nombres[:100]))
+    faltantes = app.import_supplier_delivery(app.parse_supplier_delivery(io.StringIO(csv)), 'Entrega con lotes')
+    if faltantes:
+        failures.append(f"items no encontrados en la entrega con lotes: {faltantes[:5]}")
+    with app.get_connection() as conn:
+        con_lote = conn.execute("""
+            SELECT COUNT(*) FROM inventario_lotes
+            WHERE lote LIKE 'L-%' AND fecha_vencimiento LIKE '2030-01-%' AND inicial = 5
+        """).fetchone()[0]
+    if con_lote != min(100, len(nombres)):
+        failures.append(f"entrega con lotes: {con_lote} lotes creados, esperados {min(100, len(nombres))}")
+
+    with app.get_connection() as conn:
+        # populate_inventory inserta saldos sin movimientos: solo se revisan los items de ejemplo
+        diferencias = app.inventory_ledger_differences(conn)
+        diferencias = diferencias[~diferencias['nombre'].str.startswith('Material ')]
+    if not diferencias.empty:
+        failures.append(f"{len(diferencias)} items no cuadran con el libro")
+    for failure in failures[:20]:
+        print(f"✗ {failure}")
+    if failures:
+        sys.exit(1)
+    print("✓ ningún consumo perdido y el stock cuadra con el libro de movimientos")
+
+
+def bench_materials(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'materials.db'))
+    rng = random.Random(3)
+    muestra = 10
+    with app.get_connection() as conn:
+        servicios = [row[0] for row in conn.execute(
+            'SELECT DISTINCT s.nombre FROM servicios s JOIN servicios_materiales b ON b.servicio_id = s.id')]
+        conn.executemany('''
+            INSERT INTO ordenes (numero_orden, doctor_id, paciente, trabajo, cantidad, precio, estado, tracking_id)
+            VALUES (?, 1, ?, ?, ?, 100000, 'Creada', ?)
+        ''', [(f"MAT-{i:06d}", f"Paciente {i}", rng.choice(servicios), rng.randint(1, 3), f"mat{i:06d}")
+              for i in range(muestra + args.orders)])
+        # Stock suficiente para que ningún consumo deje saldo negativo
+        app.record_inventory_movements(conn.cursor(), [(item_id, 'entrada', 10 * args.orders, 'Stock benchmark')
+                                                       for item_id, in conn.execute('SELECT id FROM inventario').fetchall()])
+        ordenes = conn.execute("SELECT id, version FROM ordenes WHERE numero_orden LIKE 'MAT-%' ORDER BY id").fetchall()
+        stock = dict(conn.execute('SELECT id, cantidad FROM inventario').fetchall())
+
+    # Un solo hilo reutiliza siempre la misma conexión del pool. El trace también se llama por cada
+    # sentencia de un trigger (con el texto de la sentencia que lo disparó), así que se cuentan las
+    # sentencias distintas consecutivas. Solo se traza la muestra: expandir los parámetros en cada
+    # llamada del trace costaría más que el propio cambio de estado.
+    sentencias = []
+    pool = app.get_connection_pool(app.DB_PATH, app.DB_POOL_SIZE)
+    conexion = pool.acquire()
+    pool.release(conexion)
+
+    failures = []
+    for estado in ('En Proceso', 'Empacada'):
+        sentencias.clear()
+        conexion.set_trace_callback(lambda sql: None if sentencias and sentencias[-1] == sql else sentencias.append(sql))
+        app.update_orders_status(ordenes[:muestra], estado)
+        conexion.set_trace_callback(None)
+        start = time.perf_counter()
+        cambiadas = app.update_orders_status(ordenes[muestra:], estado)
+        elapsed = time.perf_counter() - start
+        print(f"{len(cambiadas):,} órdenes a {estado} en {elapsed * 1000:.0f} ms "
+              f"({len(sentencias)} sentencias para un lote de {muestra})")
+        if len(cambiadas) != args.orders:
+            failures.append(f"{estado}: cambiaron {len(cambiadas)} de {args.orders} órdenes")
+        ordenes = [(order_id, version + 1) for order_id, version in ordenes]
+
+    with app.get_connection() as conn:
+        esperado = dict(conn.execute('''
+            SELECT b.item_id, SUM(b.cantidad * o.cantidad) FROM ordenes o
+            JOIN servicios s ON s.nombre = o.trabajo
+            JOIN servicios_materiales b ON b.servicio_id = s.id
+            WHERE o.numero_orden LIKE 'MAT-%' GROUP BY b.item_id
+        ''').fetchall())
+        for item_id, cantidad, reservado in conn.execute('SELECT id, cantidad, reservado FROM inventario').fetchall():
+            if stock[item_id] - cantidad != esperado.get(item_id, 0):
+                failures.append(f"item {item_id}: se descontaron {stock[item_id] - cantidad}, esperado {esperado.get(item_id, 0)}")
+            if reservado:
+                failures.append(f"item {item_id}: quedan {reservado} reservados tras el consumo")
+        if not app.inventory_ledger_differences(conn).empty:
+            failures.append("el stock no cuadra con el libro de movimientos")
+    for failure in failures[:20]:
+        print(f"✗ {failure}")
+    if failures:
+        sys.exit(1)
+    print("✓ el consumo coincide con la lista de materiales y el stock cuadra con el libro")
+
+
+def bench_forecast(args):
+    import numpy as np
+
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'forecast.db'))
+    dias = app.FORECAST_WEEKS * 7
+    hoy = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+    rng = np.random.default_rng(11)
+    with app.get_connection() as conn:
+        populate_inventory(conn, args.items)
+        ids = [row[0] for row in conn.execute('SELECT id FROM inventario ORDER BY id')]
+        # Consumo de Poisson con tasa propia por item y sin consumos los domingos
+        tasas = rng.gamma(1.5, 2.0, len(ids))
+        for atras in range(1, dias + 1):
+            fecha = hoy - timedelta(days=atras)
+            if fecha.weekday() == 6:
+                continue
+            cantidades = rng.poisson(tasas)
+            conn.executemany(
+                "INSERT INTO inventario_movimientos (item_id, tipo, cantidad, referencia, fecha) "
+                "VALUES (?, 'consumo', ?, 'benchmark', ?)",
+                [(item_id, -int(cantidad), fecha.strftime('%Y-%m-%d %H:%M:%S'))
+                 for item_id, cantidad in zip(ids, cantidades) if cantidad])
+        movimientos = conn.execute("SELECT COUNT(*) FROM inventario_movimientos WHERE tipo = 'consumo'").fetchone()[0]
+        df_inventario = app.pd.read_sql_query('SELECT id, nombre, cantidad, reservado, stock_minimo FROM inventario', conn)
+    print(f"{len(ids):,} items y {movimientos:,} consumos en {app.FORECAST_WEEKS} semanas")
+
+    # Solo el motor vectorizado: ajuste y reorden sobre la matriz items × días ya armada
+    serie = rng.poisson(np.repeat(tasas[:, None], dias, axis=1)).astype(float)
+    start = time.perf_counter()
+    nivel, indice, sigma = app.fit_demand(serie)
+    app.plan_reorders(nivel, indice, sigma, rng.integers(0, 500, len(ids)).astype(float),
+                      np.zeros(len(ids)), np.full(len(ids), 10.0))
+    motor = time.perf_counter() - start
+    print(f"ajuste y reorden de {len(ids):,} items: {motor * 1000:.0f} ms")
+
+    # Camino completo sin caché: serie desde el libro, ajuste y reorden contra el stock actual
+    app.get_demand_model.clear()
+    start = time.perf_counter()
+    df_pronostico = app.get_inventory_forecast(df_inventario)
+    print(f"pronóstico desde la base de datos: {(time.perf_counter() - start) * 1000:.0f} ms")
+    start = time.perf_counter()
+    app.get_inventory_forecast(df_inventario)
+    print(f"pronóstico con el ajuste en caché: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    error = np.abs(df_pronostico['consumo_diario'].to_numpy() - tasas * 6 / 7).mean()
+    print(f"error medio del consumo diario estimado: {error:.2f} unidades")
+    if motor > 1:
+        print(f"✗ el motor tardó {motor:.2f} s con {len(ids):,} items")
+        sys.exit(1)
+    print("✓ el motor de pronóstico corre en menos de un segundo")
+
+
+def bench_lots(args):
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    app = load_app(os.path.join(tmp, 'lots.db'))
+    rng = random.Random(5)
+    inicio = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0) - timedelta(days=30 * args.months)
+    with app.get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO inventario (nombre, categoria, cantidad, precio_unitario, proveedor, stock_minimo) "
+            "VALUES (?, 'Materiales', 0, 10000, 'Proveedor', 10)",
+            [(f"Material {i:05d}",) for i in range(args.items)])
+        ids = [row[0] for row in conn.execute("SELECT id FROM inventario WHERE nombre LIKE 'Material %'")]
+
+    # Cada mes entra un lote por item y se consume en varias salidas; los triggers aplican FEFO
+    movimientos = 0
+    start = time.perf_counter()
+    for mes in range(args.months):
+        fecha = inicio + timedelta(days=30 * mes)
+        filas = []
+        for item_id in ids:
+            vence = (fecha + timedelta(days=rng.randint(60, 540))).strftime('%Y-%m-%d')
+            filas.append((item_id, 'entrada', 30, f"L{mes:03d}", vence, fecha.strftime('%Y-%m-%d %H:%M:%S')))
+            for salida in range(4):
+                dia = fecha + timedelta(days=7 * salida + 1)
+                filas.append((item_id, 'consumo', -rng.randint(3, 9), None, None, dia.strftime('%Y-%m-%d %H:%M:%S')))
+        with app.get_connection() as conn:
+            conn.executemany('''
+                INSERT INTO inventario_movimientos (item_id, tipo, cantidad, lote, vencimiento, fecha)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', filas)
+        movimientos += len(filas)
+    elapsed = time.perf_counter() - start
+    print(f"{movimientos:,} movimientos con lotes en {elapsed:.1f} s ({movimientos / elapsed:,.0f} movimientos/s)")
+
+    failures = []
+    hoy = datetime.now().date()
+    with app.get_connection() as conn:
+        total, activos = conn.execute('SELECT COUNT(*), SUM(cantidad > 0) FROM inventario_lotes').fetchone()
+        print(f"{total:,} lotes en {args.months} meses, {activos:,} con saldo")
+        consultas = {
+            'lotes_fefo': (app.HOT_QUERIES['lotes_fefo'][0], (ids[len(ids) // 2],)),
+            'lotes_por_vencer': (app.HOT_QUERIES['lotes_por_vencer'][0], ((hoy + timedelta(days=30)).isoformat(),)),
+            'resumen_vencimientos': (app.EXPIRY_SUMMARY_SQL,
+                                     {'hoy': hoy.isoformat(), 'hasta': (hoy + timedelta(days=30)).isoformat()}),
+        }
+        for name, (sql, params) in consultas.items():
+            # Solo índices y ya en orden: ningún paso puede leer la tabla de lotes ni ordenar en memoria
+            for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+                if 'inventario_lotes' in row[3] or row[3].startswith('SEARCH l '):
+                    if 'COVERING INDEX' not in row[3]:
+                        failures.append(f"{name}: {row[3]}")
+                if 'TEMP B-TREE FOR ORDER BY' in row[3]:
+                    failures.append(f"{name}: {row[3]}")
+            start = time.perf_counter()
+            for _ in range(100):
+                conn.execute(sql, params).fetchall()
+            print(f"{name:<22} {(time.perf_counter() - start) * 10:.2f} ms")
+
+        # FEFO: ningún lote con saldo vence antes que otro del mismo item que entró después y ya se consumió
+        fuera_de_orden = conn.execute('''
+            SELECT COUNT(*) FROM inventario_lotes a
+            JOIN inventario_lotes b ON b.item_id = a.item_id AND b.cantidad < b.inicial AND b.id > a.id
+            WHERE a.cantidad > 0 AND a.fecha_vencimiento <= b.fecha_vencimiento
+        ''').fetchone()[0]
+        if fuera_de_orden:
+            failures.append(f"{fuera_de_orden} lotes con saldo vencen antes que otro ya consumido")
+        if not app.inventory_lot_differences(conn).empty:
+            failures.append("el saldo de algunos items no coincide con sus lotes")
+    for failure in failures[:20]:
+        print(f"✗ {failure}")
+    if failures:
+        sys.exit(1)
+    print("✓ consumo en orden FEFO y consultas de vencimiento resueltas solo con índices")
+
+
+# Páginas que visita cada rol al entrar (usuarios de los datos de ejemplo)
+ROLE_PAGES = {
+    'Administrador': ('admin', 'admin123', ["📊 Dashboard", "📋 Órdenes", "📊 Reportes"]),
+    'Secretaria': ('secretaria', 'sec123', ["📊 Dashboard", "📋 Órdenes"]),
+    'Técnico': ('tecnico1', 'tech123', ["📋 Mis Órdenes", "📦 Inventario"]),
+    'Mensajero': ('mensajero1', 'msg123', ["🚚 Entregas"]),
+    'Doctor': ('dr.juan', '123456', ["📋 Mis Órdenes", "🦷 Servicios"]),
+}
+HEAVY_MODULES = ('plotly.express', 'reportlab', 'qrcode', 'PIL.Image')
+
+
+def measure_role(script, role):
+    """Iniciar sesión con un rol en un proceso nuevo y medir tiempo, memoria y módulos cargados"""
+    from streamlit.testing.v1 import AppTest
+
+    username, password, pages = ROLE_PAGES[role]
+    start = time.perf_counter()
+    at = AppTest.from_file(script, default_timeout=120)
+    at.run()
+    at.text_input[0].input(username)
+    at.text_input[1].input(password)
+    at.button[0].click()
+    at.run()
+    for page in pages:
+        next(b for b in at.button if b.label == page).click()
+        at.run()
+    if at.exception:
+        raise SystemExit(f"{role}: {at.exception[0].message}")
+    return {
+        'segundos': time.perf_counter() - start,
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'modulos': [m for m in HEAVY_MODULES if m in sys.modules],
+    }
+
+
+def import_times(script, env):
+    """Tiempo de importación (ms) de app y de cada dependencia pesada según -X importtime"""
+    code = f"import sys; sys.path.insert(0, {os.path.dirname(script)!r}); import {os.path.splitext(os.path.basename(script))[0]}"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                            capture_output=True, text=True, check=True)
+    total = 0
+    paquetes = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            total += int(cumulative)
+        if name.strip() in HEAVY_MODULES:
+            paquetes[name.strip()] = int(cumulative) / 1000
+    return total / 1000, paquetes
+
+
+def bench_startup(args):
+    script = os.path.abspath(args.script)
+    if args.role:
+        print(json.dumps(measure_role(script, args.role)))
+        return
+
+    tmp = tempfile.mkdtemp(prefix='glab-bench-')
+    env = dict(os.environ, GLAB_DB_PATH=os.path.join(tmp, 'startup.db'))
+    subprocess.run([sys.executable, script, '--bootstrap'], env=env, check=True, capture_output=True)
+
+    total, paquetes = import_times(script, env)
+    print(f"importar app: {total:.0f} ms")
+    for name in HEAVY_MODULES:
+        print(f"  {name:<15} {f'{paquetes[name]:.0f} ms' if name in paquetes else 'no se importa al inicio'}")
+
+    print(f"{'rol':<14} {'segundos':>9} {'RSS MB':>8}  módulos pesados cargados")
+    for role in ROLE_PAGES:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), 'startup', '--script', script,
+                                 '--role', role], env=env, capture_output=True, text=True, check=True)
+        medida = json.loads(result.stdout.strip().splitlines()[-1])
+        print(f"{role:<14} {medida['segundos']:>9.2f} {medida['rss_mb']:>8.0f}  {', '.join(medida['modulos']) or '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = sub.add_parser('pool', help='Reruns por segundo: conexión por consulta vs pool con WAL')
+    p.add_argument('--orders', type=int, default=20000)
+    p.add_argument('--threads', type=int, default=4)
+    p.add_argument('--seconds', type=float, default=5)
+    p.set_defaults(func=bench_pool)
+
+    p = sub.add_parser('plans', help='Falla si alguna consulta de HOT_QUERIES recorre una tabla completa')
+    p.add_argument('--orders', type=int, default=1000000)
+    p.add_argument('--items', type=int, default=5000)
+    p.set_defaults(func=bench_plans)
+
+    p = sub.add_parser('tracking', help='Tiempo por búsqueda de tracking ID a medida que crece ordenes')
+    p.add_argument('--sizes', type=lambda v: [int(x) for x in v.split(',')], default=[10000, 100000, 1000000])
+    p.add_argument('--lookups', type=int, default=2000)
+    p.add_argument('--legacy-lookups', type=int, default=20)
+    p.set_defaults(func=bench_tracking)
+
+    p = sub.add_parser('allocator', help='Crea órdenes desde muchos hilos y verifica que no haya duplicados')
+    p.add_argument('--threads', type=int, default=16)
+    p.add_argument('--orders', type=int, default=200, help='órdenes por hilo')
+    p.add_argument('--tracking-length', type=int, default=3)
+    p.set_defaults(func=bench_allocator)
+
+    p = sub.add_parser('pdf', help='PDFs de orden por segundo: formulario redibujado vs plantilla')
+    p.add_argument('--orders', type=int, default=300)
+    p.set_defaults(func=bench_pdf)
+
+    p = sub.add_parser('export', help='Exportación masiva a ZIP: PDFs por segundo según número de procesos')
+    p.add_argument('--orders', type=int, default=2000)
+    p.add_argument('--workers', type=lambda v: [int(x) for x in v.split(',')], default=[1, 2, 4])
+    p.set_defaults(func=bench_export)
+
+    p = sub.add_parser('report', help='Reporte de técnicos: consulta agregada y PDF con muchas filas')
+    p.add_argument('--technicians', type=int, default=100)
+    p.add_argument('--orders', type=int, default=1000000)
+    p.add_argument('--detail-rows', type=lambda v: [int(x) for x in v.split(',')], default=[5000, 50000])
+    p.set_defaults(func=bench_report)
+
+    p = sub.add_parser('startup', help='Arranque en frío: -X importtime y memoria (RSS) por rol')
+    p.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py'))
+    p.add_argument('--role', choices=list(ROLE_PAGES), help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('events', help='Bitácora de eventos: escritura con triggers y percentiles por etapa')
+    p.add_argument('--events', type=int, default=2000000)
+    p.set_defaults(func=bench_events)
+
+    p = sub.add_parser('contention', help='Varios mensajeros toman la misma entrega: debe ganar exactamente uno')
+    p.add_argument('--threads', type=int, default=16)
+    p.add_argument('--orders', type=int, default=200)
+    p.set_defaults(func=bench_contention)
+
+    p = sub.add_parser('inventory', help='Consumos concurrentes del mismo item y entrega de proveedor en lote')
+    p.add_argument('--threads', type=int, default=16)
+    p.add_argument('--withdrawals', type=int, default=200, help='consumos por hilo')
+    p.add_argument('--items', type=int, default=5000)
+    p.set_defaults(func=bench_inventory)
+
+    p = sub.add_parser('materials', help='Cambio de estado en lote: reserva y consumo de materiales')
+    p.add_argument('--orders', type=int, default=5000)
+    p.set_defaults(func=bench_materials)
+
+    p = sub.add_parser('forecast', help='Pronóstico de demanda y reorden vectorizado para miles de items')
+    p.add_argument('--items', type=int, default=5000)
+    p.set_defaults(func=bench_forecast)
+
+    p = sub.add_parser('lots', help='Lotes acumulados por años: consumo FEFO y vencimientos solo con índices')
+    p.add_argument('--items', type=int, default=1000)
+    p.add_argument('--months', type=int, default=60)
+    p.set_defaults(func=bench_lots)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+"""Proceso de la exportación masiva de PDFs de G-LAB
+
+Los procesos del pool se crean con spawn (con fork heredarían los locks que otros hilos del
+servidor de Streamlit tuvieran tomados). Un proceso nuevo solo puede ejecutar funciones de un
+módulo importable, por eso el trabajo vive aquí y no en app.py, que Streamlit ejecuta como script.
+"""
+
+
+def render_order_pdf(order_data):
+    # order_pdf no importa Streamlit ni la aplicación: el proceso solo carga lo que dibuja el PDF
+    import order_pdf
+    return order_pdf.get_order_pdf(order_data)
@@ -0,0 +1,476 @@
+"""PDF de órdenes de G-LAB: formulario, QR y caché en disco
+
+No importa Streamlit: lo usan tanto app.py como los procesos de la exportación masiva
+(export_worker), que así no cargan la aplicación. Las cachés en memoria son por proceso.
+"""
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+# Función para generar QR
+def generate_qr_code(data):
+    import qrcode
+    
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(data)
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color="black", back_color="white")
+    return img
+
+# QR renderizados que se conservan en memoria (los menos usados recientemente salen primero)
+QR_CACHE_SIZE = 512
+
+# Función para generar QR como PNG en memoria, cacheado por contenido
+@functools.lru_cache(maxsize=QR_CACHE_SIZE)
+def generate_qr_png(data):
+    # En escala de grises: reportlab convertiría el bitmap a RGB, con el triple de datos por PDF
+    img = generate_qr_code(data).convert('L')
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+# Módulo de PDF de órdenes
+# Parte fija del formulario: recuadros, casillas y rótulos (igual para todas las órdenes)
+def _draw_order_form(c, width, height):
+    from reportlab.lib.colors import red, black
+    
+    # Header con logo estilizado
+    c.setFont("Helvetica-Bold", 20)
+    c.setFillColor(black)
+    c.drawString(100, height - 60, "🦷 Mónica Riano")
+    
+    c.setFont("Helvetica", 12)
+    c.drawString(100, height - 80, "LABORATORIO DENTAL S.A.S")
+    
+    # Número de orden en recuadro rojo (esquina superior derecha)
+    c.setFillColor(red)
+    c.rect(450, height - 100, 120, 60, fill=1)
+    c.setFillColor(black)
+    c.setFont("Helvetica-Bold", 10)
+    c.drawString(460, height - 55, "ORDEN No.")
+    
+    # Campos principales del formulario
+    y_pos = height - 140
+    
+    # NOMBRE DE LA CLÍNICA
+    c.setFont("Helvetica", 10)
+    c.drawString(50, y_pos, "NOMBRE DE LA CLÍNICA")
+    c.rect(50, y_pos - 25, 300, 20)
+    
+    # FECHA DE ENTREGA AL LABORATORIO (derecha)
+    c.drawString(400, y_pos, "FECHA DE ENTREGA AL LABORATORIO")
+    c.rect(400, y_pos - 25, 80, 20)
+    c.rect(480, y_pos - 25, 80, 20)
+    
+    # NOMBRE DEL DOCTOR(A)
+    y_pos -= 50
+    c.drawString(50, y_pos, "NOMBRE DEL DOCTOR(A)")
+    c.rect(50, y_pos - 25, 300, 20)
+    
+    # FECHA DE ENTREGA A LA CLÍNICA (derecha)
+    c.drawString(400, y_pos, "FECHA DE ENTREGA A LA CLÍNICA")
+    c.rect(400, y_pos - 25, 80, 20)
+    c.rect(480, y_pos - 25, 80, 20)
+    
+    # PACIENTE
+    y_pos -= 50
+    c.drawString(50, y_pos, "PACIENTE")
+    c.rect(50, y_pos - 25, 300, 20)
+    
+    # Secciones de checkboxes
+    y_pos -= 80
+    
+    # METAL CERÁMICA
+    c.drawString(50, y_pos, "METAL CERÁMICA")
+    c.rect(50, y_pos - 20, 150, 80)
+    
+    # Checkboxes dentro de Metal Cerámica
+    checkbox_y = y_pos - 35
+    c.rect(60, checkbox_y, 10, 10)
+    c.drawString(75, checkbox_y + 2, "SOBREDENTADURA")
+    
+    checkbox_y -= 15
+    c.rect(60, checkbox_y, 10, 10)
+    c.drawString(75, checkbox_y + 2, "CORONA")
+    
+    checkbox_y -= 15
+    c.rect(60, checkbox_y, 10, 10)
+    c.drawString(75, checkbox_y + 2, "BARRA HÍBRIDA")
+    
+    # DISILICATO DE LITIO (centro)
+    c.drawString(220, y_pos, "DISILICATO DE LITIO")
+    c.rect(220, y_pos - 20, 150, 80)
+    
+    # Checkboxes dentro de Disilicato de Litio
+    checkbox_y = y_pos - 35
+    c.rect(230, checkbox_y, 10, 10)
+    c.drawString(245, checkbox_y + 2, "CARILLAS")
+    
+    checkbox_y -= 15
+    c.rect(230, checkbox_y, 10, 10)
+    c.drawString(245, checkbox_y + 2, "CORONAS")
+    
+    checkbox_y -= 15
+    c.rect(230, checkbox_y, 10, 10)
+    c.drawString(245, checkbox_y + 2, "INCRUSTACIÓN")
+    
+    # DISILICATO DE LITIO (derecha)
+    c.drawString(390, y_pos, "DISILICATO DE LITIO")
+    c.rect(390, y_pos - 20, 150, 80)
+    
+    # Checkboxes dentro de Disilicato de Litio (derecha)
+    checkbox_y = y_pos - 35
+    c.rect(400, checkbox_y, 10, 10)
+    c.drawString(415, checkbox_y + 2, "COLOR SUSTRATO")
+    
+    checkbox_y -= 15
+    c.rect(400, checkbox_y, 10, 10)
+    c.drawString(415, checkbox_y + 2, "COLOR FINAL")
+    
+    checkbox_y -= 15
+    c.rect(400, checkbox_y, 10, 10)
+    c.drawString(415, checkbox_y + 2, "ZIRCONIO")
+    
+    # Segunda fila de secciones
+    y_pos -= 120
+    
+    # TITANIO
+    c.drawString(50, y_pos, "TITANIO")
+    c.rect(50, y_pos - 20, 150, 60)
+    
+    checkbox_y = y_pos - 35
+    c.rect(60, checkbox_y, 10, 10)
+    c.drawString(75, checkbox_y + 2, "BARRA")
+    
+    checkbox_y -= 15
+    c.rect(60, checkbox_y, 10, 10)
+    c.drawString(75, checkbox_y + 2, "PILAR PERSONALIZADA")
+    
+    # Continuación de Disilicato (centro)
+    c.drawString(220, y_pos, "")
+    c.rect(220, y_pos - 20, 150, 60)
+    
+    checkbox_y = y_pos - 35
+    c.rect(230, checkbox_y, 10, 10)
+    c.drawString(245, checkbox_y + 2, "MONOLÍTICO")
+    
+    checkbox_y -= 15
+    c.rect(230, checkbox_y, 10, 10)
+    c.drawString(245, checkbox_y + 2, "ESTRATIFICADA")
+    
+    # Continuación de Disilicato (derecha)
+    c.drawString(390, y_pos, "")
+    c.rect(390, y_pos - 20, 150, 60)
+    
+    checkbox_y = y_pos - 35
+    c.rect(400, checkbox_y, 10, 10)
+    c.drawString(415, checkbox_y + 2, "MONOLÍTICO")
+    
+    checkbox_y -= 15
+    c.rect(400, checkbox_y, 10, 10)
+    c.drawString(415, checkbox_y + 2, "ESTRATIFICADA")
+    
+    # UNIDADES DE IMPLANTES y TIPO DE IMPRESIÓN
+    y_pos -= 80
+    
+    c.drawString(50, y_pos, "UNIDADES DE IMPLANTES")
+    c.rect(50, y_pos - 25, 100, 20)
+    
+    c.drawString(200, y_pos, "TIPO DE IMPRESIÓN")
+    c.rect(200, y_pos - 20, 150, 40)
+    
+    checkbox_y = y_pos - 35
+    c.rect(210, checkbox_y, 10, 10)
+    c.drawString(225, checkbox_y + 2, "ANALÓGICA")
+    
+    checkbox_y -= 15
+    c.rect(210, checkbox_y, 10, 10)
+    c.drawString(225, checkbox_y + 2, "DIGITAL")
+    
+    c.drawString(400, y_pos, "UNIDADES DE PREPARACIÓN")
+    c.rect(400, y_pos - 25, 100, 20)
+    
+    # OBSERVACIONES
+    y_pos -= 80
+    c.drawString(50, y_pos, "OBSERVACIONES")
+    c.rect(50, y_pos - 80, 490, 75)
+    
+    # Sección inferior con más checkboxes
+    y_pos -= 120
+    
+    # FOTOGRAFÍAS
+    c.drawString(50, y_pos, "FOTOGRAFÍAS")
+    c.rect(50, y_pos - 20, 120, 100)
+    
+    checkbox_items = ["ANTAGONISTA", "REGISTRO OCLUSAL", "MODELO DE ESTUDIO", "ENFILADO"]
+    checkbox_y = y_pos - 35
+    for item in checkbox_items:
+        c.rect(60, checkbox_y, 10, 10)
+        c.drawString(75, checkbox_y + 2, item)
+        checkbox_y -= 20
+    
+    # JIG DE VERIFICACIÓN (centro)
+    c.drawString(200, y_pos, "")
+    c.rect(200, y_pos - 20, 150, 100)
+    
+    checkbox_items = ["JIG DE VERIFICACIÓN", "ANÁLOGO", "TRANSFER DE IMPRESIÓN", "ADITAMIENTO", "TORNILLO LABORATORIO", "ENCERADO"]
+    checkbox_y = y_pos - 35
+    for item in checkbox_items:
+        c.rect(210, checkbox_y, 10, 10)
+        c.drawString(225, checkbox_y + 2, item)
+        checkbox_y -= 15
+    
+    # CARACTERÍSTICAS DEL PILAR (derecha)
+    c.drawString(380, y_pos, "CARACTERÍSTICAS DEL PILAR")
+    c.rect(380, y_pos - 20, 160, 100)
+    
+    checkbox_items = ["DIENTE NATURAL", "DIENTE PIGMENTADO", "NÚCLEO PLATEADO", "NÚCLEO DORADO"]
+    checkbox_y = y_pos - 35
+    for item in checkbox_items:
+        c.rect(390, checkbox_y, 10, 10)
+        c.drawString(405, checkbox_y + 2, item)
+        checkbox_y -= 20
+    
+    # Footer con contacto
+    c.setFont("Helvetica", 10)
+    c.drawString(50, 50, "cel.: 313-222-1878 • e-mail: mrlaboratoriodental@gmail.com")
+
+# Campos variables de cada orden sobre el formulario
+def _draw_order_fields(c, order_data, width, height):
+    from reportlab.lib.colors import black
+    
+    c.setFillColor(black)
+    c.setFont("Helvetica-Bold", 18)
+    c.drawString(470, height - 75, order_data.get('numero_orden', 'N/A'))
+    
+    c.setFont("Helvetica", 10)
+    c.drawString(55, height - 160, order_data.get('clinica', ''))
+    c.drawString(55, height - 210, order_data.get('doctor', ''))
+    c.drawString(55, height - 260, order_data.get('paciente', ''))
+    
+    # OBSERVACIONES (el recuadro empieza en height - 600)
+    y_pos = height - 600
+    if order_data.get('observaciones'):
+        # Dividir texto en líneas para que quepa en el recuadro
+        obs_text = order_data['observaciones']
+        lines = []
+        words = obs_text.split()
+        current_line = ""
+        for word in words:
+            if len(current_line + " " + word) < 70:
+                current_line += " " + word if current_line else word
+            else:
+                lines.append(current_line)
+                current_line = word
+        if current_line:
+            lines.append(current_line)
+        
+        text_y = y_pos - 20
+        for line in lines[:3]:  # Máximo 3 líneas
+            c.drawString(55, text_y, line)
+            text_y -= 15
+    
+    # QR Code en esquina inferior derecha
+    try:
+        from reportlab.lib.utils import ImageReader
+        
+        qr_png = generate_qr_png(f"Orden: {order_data.get('numero_orden', 'N/A')} - Tracking: {order_data.get('tracking_id', 'N/A')}")
+        c.drawImage(ImageReader(BytesIO(qr_png)), 480, 30, 60, 60)
+    except Exception as qr_error:
+        # Si falla el QR, continuar sin él
+        c.setFont("Helvetica", 8)
+        c.drawString(480, 50, f"Tracking: {order_data.get('tracking_id', 'N/A')}")
+
+class OrderFormTemplate:
+    """Formulario de orden grabado una sola vez y reutilizado como XObject en cada PDF.
+    
+    Copiar lo grabado usa internos del canvas de reportlab (_code, _doc.fontMapping), por eso
+    reportlab está fijado a la versión 4 en requirements.txt. Si faltan, disponible queda en False
+    y cada PDF dibuja el formulario con la API pública; benchmark.py pdf falla en ese caso.
+    """
+    name = 'formulario_orden'
+    
+    def __init__(self, pagesize):
+        from reportlab.pdfgen import canvas
+        
+        self.pagesize = pagesize
+        # Grabar las operaciones de dibujo en un lienzo descartable
+        scratch = canvas.Canvas(BytesIO(), pagesize=pagesize)
+        doc = getattr(scratch, '_doc', None)
+        self.disponible = (isinstance(getattr(scratch, '_code', None), list) and
+                           all(hasattr(doc, attr) for attr in ('fontMapping', 'hasForm', 'getInternalFontName')))
+        if self.disponible:
+            scratch.beginForm(self.name)
+            _draw_order_form(scratch, *pagesize)
+            self.code = tuple(scratch._code)
+            # El contenido grabado se refiere a las fuentes por nombre interno (/F1, /F2...)
+            self.fonts = tuple(doc.fontMapping.items())
+    
+    def stamp(self, c):
+        if not self.disponible:
+            c.beginForm(self.name)
+            _draw_order_form(c, *self.pagesize)
+            c.endForm()
+            c.doForm(self.name)
+            return
+        # El XObject se define una vez por documento y se repite en cada página
+        if not c._doc.hasForm(self.name):
+            for psname, internal in self.fonts:
+                if c._doc.getInternalFontName(psname) != internal:
+                    raise RuntimeError(f"Fuente {psname} registrada como {c._doc.getInternalFontName(psname)}, se esperaba {internal}")
+            c.beginForm(self.name)
+            c._code.extend(self.code)
+            c.endForm()
+        c.doForm(self.name)
+
+@functools.lru_cache(maxsize=None)
+def get_order_form_template(pagesize):
+    return OrderFormTemplate(pagesize)
+
+# Función para generar PDF con formato exacto
+def generate_order_pdf(order_data):
+    try:
+        from reportlab.lib.pagesizes import letter
+        from reportlab.pdfgen import canvas
+        
+        buffer = BytesIO()
+        c = canvas.Canvas(buffer, pagesize=letter)
+        width, height = letter
+        
+        get_order_form_template(letter).stamp(c)
+        _draw_order_fields(c, order_data, width, height)
+        
+        c.save()
+        buffer.seek(0)
+        return buffer
+        
+    except Exception as e:
+        print(f"Error generando PDF: {str(e)}")  # Para debug
+        return None
+
+# Módulo de caché de PDFs en disco
+# La clave es un hash de los campos que dibuja generate_order_pdf: cuando un cambio (edición,
+# estado, técnico) toca alguno de esos campos la clave cambia y el PDF anterior deja de usarse;
+# si no los toca, el PDF guardado sigue siendo válido
+ORDER_PDF_FIELDS = ('numero_orden', 'clinica', 'doctor', 'paciente', 'observaciones', 'tracking_id')
+ORDER_PDF_LAYOUT_VERSION = 1  # Subir al cambiar el diseño del formulario
+PDF_CACHE_DIR = os.environ.get('GLAB_PDF_CACHE_DIR', 'pdf_cache')
+PDF_CACHE_MAX_MB = int(os.environ.get('GLAB_PDF_CACHE_MB', '256'))
+PDF_CACHE_EVICT_EVERY = 50
+
+def order_pdf_key(order_data):
+    campos = [ORDER_PDF_LAYOUT_VERSION] + [
+        '' if order_data.get(campo) is None else str(order_data.get(campo)) for campo in ORDER_PDF_FIELDS
+    ]
+    return hashlib.sha256(json.dumps(campos).encode()).hexdigest()
+
+class PDFCache:
+    """PDFs guardados en disco por clave de contenido, compartidos entre procesos"""
+    
+    def __init__(self, directorio, max_bytes):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.escrituras = 0
+        self.lock = threading.Lock()
+    
+    def _path(self, key):
+        return os.path.join(self.directorio, key[:2], key + '.pdf')
+    
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as archivo:
+                data = archivo.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # La fecha de modificación marca el último uso para desalojar primero lo más antiguo
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+    
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Escribir en un temporal y renombrar: ningún proceso ve un PDF a medio escribir
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as archivo:
+                archivo.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        
+        with self.lock:
+            self.escrituras += 1
+            desalojar = self.escrituras % PDF_CACHE_EVICT_EVERY == 0
+        if desalojar:
+            self.evict()
+    
+    def evict(self):
+        """Borrar los PDFs usados hace más tiempo hasta quedar en el 90% del límite"""
+        entradas = []
+        total = 0
+        ahora = time.time()
+        for subdir in os.scandir(self.directorio):
+            if not subdir.is_dir():
+                continue
+            for entrada in os.scandir(subdir.path):
+                try:
+                    info = entrada.stat()
+                except FileNotFoundError:
+                    continue  # Otro proceso la borró
+                if entrada.name.endswith('.tmp'):
+                    # Temporales huérfanos de un proceso que se interrumpió
+                    if ahora - info.st_mtime > 3600:
+                        self._remove(entrada.path)
+                    continue
+                entradas.append((info.st_mtime, info.st_size, entrada.path))
+                total += info.st_size
+        
+        borrados = 0
+        if total > self.max_bytes:
+            entradas.sort()
+            for _, size, path in entradas:
+                if total <= self.max_bytes * 0.9:
+                    break
+                if self._remove(path):
+                    total -= size
+                    borrados += 1
+        return borrados
+    
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+@functools.lru_cache(maxsize=None)
+def get_pdf_cache(directorio, max_mb):
+    return PDFCache(directorio, max_mb * 1024 * 1024)
+
+def get_order_pdf(order_data):
+    """PDF de la orden (bytes); solo se genera si no está en la caché"""
+    cache = get_pdf_cache(PDF_CACHE_DIR, PDF_CACHE_MAX_MB)
+    key = order_pdf_key(order_data)
+    pdf = cache.get(key)
+    if pdf is None:
+        buffer = generate_order_pdf(order_data)
+        if buffer is None:
+            return None
+        pdf = buffer.getvalue()
+        try:
+            cache.put(key, pdf)
+        except OSError:
+            pass  # Sin espacio o sin permisos: el PDF se entrega igual, solo no queda en caché
+    return pdf